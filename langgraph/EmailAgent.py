@@ -53,6 +53,8 @@ from langchain_openai import ChatOpenAI
 from langgraph.types import Command, interrupt
 from langgraph.graph import END, START, StateGraph
 
+from structured_output import structured
+
 def read_email(state: EmailAgentState) -> EmailAgentState:
     """Extract and parse email content"""
     pass
@@ -66,8 +68,11 @@ llm = ChatOpenAI(
 def classify_intent(state: EmailAgentState) -> EmailAgentState:
     """Use LLM to classify email intent and urgency, then route accordingly"""
 
-    # Create structured LLM that returns EmailClassification dict
-    structured_llm = llm.with_structured_output(EmailClassification)
+    # Create structured LLM that returns EmailClassification dict, repairing near misses locally
+    structured_llm = structured(llm, EmailClassification, aliases={
+        "urgency": {"urgent": "high", "asap": "high", "normal": "medium", "moderate": "medium", "emergency": "critical"},
+        "intent": {"inquiry": "question", "payment": "billing", "feature request": "feature"},
+    })
 
     classification_prompt = f"""
     Analyze this customer email and classify it:
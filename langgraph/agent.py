@@ -1,9 +1,12 @@
 from langchain_core.messages import SystemMessage
 from langchain_openai import ChatOpenAI
 
-from langgraph.graph import START, StateGraph, MessagesState
-from langgraph.prebuilt import tools_condition, ToolNode
+from langgraph.graph import StateGraph, MessagesState
 
+from arithmetic import add_fast_path
+from tool_executor import cached_results, cached_tools_condition, pure, tool_node
+
+@pure
 def add(a: int, b: int) -> int:
     """Adds a and b.
 
@@ -13,6 +16,7 @@ def add(a: int, b: int) -> int:
     """
     return a + b
 
+@pure
 def multiply(a: int, b: int) -> int:
     """Multiplies a and b.
 
@@ -22,6 +26,7 @@ def multiply(a: int, b: int) -> int:
     """
     return a * b
 
+@pure
 def divide(a: int, b: int) -> float:
     """Divide a and b.
 
@@ -42,18 +47,22 @@ sys_msg = SystemMessage(content="You are a helpful assistant tasked with writing
 
 # Node
 def assistant(state: MessagesState):
-   return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+   response = llm_with_tools.invoke([sys_msg] + state["messages"])
+   # Tool calls the cache can answer skip the tools node
+   return {"messages": [response] + cached_results(response, tools)}
 
 # Build graph
 builder = StateGraph(MessagesState)
 builder.add_node("assistant", assistant)
-builder.add_node("tools", ToolNode(tools))
-builder.add_edge(START, "assistant")
+builder.add_node("tools", tool_node(tools))
+# With ARITHMETIC_FAST_PATH=1 plain arithmetic is answered locally, everything else goes to the LLM
+add_fast_path(builder, "assistant", ["add", "multiply", "divide"])
 builder.add_conditional_edges(
     "assistant",
     # If the latest message (result) from assistant is a tool call -> tools_condition routes to tools
     # If the latest message (result) from assistant is a not a tool call -> tools_condition routes to END
-    tools_condition,
+    # If the tool calls were answered from the cache -> routes to assistant
+    cached_tools_condition("assistant"),
 )
 builder.add_edge("tools", "assistant")
 
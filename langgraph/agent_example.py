@@ -1,17 +1,23 @@
 import os
 import time
-from typing import TypedDict, List, Any
+import uuid
+from typing import Annotated, TypedDict, List
 
 # --------------------------
 # LangChain / LangGraph imports
 # --------------------------
 
 from langchain_openai import ChatOpenAI
+from langchain_core.messages import AnyMessage, RemoveMessage, ToolMessage, convert_to_messages
 from langchain_core.tools import tool
 from langchain_community.tools.tavily_search import TavilySearchResults
 
 from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
+from langgraph.graph.message import add_messages
+
+import safe_math
+import tool_executor
+from tool_executor import pure
 
 
 # --------------------------
@@ -36,11 +42,23 @@ os.environ["TAVILY_API_KEY"] = "YOUR_TAVILY_API_KEY"
 search_tool = TavilySearchResults(max_results=3)
 
 
+@pure
 @tool
 def math(expr: str):
-    """Evaluate a Python math expression."""
+    """Evaluate a math expression: numbers, + - * / // % **, comparisons, sqrt, log, sin, ..., pi, e."""
+    try:
+        return safe_math.evaluate(expr)
+    except Exception as e:
+        return f"Math error: {e}"
+
+
+@pure
+@tool
+def math_steps(steps: List[str]):
+    """Evaluate several math expressions in order, in one call. A step may be `name = expression`
+    and later steps can use name; a list like [10, 20, 30] is a vector, operations apply to every element."""
     try:
-        return eval(expr)
+        return safe_math.evaluate_steps(steps)
     except Exception as e:
         return f"Math error: {e}"
 
@@ -52,15 +70,34 @@ def wait(seconds: int):
     return f"Waited {seconds} seconds"
 
 
-TOOLS = [search_tool, math, wait]
+TOOLS = [search_tool, math, math_steps, wait]
 
 
 # --------------------------
 # 3. LangGraph State Structure
 # --------------------------
 
+def append_messages(left, right):
+
+    """ add_messages, but an update that only adds new messages is appended without re-indexing the history
+
+    add_messages converts and indexes every message of the history on each step, which is most of the
+    per-step cost once a conversation has a few hundred messages. Removals and replacements (a message
+    id already in the history) still go through add_messages.
+    """
+
+    right = convert_to_messages(right if isinstance(right, list) else [right])
+    ids = {m.id for m in left}
+    if any(isinstance(m, RemoveMessage) or m.id in ids for m in right):
+        return add_messages(left, right)
+    for m in right:
+        if m.id is None:
+            m.id = str(uuid.uuid4())
+    return left + right
+
+# Nodes return only their new messages, append_messages appends them to the history
 class AgentState(TypedDict):
-    messages: List[Any]
+    messages: Annotated[List[AnyMessage], append_messages]
 
 
 # --------------------------
@@ -69,14 +106,16 @@ class AgentState(TypedDict):
 
 def agent_node(state: AgentState):
     response = llm.invoke(state["messages"])
-    return {"messages": state["messages"] + [response]}
+    # Tool calls the cache can answer skip the tool node
+    return {"messages": [response] + tool_executor.cached_results(response, TOOLS)}
 
 
 # --------------------------
 # 5. Tool Execution Node
 # --------------------------
 
-tool_node = ToolNode(TOOLS)
+# ToolNode with per-call timeouts, wait may legitimately run long
+tool_node = tool_executor.tool_node(TOOLS, timeouts={"wait": 120})
 
 
 # --------------------------
@@ -86,6 +125,10 @@ tool_node = ToolNode(TOOLS)
 def router(state: AgentState):
     last = state["messages"][-1]
 
+    # If the tool calls were answered from the cache, back to the LLM
+    if isinstance(last, ToolMessage):
+        return "agent"
+
     # If LLM wants to call a tool (OpenAI tool_calls format)
     if last.additional_kwargs.get("tool_calls"):
         return "tool"
@@ -111,6 +154,7 @@ graph.add_conditional_edges(
     router,            # routing function
     {
         "tool": "tool",
+        "agent": "agent",
         "end": END,
     }
 )
@@ -130,8 +174,11 @@ def run_agent(query: str):
 
     print("\n========== AGENT START ==========\n")
 
+    # Each update holds only the messages the node added
     for update in app.stream(state):
-        print(update)
+        for node, delta in update.items():
+            for message in delta["messages"]:
+                print(f"[{node}] {message.type}: {message.content or getattr(message, 'tool_calls', '')}")
         final_state = update
 
     print("\n========== FINAL ANSWER ==========\n")
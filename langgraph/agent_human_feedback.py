@@ -2,8 +2,11 @@ from langchain_core.messages import SystemMessage
 from langchain_openai import ChatOpenAI
 
 from langgraph.graph import START, StateGraph, MessagesState
-from langgraph.prebuilt import tools_condition, ToolNode
+from langgraph.prebuilt import tools_condition
 
+from tool_executor import pure, tool_node
+
+@pure
 def add(a: int, b: int) -> int:
     """Adds a and b.
 
@@ -13,6 +16,7 @@ def add(a: int, b: int) -> int:
     """
     return a + b
 
+@pure
 def multiply(a: int, b: int) -> int:
     """Multiplies a and b.
 
@@ -22,6 +26,7 @@ def multiply(a: int, b: int) -> int:
     """
     return a * b
 
+@pure
 def divide(a: int, b: int) -> float:
     """Adds a and b.
 
@@ -47,7 +52,8 @@ def assistant(state: MessagesState):
 # Build graph
 builder = StateGraph(MessagesState)
 builder.add_node("assistant", assistant)
-builder.add_node("tools", ToolNode(tools))
+# Cached results are still served by the tools node, so every call keeps its approval step
+builder.add_node("tools", tool_node(tools))
 builder.add_edge(START, "assistant")
 builder.add_conditional_edges(
     "assistant",
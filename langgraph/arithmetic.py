@@ -0,0 +1,121 @@
+""" Arithmetic fast path for the calculator agents
+
+Most requests to the calculator agents are one operation on two numbers
+("Multiply 3 by 2", "what is 12 + 7?"), which the tool loop answers with two
+LLM calls around the tool. The fast_path node parses such requests locally
+and answers them directly; anything it is not sure about (more than one
+operation, words it does not know, division by zero, an operation the graph
+has no tool for) goes to the LLM as before.
+
+    add_fast_path(builder, "assistant", ["add", "multiply", "divide"])
+
+replaces builder.add_edge(START, "assistant"). The fast path is off unless
+ARITHMETIC_FAST_PATH=1; when off every request falls through to the LLM.
+Graphs that interrupt before the LLM node (state.py) should not use it: an
+answered request ends the run before the breakpoint.
+"""
+
+import os
+import re
+import threading
+from collections import Counter
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.graph import START, END
+
+arithmetic_fast_path = os.environ.get("ARITHMETIC_FAST_PATH", "0") == "1"
+
+# Requests served by the fast path vs handed to the LLM
+fast_path_stats = Counter()
+_lock = threading.Lock()
+
+NUMBER = r"(-?\d+(?:\.\d+)?)"
+
+OPERATIONS = {
+    "add": ("+", lambda a, b: a + b),
+    "multiply": ("*", lambda a, b: a * b),
+    "divide": ("/", lambda a, b: a / b),
+}
+
+# Whole-request patterns, after lowercasing and dropping polite prefixes and trailing punctuation.
+# Symbols may touch the numbers, words (and "x") need spaces around them: "0x10" is not 0 * 10
+PATTERNS = [
+    (re.compile(rf"multiply {NUMBER} (?:by|and|with|times) {NUMBER}"), "multiply"),
+    (re.compile(rf"(?:the )?product of {NUMBER} and {NUMBER}"), "multiply"),
+    (re.compile(rf"{NUMBER}(?: ?[*×] ?| (?:x|times|multiplied by) ){NUMBER}"), "multiply"),
+    (re.compile(rf"add {NUMBER} (?:and|to|plus) {NUMBER}"), "add"),
+    (re.compile(rf"(?:the )?sum of {NUMBER} and {NUMBER}"), "add"),
+    (re.compile(rf"{NUMBER}(?: ?\+ ?| plus ){NUMBER}"), "add"),
+    (re.compile(rf"divide {NUMBER} (?:by|over) {NUMBER}"), "divide"),
+    (re.compile(rf"{NUMBER}(?: ?[/÷] ?| (?:divided by|over) ){NUMBER}"), "divide"),
+]
+
+PREFIX = re.compile(r"^(?:(?:please|can you|could you|what is|what's|whats|compute|calculate|tell me|how much is)[ ,]+)+")
+
+def parse_number(text: str):
+    return float(text) if "." in text else int(text)
+
+def parse_arithmetic(text: str, operations=None):
+
+    """ (operation, a, b) when the whole request is one supported operation on two numbers, else None """
+
+    text = re.sub(r"\s+", " ", text.strip().lower()).rstrip("?.! ")
+    text = PREFIX.sub("", text)
+    for pattern, operation in PATTERNS:
+        match = pattern.fullmatch(text)
+        if match and (operations is None or operation in operations):
+            return operation, parse_number(match.group(1)), parse_number(match.group(2))
+    return None
+
+def format_number(x):
+    if isinstance(x, float) and x.is_integer():
+        return str(int(x))
+    return str(round(x, 10)) if isinstance(x, float) else str(x)
+
+def answer(text: str, operations=None):
+
+    """ Answer to a plain arithmetic request, None if the request should go to the LLM """
+
+    parsed = parse_arithmetic(text, operations)
+    if parsed is None:
+        return None
+    operation, a, b = parsed
+    if operation == "divide" and b == 0:
+        return None
+    symbol, apply = OPERATIONS[operation]
+    return f"{format_number(a)} {symbol} {format_number(b)} = {format_number(apply(a, b))}"
+
+def fast_path_node(operations=None):
+
+    """ Node answering the last human message when it is plain arithmetic, otherwise leaving the state as is """
+
+    def fast_path(state):
+        last = state["messages"][-1]
+        content = answer(last.content, operations) if arithmetic_fast_path and isinstance(last, HumanMessage) else None
+        with _lock:
+            fast_path_stats["served" if content else "fallback"] += 1
+        if content is None:
+            return {}
+        return {"messages": [AIMessage(content=content, name="fast_path")]}
+    return fast_path
+
+def route_fast_path(fallback: str):
+
+    """ END when the fast path answered, else the LLM node """
+
+    def route(state):
+        return END if isinstance(state["messages"][-1], AIMessage) else fallback
+    return route
+
+def add_fast_path(builder, entry: str, operations=None):
+
+    """ START -> fast_path -> (END | entry) in place of START -> entry """
+
+    builder.add_node("fast_path", fast_path_node(operations))
+    builder.add_edge(START, "fast_path")
+    builder.add_conditional_edges("fast_path", route_fast_path(entry), [entry, END])
+
+def fast_path_share() -> float:
+    with _lock:
+        total = fast_path_stats["served"] + fast_path_stats["fallback"]
+        return fast_path_stats["served"] / total if total else 0.0
@@ -0,0 +1,1187 @@
+""" Offline benchmarks for the langgraph examples
+
+The LLM and the search backends are swapped for in-process fakes, so the
+numbers reflect what the graphs do (LLM calls, searches, prompt sizes)
+rather than Ollama or network latency.
+
+Usage:
+    python benchmarks.py                  # run everything
+    python benchmarks.py query_planning   # run one benchmark
+"""
+
+import asyncio
+import contextlib
+import functools
+import importlib
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from langchain_core.documents import Document
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage, HumanMessage
+
+import structured_output
+from retrieval_cache import RetrievalCache
+
+### Fakes
+
+class FakeLLM:
+
+    """ Stand-in chat model that counts calls by kind ("chat" or the structured output schema name) """
+
+    def __init__(self, reply="This is an answer from the expert [1].", latency=0.0, structured=None, slow=None, prefill=0.0, slots=None):
+        self.reply = reply
+        self.latency = latency
+        self.prefill = prefill
+        # Requests the fake server works on at once (like OLLAMA_NUM_PARALLEL), sync calls queue for a slot
+        self.slots = threading.BoundedSemaphore(slots) if slots else contextlib.nullcontext()
+        self.slow = slow or {}
+        self.structured = structured or {}
+        self.calls = Counter()
+        self.prompt_chars = Counter()
+        self.max_prompt_chars = 0
+
+    def with_structured_output(self, schema, include_raw=False, **kwargs):
+        return FakeStructuredLLM(self, schema, include_raw)
+
+    def _record(self, kind, messages):
+        self.calls[kind] += 1
+        if isinstance(messages, str):
+            chars = len(messages)
+        else:
+            chars = sum(len(getattr(m, "content", m)) for m in messages)
+        self.prompt_chars[kind] += chars
+        self.max_prompt_chars = max(self.max_prompt_chars, chars)
+
+    def delay(self, messages):
+
+        """ Latency of a call: base latency (or that of a matching `slow` marker) plus prefill seconds per 1k prompt tokens """
+
+        text = messages if isinstance(messages, str) else " ".join(str(getattr(m, "content", m)) for m in messages)
+        base = max([self.latency] + [latency for marker, latency in self.slow.items() if marker in text])
+        return base + self.prefill * len(text) / 4000
+
+    def invoke(self, messages, config=None, **kwargs):
+        self._record("chat", messages)
+        with self.slots:
+            time.sleep(self.delay(messages))
+        return AIMessage(content=self.reply)
+
+    async def ainvoke(self, messages, config=None, **kwargs):
+        self._record("chat", messages)
+        await asyncio.sleep(self.delay(messages))
+        return AIMessage(content=self.reply)
+
+    def batch(self, inputs, config=None, **kwargs):
+        with ThreadPoolExecutor(max_workers=(config or {}).get("max_concurrency") or len(inputs) or 1) as pool:
+            return list(pool.map(self.invoke, inputs))
+
+class FakeStructuredLLM:
+
+    """ Structured output view of a FakeLLM
+
+    Responders in FakeLLM.structured return a schema instance, or raw text that is parsed like
+    with_structured_output would (so malformed output can be simulated).
+    """
+
+    def __init__(self, llm, schema, include_raw=False):
+        self.llm = llm
+        self.schema = schema
+        self.include_raw = include_raw
+
+    def _respond(self, messages):
+        name = getattr(self.schema, "__name__", str(self.schema))
+        self.llm._record(name, messages)
+        if name in self.llm.structured:
+            result = self.llm.structured[name](messages)
+        else:
+            result = self.schema.model_validate({field: "benchmark query" for field in self.schema.model_fields})
+        if not isinstance(result, str):
+            text = json.dumps(result.model_dump() if hasattr(result, "model_dump") else result)
+            return {"raw": AIMessage(content=text), "parsed": result, "parsing_error": None} if self.include_raw else result
+        try:
+            parsed = structured_output.validate(json.loads(result), self.schema)
+        except (ValueError, TypeError) as e:
+            if not self.include_raw:
+                raise OutputParserException(str(e), llm_output=result)
+            return {"raw": AIMessage(content=result), "parsed": None, "parsing_error": e}
+        return {"raw": AIMessage(content=result), "parsed": parsed, "parsing_error": None} if self.include_raw else parsed
+
+    def invoke(self, messages, config=None, **kwargs):
+        with self.llm.slots:
+            time.sleep(self.llm.delay(messages))
+            return self._respond(messages)
+
+    async def ainvoke(self, messages, config=None, **kwargs):
+        await asyncio.sleep(self.llm.delay(messages))
+        return self._respond(messages)
+
+    def batch(self, inputs, config=None, **kwargs):
+        with ThreadPoolExecutor(max_workers=(config or {}).get("max_concurrency") or len(inputs) or 1) as pool:
+            return list(pool.map(self.invoke, inputs))
+
+searches = Counter()
+
+class FakeTavilySearchResults:
+
+    """ Stand-in for TavilySearchResults returning three canned hits """
+
+    latency = 0.0
+
+    def __init__(self, max_results=3, **kwargs):
+        self.max_results = max_results
+
+    def invoke(self, query):
+        searches["web"] += 1
+        time.sleep(self.latency)
+        return [{"url": f"https://example.com/{i}", "content": f"Web result {i} for {query}."}
+                for i in range(self.max_results)]
+
+    async def ainvoke(self, query):
+        return self.invoke(query)
+
+class FakeWikipediaLoader:
+
+    """ Stand-in for WikipediaLoader returning canned pages """
+
+    latency = 0.0
+    sentences = 40
+
+    def __init__(self, query, load_max_docs=2, **kwargs):
+        self.query = query
+        self.load_max_docs = load_max_docs
+
+    def load(self):
+        searches["wikipedia"] += 1
+        time.sleep(self.latency)
+        return [Document(page_content="\n\n".join(f"Sentence {k} of article {i} about {self.query}." for k in range(self.sentences)),
+                         metadata={"source": f"https://en.wikipedia.org/wiki/Article_{i}"})
+                for i in range(self.load_max_docs)]
+
+    async def aload(self):
+        return self.load()
+
+@contextlib.contextmanager
+def fake_research_assistant(llm, cache=None):
+
+    """ research_assistant with the LLM, the search backends and the retrieval cache replaced, put back on exit """
+
+    import research_assistant
+    searches.clear()
+    with mock.patch.multiple(research_assistant, llm=llm, TavilySearchResults=FakeTavilySearchResults,
+                             WikipediaLoader=FakeWikipediaLoader, shared_cache=cache or RetrievalCache(":memory:")):
+        yield research_assistant
+
+def sample_analyst(research_assistant, i=0):
+    return research_assistant.Analyst(affiliation="Benchmark Labs", name=f"Analyst {i}",
+                                      role="Researcher", description=f"Focus area number {i}.")
+
+def restores(target, *names):
+
+    """ Decorator putting the named attributes of target (a module name, or an object such as a fake class)
+    back as they were before the benchmark, which changes them to compare settings """
+
+    def decorate(bench):
+        @functools.wraps(bench)
+        def run():
+            obj = importlib.import_module(target) if isinstance(target, str) else target
+            saved = {name: getattr(obj, name) for name in names}
+            try:
+                return bench()
+            finally:
+                for name, value in saved.items():
+                    setattr(obj, name, value)
+        return run
+    return decorate
+
+### Benchmarks
+
+@restores("research_assistant", "per_backend_queries", "novelty_threshold")
+def bench_query_planning():
+
+    """ LLM calls per interview turn with the query-planning stage """
+
+    for per_backend in (False, True):
+        llm = FakeLLM()
+        with fake_research_assistant(llm) as ra:
+            ra.per_backend_queries = per_backend
+            ra.novelty_threshold = 0.0
+            max_num_turns = 3
+            ra.interview_graph.invoke({"analyst": sample_analyst(ra),
+                                       "messages": [HumanMessage(content="So you said you were writing an article on LangGraph?")],
+                                       "max_num_turns": max_num_turns})
+            query_calls = llm.calls["SearchQuery"] + llm.calls["SearchQueries"]
+            retrievers = 2
+            print(f"per_backend_queries={per_backend}")
+            print(f"  turns                         : {max_num_turns}")
+            print(f"  query-writing calls per turn  : {query_calls / max_num_turns:.1f} (was {retrievers}, one per retriever)")
+            print(f"  LLM calls per turn            : {(sum(llm.calls.values()) - 1) / max_num_turns:.1f} (was 4, excluding the final write_section)")
+            lookups = ra.shared_cache.counters["hits"] + ra.shared_cache.counters["misses"]
+            print(f"  searches per turn             : {lookups / max_num_turns:.1f}")
+
+@restores(FakeTavilySearchResults, "latency")
+@restores(FakeWikipediaLoader, "latency")
+def bench_retrieval_cache():
+
+    """ Two reports on the same topic: the second is served from the on-disk retrieval cache """
+
+    FakeTavilySearchResults.latency = FakeWikipediaLoader.latency = 0.2
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = RetrievalCache(os.path.join(tmp, "retrieval.sqlite"))
+        for run in ("cold", "warm"):
+            # Distinct query per planning call, repeated identically in the second run
+            queries = iter(range(1000))
+            llm = FakeLLM(structured={"SearchQuery": lambda messages: ra.SearchQuery(search_query=f"langgraph topic {next(queries)}")})
+            with fake_research_assistant(llm, cache) as ra:
+                start = time.perf_counter()
+                for i in range(3):
+                    ra.interview_graph.invoke({"analyst": sample_analyst(ra, i),
+                                               "messages": [HumanMessage(content="So you said you were writing an article on LangGraph?")],
+                                               "max_num_turns": 2})
+                elapsed = time.perf_counter() - start
+                print(f"{run}: {elapsed:.2f}s, network searches: {sum(searches.values())}, cache: {cache.stats()}")
+
+@restores("research_assistant", "answer_token_budget", "section_token_budget", "wikipedia_top_k")
+@restores(FakeWikipediaLoader, "sentences")
+def bench_context_packing():
+
+    """ Prompt tokens sent by the interview with and without token-budgeted context packing """
+
+    import context_packing
+    FakeWikipediaLoader.sentences = 600
+    for budget in (0, 2000):
+        queries = iter(range(1000))
+        llm = FakeLLM(structured={"SearchQuery": lambda messages: ra.SearchQuery(search_query=f"langgraph topic {next(queries)}")})
+        with fake_research_assistant(llm) as ra:
+            ra.answer_token_budget = ra.section_token_budget = budget
+            ra.wikipedia_top_k = 0
+            context_packing.totals.clear()
+            ra.interview_graph.invoke({"analyst": sample_analyst(ra),
+                                       "messages": [HumanMessage(content="So you said you were writing an article on LangGraph?")],
+                                       "max_num_turns": 3})
+            print(f"budget={budget or 'off'}: ~{context_packing.count_tokens('x' * llm.prompt_chars['chat'])} prompt tokens "
+                  f"over {llm.calls['chat']} calls, packing: {context_packing.packing_stats()}")
+
+@restores("research_assistant", "reduce_group_size", "max_concurrency")
+def bench_tree_reduce():
+
+    """ Reduce phase over many sections: one flat prompt vs the hierarchical reduce """
+
+    from context_packing import count_tokens
+    memo = "## Section\n\n" + "An insight with a citation [1]. " * 80 + "\n\n### Sources\n[1] https://example.com\n"
+    for group_size in (0, 5):
+        llm = FakeLLM(reply=memo, latency=0.05)
+        with fake_research_assistant(llm) as ra:
+            ra.reduce_group_size = group_size
+            ra.max_concurrency = 8
+            state = {"topic": "LangGraph", "sections": [memo] * 24}
+            start = time.perf_counter()
+            state.update(ra.condense_sections(state))
+            merge_calls = llm.calls["chat"]
+            for node in (ra.write_report, ra.write_introduction, ra.write_conclusion):
+                state.update(node.invoke(state))
+            elapsed = time.perf_counter() - start
+            print(f"group_size={group_size or 'flat'}: {merge_calls} merge calls, memos for writers: {len(state['memos'])}, "
+                  f"largest prompt ~{count_tokens('x' * llm.max_prompt_chars)} tokens, {elapsed:.2f}s")
+
+def ollama_prefill(messages, model="llama3.1", url="http://localhost:11434/api/chat"):
+
+    """ (prompt tokens evaluated, prefill seconds) of one call to the native Ollama API, generating a single token """
+
+    roles = {"system": "system", "human": "user", "ai": "assistant"}
+    body = json.dumps({"model": model, "stream": False, "options": {"num_predict": 1, "temperature": 0},
+                       "messages": [{"role": roles[m.type], "content": m.content} for m in messages]}).encode()
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        result = json.loads(response.read())
+    return result.get("prompt_eval_count", 0), result.get("prompt_eval_duration", 0) / 1e9
+
+def bench_reduce_prefill():
+
+    """ Shared-prefix reduce prompts vs the previous layout (sections after task-specific instructions)
+
+    Offline it reports how many prompt tokens the three calls have in common; with a local Ollama
+    server it also measures the prefill each call actually pays (prompt_eval_count / _duration).
+    """
+
+    import research_assistant as ra
+    from context_packing import count_tokens
+    memos = [f"## Memo {i}\n\n" + " ".join(f"Finding {i}.{k} about agent orchestration [{k % 3 + 1}]." for k in range(120))
+             for i in range(5)]
+    state = {"topic": "real world applications of langgraph", "formatted_sections": ra.format_sections(memos)}
+    tasks = [ra.report_writer_instructions,
+             ra.intro_conclusion_instructions.format(section="introduction"),
+             ra.intro_conclusion_instructions.format(section="conclusion")]
+
+    layouts = {
+        # Previous layout: one system message, task instructions first and the sections at the end
+        "before": [[ra.SystemMessage(content=task + "\n\n" + ra.reduce_messages(state, task)[0].content)] for task in tasks],
+        "after": [ra.reduce_messages(state, task) for task in tasks],
+    }
+    for name, prompts in layouts.items():
+        texts = ["\n".join(m.content for m in prompt) for prompt in prompts]
+        shared = len(os.path.commonprefix(texts))
+        print(f"{name}: prompts ~{[count_tokens(t) for t in texts]} tokens, shared prefix ~{count_tokens('x' * shared)} tokens")
+        try:
+            measured = [ollama_prefill(prompt) for prompt in prompts]
+        except OSError as e:
+            print(f"  (Ollama not reachable, skipping prefill timing: {e})")
+            continue
+        for (evaluated, seconds), label in zip(measured, ("report", "introduction", "conclusion")):
+            print(f"  {label:<12}: {evaluated} prompt tokens evaluated, prefill {seconds:.2f}s")
+
+@restores("research_assistant", "novelty_threshold")
+def bench_novelty_stopping():
+
+    """ Interviews whose follow-up searches keep returning the same documents, with and without novelty stopping """
+
+    for threshold in (0.0, 0.1):
+        llm = FakeLLM()
+        with fake_research_assistant(llm) as ra:
+            ra.novelty_threshold = threshold
+            interview_stats = []
+            for i in range(3):
+                result = ra.interview_graph.invoke({"analyst": sample_analyst(ra, i),
+                                                    "messages": [HumanMessage(content="So you said you were writing an article on LangGraph?")],
+                                                    "max_num_turns": 5})
+                interview_stats.extend(result["interview_stats"])
+            lookups = ra.shared_cache.counters["hits"] + ra.shared_cache.counters["misses"]
+            print(f"novelty_threshold={threshold}: {sum(llm.calls.values())} LLM calls, {lookups} searches, "
+                  f"{ra.interview_savings(interview_stats)}")
+
+@restores("research_assistant", "wikipedia_top_k", "novelty_threshold")
+@restores(FakeWikipediaLoader, "sentences")
+def bench_wikipedia_passages():
+
+    """ Wikipedia context per turn and page fetches: whole pages vs the per-interview passage index """
+
+    from context_packing import count_tokens
+    FakeWikipediaLoader.sentences = 600
+    for top_k in (0, 4):
+        queries = iter(range(1000))
+        llm = FakeLLM(structured={"SearchQuery": lambda messages: ra.SearchQuery(search_query=f"langgraph topic {next(queries)}")})
+        with fake_research_assistant(llm) as ra:
+            ra.wikipedia_top_k = top_k
+            ra.novelty_threshold = 0.0
+            result = ra.interview_graph.invoke({"analyst": sample_analyst(ra),
+                                                "messages": [HumanMessage(content="So you said you were writing an article on LangGraph?")],
+                                                "max_num_turns": 3})
+            wikipedia = [entry for entry in ra.document_store.resolve(result["context"]) if "wikipedia.org" in entry]
+            print(f"wikipedia_top_k={top_k or 'whole pages'}: {searches['wikipedia']} page fetches over 3 turns, "
+                  f"~{sum(count_tokens(entry) for entry in wikipedia) // 3} tokens of Wikipedia context per turn")
+
+def bench_wikipedia_snapshot():
+
+    """ Build a synthetic 30k-article snapshot and time queries against it
+
+    Words follow a Zipf distribution over a 50k vocabulary, like real text: the most common terms are in nearly
+    every article, so their postings lists are as long as the collection. Queries mix common and rare terms.
+    The build runs with small runs (max_run_postings) so the on-disk merge is exercised.
+    """
+
+    import wiki_snapshot
+    rng = random.Random(0)
+    vocabulary = [f"term{i}" for i in range(50000)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    articles = [(f"Article {i} {rng.choices(vocabulary, cum_weights=weights)[0]}", " ".join(rng.choices(vocabulary, cum_weights=weights, k=300)))
+                for i in range(30000)]
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        wiki_snapshot.build_snapshot(iter(articles), tmp, max_run_postings=1_000_000)
+        print(f"indexed {len(articles)} articles in {time.perf_counter() - start:.1f}s, "
+              f"{sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp)) / 1e6:.1f} MB on disk")
+        snapshot = wiki_snapshot.open_snapshot(tmp)
+        longest = max(snapshot._lookup(term)[1] for term in vocabulary[:5])
+        latencies = []
+        for _ in range(200):
+            query = " ".join(rng.choices(vocabulary, cum_weights=weights, k=4))
+            start = time.perf_counter()
+            docs = wiki_snapshot.WikipediaSnapshotLoader(query, load_max_docs=2, path=tmp).load()
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        print(f"query latency: p50 {statistics.median(latencies):.2f} ms, p95 {latencies[int(len(latencies) * 0.95)]:.2f} ms "
+              f"(longest postings list {longest}), {len(docs)} docs per query, metadata {sorted(docs[0].metadata)}")
+        wiki_snapshot.open_snapshot.cache_clear()
+
+@restores("research_assistant", "novelty_threshold", "wikipedia_top_k")
+def bench_document_store():
+
+    """ Bytes of interview state, checkpoints and stream_mode="values" events with document IDs vs inline text
+
+    The inline figures serialize the same states with every ID replaced by its text, which is what the graph carried before.
+    """
+
+    from langgraph.checkpoint.memory import MemorySaver
+    from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+    serde = JsonPlusSerializer()
+    llm = FakeLLM()
+    with fake_research_assistant(llm) as ra:
+        ra.novelty_threshold = 0.0
+        ra.wikipedia_top_k = 0
+        graph = ra.interview_builder.compile(checkpointer=MemorySaver())
+
+        def size(values, inline):
+            if inline and values.get("context"):
+                values = {**values, "context": ra.document_store.resolve(values["context"])}
+            return len(serde.dumps_typed(values)[1])
+
+        totals = Counter()
+        for i in range(3):
+            config = {"configurable": {"thread_id": f"analyst-{i}"}}
+            interview = ra.interview_input("LangGraph", sample_analyst(ra, i)) | {"max_num_turns": 3}
+            for values in graph.stream(interview, config, stream_mode="values"):
+                totals["stream_ids"] += size(values, False)
+                totals["stream_inline"] += size(values, True)
+                if values.get("context"):
+                    totals["final_ids"], totals["final_inline"] = size(values, False), size(values, True)
+            # What conduct_interview does once the interview ends, released documents stay resolvable until evicted
+            ra.document_store.release(interview["interview_id"])
+            for checkpoint in graph.checkpointer.list(config):
+                channel_values = checkpoint.checkpoint["channel_values"]
+                totals["checkpoint_ids"] += size(channel_values, False)
+                totals["checkpoint_inline"] += size(channel_values, True)
+        for label, key in (("stream_mode=values bytes", "stream"), ("checkpoint bytes", "checkpoint"), ("last interview state bytes", "final")):
+            print(f"{label:<27}: {totals[key + '_inline']:>9} inline -> {totals[key + '_ids']:>7} with IDs "
+                  f"({totals[key + '_inline'] / totals[key + '_ids']:.1f}x smaller)")
+        print(f"document store: {ra.document_store.stats()}")
+
+def bench_approval_jobs():
+
+    """ Research jobs waiting on reviewers who answer at random times: one process, no thread held per waiting job """
+
+    llm = FakeLLM(latency=0.02, structured={"Perspectives": lambda messages: ra.Perspectives(analysts=[sample_analyst(ra, i) for i in range(3)])})
+    with fake_research_assistant(llm) as ra:
+        rng = random.Random(0)
+        review_delays = [rng.uniform(0.0, 1.0) for _ in range(24)]
+
+        async def run():
+            jobs = ra.ResearchJobs()
+            job_ids = [jobs.start(f"topic {i}") for i in range(len(review_delays))]
+            start = time.perf_counter()
+            reviewed, peak_pending = set(), 0
+
+            # Reviewers approve each job review_delays[i] seconds after it starts
+            while len(reviewed) < len(job_ids):
+                pending = jobs.pending()
+                peak_pending = max(peak_pending, len(pending))
+                for request in pending:
+                    i = job_ids.index(request["job_id"])
+                    if time.perf_counter() - start >= review_delays[i]:
+                        jobs.resume(request["job_id"], "approve")
+                        reviewed.add(request["job_id"])
+                await asyncio.sleep(0.01)
+            reports = [await jobs.wait(job_id) for job_id in job_ids]
+            return time.perf_counter() - start, peak_pending, reports
+
+        elapsed, peak_pending, reports = asyncio.run(run())
+        print(f"{len(reports)} jobs, {sum('final_report' in r for r in reports)} reports, peak {peak_pending} awaiting approval at once")
+        print(f"wall time {elapsed:.2f}s vs {sum(review_delays):.2f}s of review waits alone when input() blocked each run in turn")
+
+class CrashingLLM(FakeLLM):
+
+    """ FakeLLM raising on prompts containing the `crash` marker, like a timeout or a dead Ollama server """
+
+    crash = () # markers that must all appear in the prompt
+
+    def check(self, messages):
+        text = " ".join(str(getattr(m, "content", m)) for m in messages)
+        if self.crash and all(marker in text for marker in self.crash):
+            raise RuntimeError("simulated crash")
+
+    def invoke(self, messages, config=None, **kwargs):
+        self.check(messages)
+        return super().invoke(messages, config, **kwargs)
+
+    async def ainvoke(self, messages, config=None, **kwargs):
+        self.check(messages)
+        return await super().ainvoke(messages, config, **kwargs)
+
+@restores("research_assistant", "document_store", "graph")
+def bench_checkpoint_resume():
+
+    """ Crash a checkpointed run, resume it as a new process would (fresh checkpointer and document store) and count the work redone """
+
+    from doc_store import DocumentStore
+    crashes = {"write_report": ("Think carefully about the insights from each memo above",),
+               "a write_section": ("You are an expert technical writer", "Focus area number 2.")}
+    for label, marker in [("no crash", ())] + list(crashes.items()):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "checkpoints.sqlite")
+            llm = CrashingLLM(structured={"Perspectives": lambda messages: ra.Perspectives(analysts=[sample_analyst(ra, i) for i in range(3)])})
+            with fake_research_assistant(llm) as ra:
+                ra.document_store = DocumentStore()
+                ra.document_store.persist(path + ".documents")
+                ra.graph = ra.builder.compile(checkpointer=ra.checkpointer(path))
+                llm.crash = marker
+                try:
+                    ra.run_research("LangGraph", review=lambda request: "approve", thread_id="benchmark")
+                except RuntimeError:
+                    pass
+                first = (sum(llm.calls.values()), ra.shared_cache.counters["hits"] + ra.shared_cache.counters["misses"])
+                if not marker:
+                    print(f"{label:<24}: {first[0]} LLM calls, {first[1]} searches")
+                    continue
+
+                # New process: nothing in memory but the SQLite file
+                llm.crash = ()
+                llm.calls.clear()
+                ra.shared_cache = RetrievalCache(":memory:")
+                ra.document_store = DocumentStore()
+                ra.document_store.persist(path + ".documents")
+                ra.graph = ra.builder.compile(checkpointer=ra.checkpointer(path))
+                result = ra.resume_research("benchmark", review=lambda request: "approve")
+                print(f"crash in {label:<15}: {first[0]} LLM calls, {first[1]} searches before the crash, "
+                      f"resume: {sum(llm.calls.values())} LLM calls, {ra.shared_cache.counters['hits'] + ra.shared_cache.counters['misses']} searches, "
+                      f"{len(result['sections'])} sections, report {'written' if result.get('final_report') else 'missing'}")
+
+@restores("map_reduce", "joke_mode", "joke_group_size")
+def bench_joke_batching():
+
+    """ Jokes/sec of the map step: one call per subject via Send(), one list-of-jokes call, grouped calls through
+    model.batch, and the size-based choice between the last two (auto)
+
+    The fake server works on 4 requests at once; a call costs 0.2s (round trip and prefill of the
+    instructions) plus 0.03s per joke it writes. It returns the jokes of a group in reverse order, so
+    matching them to subjects by position would pair every joke with the wrong subject.
+    """
+
+    import map_reduce as mr
+
+    def write_jokes(messages):
+        subjects = [line[2:] for line in messages.splitlines() if line.startswith("- ")]
+        time.sleep(0.03 * len(subjects))
+        return mr.Jokes(jokes=[mr.SubjectJoke(subject=s, joke=f"A joke about {s}.") for s in reversed(subjects)])
+
+    def write_joke(messages):
+        time.sleep(0.03)
+        return mr.Joke(joke=f"A joke about {messages.rsplit(' ', 1)[-1]}.")
+
+    for num_subjects in (3, 24, 120):
+        for mode, group_size in (("send", None), ("single", None), ("batch", 8), ("auto", 8)):
+            llm = FakeLLM(latency=0.2, slots=4,
+                          structured={"Subjects": lambda messages: mr.Subjects(subjects=[f"subject{i}" for i in range(num_subjects)]),
+                                      "Jokes": write_jokes, "Joke": write_joke,
+                                      "BestJoke": lambda messages: mr.BestJoke(id=0)})
+            with mock.patch.object(mr, "model", llm):
+                mr.joke_mode = mode
+                mr.joke_group_size = group_size or mr.joke_group_size
+                state = {"topic": "computers", **mr.generate_topics({"topic": "computers"})}
+                start = time.perf_counter()
+                if mode == "send":
+                    # Send() fans out every subject at once, as the graph does
+                    with ThreadPoolExecutor(max_workers=num_subjects) as pool:
+                        jokes = [j for update in pool.map(mr.generate_joke, [{"subject": s} for s in state["subjects"]]) for j in update["jokes"]]
+                else:
+                    jokes = mr.generate_jokes(state)["jokes"]
+                elapsed = time.perf_counter() - start
+                label = mode if group_size is None else f"{mode}, groups of {group_size}"
+                in_order = jokes == [f"A joke about {s}." for s in state["subjects"]]
+                print(f"{num_subjects:>3} subjects, {label:<20}: {len(jokes) / elapsed:6.1f} jokes/sec, "
+                      f"{llm.calls['Joke'] + llm.calls['Jokes']} calls, jokes match subjects in order: {in_order}")
+
+@restores("map_reduce", "best_joke_mode", "tournament_group_size")
+def bench_joke_selection():
+
+    """ best_joke over many candidates: one flat prompt vs the tournament with groups of 8 and 16
+
+    The fake judge costs 0.1s per call plus 0.2s per 1k prompt tokens, serves 4 calls at once and
+    always prefers the one golden joke, so every mode should return it. The flat prompt outgrows
+    Ollama's default 2048-token context window (silently truncated) past ~80 jokes.
+    """
+
+    import map_reduce as mr
+    from context_packing import count_tokens
+
+    def judge(messages):
+        jokes = messages.split("Jokes: \n\n  ", 1)[1].split("\n\n")
+        return mr.BestJoke(id=next((i for i, joke in enumerate(jokes) if "golden" in joke), 0))
+
+    for num_jokes in (24, 120, 480):
+        jokes = [f"Joke {i}: why did the computer {i} go to the doctor? Because it had a virus, again and again." for i in range(num_jokes)]
+        jokes[num_jokes * 2 // 3] = "The golden joke: there are 10 kinds of people, those who read binary and those who do not."
+        for mode, group_size in (("flat", None), ("tournament", 8), ("tournament", 16)):
+            llm = FakeLLM(latency=0.1, prefill=0.2, slots=4, structured={"BestJoke": judge})
+            with mock.patch.object(mr, "model", llm):
+                mr.best_joke_mode = mode
+                mr.tournament_group_size = group_size or 8
+                rounds, remaining = 1, num_jokes
+                while mode == "tournament" and remaining > group_size:
+                    rounds, remaining = rounds + 1, -(-remaining // group_size)
+                start = time.perf_counter()
+                best = mr.best_joke({"topic": "computers", "jokes": jokes})["best_selected_joke"]
+                elapsed = time.perf_counter() - start
+                label = mode if mode == "flat" else f"groups of {group_size}"
+                largest = count_tokens("x" * llm.max_prompt_chars)
+                print(f"{num_jokes:>3} jokes, {label:<12}: {elapsed:.2f}s, {rounds} round(s), {llm.calls['BestJoke']:>3} calls, "
+                      f"largest prompt ~{largest:>5} tokens (fits 2048: {largest <= 2048}), golden joke selected: {'golden' in best}")
+
+def bench_structured_repair():
+
+    """ Structured calls against a llama3.1-like fake that often answers almost-valid JSON: retries only vs local repair first
+
+    A quarter of the responses come wrapped in prose or code fences, truncated, or (rarely) unusable;
+    enum values vary in case and wording and BestJoke IDs are sometimes 1-based (one past the end).
+    """
+
+    from typing import Literal, TypedDict
+    import map_reduce as mr
+
+    # Same shape as EmailAgent.EmailClassification (EmailAgent runs its graph on import)
+    class EmailClassification(TypedDict):
+        intent: Literal["question", "bug", "billing", "feature", "complex"]
+        urgency: Literal["low", "medium", "high", "critical"]
+        topic: str
+        summary: str
+
+    rng = random.Random(0)
+
+    def corrupt(data):
+        text = json.dumps(data)
+        kind = rng.choices(["valid", "prose", "fence", "truncated", "garbage"], weights=[75, 6, 6, 10, 3])[0]
+        if kind == "prose":
+            return f"Sure! Here is the result: {text} Let me know if you need anything else."
+        if kind == "fence":
+            return f"```json\n{text}\n```"
+        if kind == "truncated":
+            return text[:rng.randint(len(text) * 2 // 3, len(text) - 1)]
+        if kind == "garbage":
+            return "I'm sorry, I cannot help with that."
+        return text
+
+    responders = {
+        "Subjects": lambda messages: corrupt({"subjects": ["keyboards", "debugging", "the cloud"]}),
+        "BestJoke": lambda messages: corrupt({"id": rng.choice([0, 1, 2, 3, 4])}),
+        "EmailClassification": lambda messages: corrupt({"intent": rng.choice(["billing", "Billing"]),
+                                                         "urgency": rng.choice(["high", "High", "urgent", "critical", "Critical"]),
+                                                         "topic": "double charge", "summary": "Customer was charged twice for one subscription."}),
+    }
+    urgency_aliases = {"urgency": {"urgent": "high"}}
+    for repair in (False, True):
+        rng.seed(0)
+        structured_output.counters.clear()
+        llm = FakeLLM(latency=0.0, structured=responders)
+        unusable = 0
+        for _ in range(200):
+            for schema, kwargs in ((mr.Subjects, {}), (mr.BestJoke, {"fixup": mr.clamp_id(4)}), (EmailClassification, {"aliases": urgency_aliases})):
+                try:
+                    result = structured_output.structured(llm, schema, retries=2, repair=repair, **kwargs).invoke("prompt")
+                    # An out-of-range ID used to fall back to the first joke: a wrong pick
+                    unusable += schema is mr.BestJoke and not 0 <= result.id < 4
+                except OutputParserException:
+                    unusable += 1
+        stats = structured_output.repair_stats()
+        print(f"repair={repair}: {sum(llm.calls.values())} LLM calls for 600 results "
+              f"(parsed {stats['parsed']}, repaired {stats['repaired']}, retried {stats['retried']}, failed {stats['failed']}), "
+              f"unusable results: {unusable}")
+
+@restores("parallelization", "answer_deadline", "hedge_requests")
+def bench_answer_deadline():
+
+    """ Answer latency of parallelization.py when backends have latency tails: wait for all vs deadline vs deadline + hedging
+
+    Web search takes ~20ms and Wikipedia ~40ms, but 3% of requests to either stall for 0.5s.
+    """
+
+    import parallelization as par
+    rng = random.Random(0)
+    lock = threading.Lock()
+
+    def backend_latency(base):
+        with lock:
+            return 0.5 if rng.random() < 0.03 else base * rng.uniform(0.8, 1.2)
+
+    class TailTavily(FakeTavilySearchResults):
+        def invoke(self, query):
+            time.sleep(backend_latency(0.02))
+            return super().invoke(query)
+
+    class TailWikipedia(FakeWikipediaLoader):
+        def load(self):
+            time.sleep(backend_latency(0.04))
+            return super().load()
+
+    with mock.patch.multiple(par, llm=FakeLLM(), TavilySearchResults=TailTavily, WikipediaLoader=TailWikipedia,
+                             shared_cache=RetrievalCache(":memory:"), latencies=par.LatencyTracker()):
+        for label, deadline, hedge in (("wait for all", 0.0, False), ("deadline 0.15s", 0.15, False), ("deadline 0.15s + hedging", 0.15, True)):
+            rng.seed(0)
+            par.shared_cache = RetrievalCache(":memory:")
+            par.answer_deadline, par.hedge_requests = deadline, hedge
+            par.latencies = par.LatencyTracker()
+            par.retrieval_stats.clear()
+            timings, partial = [], 0
+            for i in range(150):
+                start = time.perf_counter()
+                result = par.graph.invoke({"question": f"question {i}"})
+                timings.append(time.perf_counter() - start)
+                partial += len(result["context"]) < 2
+            timings.sort()
+            print(f"{label:<25}: p50 {timings[len(timings) // 2] * 1000:4.0f} ms, p99 {timings[int(len(timings) * 0.99)] * 1000:4.0f} ms, "
+                  f"max {timings[-1] * 1000:4.0f} ms, {partial} of {len(timings)} answers missing a backend, {dict(par.retrieval_stats)}")
+
+@restores("research_assistant", "novelty_threshold")
+def bench_context_rendering():
+
+    """ Prompt tokens of the context as formatted before (the list's repr) vs the compact numbered renderer
+
+    The context set is recorded from the fake backends: the parallelization.py retrieval for ten
+    questions and the retrieval of a three-turn research interview (duplicates included, as state holds them).
+    Tokens are counted with tiktoken's cl100k_base when its encoding is available, else estimated at ~4 characters per token.
+    """
+
+    from context_packing import count_tokens, render_context
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        tokens, counter = (lambda text: len(encoding.encode(text))), "cl100k_base"
+    except Exception:
+        tokens, counter = count_tokens, "~4 chars/token"
+
+    import parallelization as par
+    with mock.patch.multiple(par, TavilySearchResults=FakeTavilySearchResults, WikipediaLoader=FakeWikipediaLoader,
+                             shared_cache=RetrievalCache(":memory:")):
+        recorded = [par.search_web({"question": f"How were Nvidia's Q{i % 4 + 1} {2020 + i} earnings?"})["context"]
+                    + par.search_wikipedia({"question": f"How were Nvidia's Q{i % 4 + 1} {2020 + i} earnings?"})["context"]
+                    for i in range(10)]
+
+    with fake_research_assistant(FakeLLM()) as ra:
+        ra.novelty_threshold = 0.0
+        result = ra.interview_graph.invoke({"analyst": sample_analyst(ra),
+                                            "messages": [HumanMessage(content="So you said you were writing an article on LangGraph?")],
+                                            "max_num_turns": 3})
+        recorded.append(ra.document_store.resolve(result["context"]))
+
+        before = sum(tokens(str(context)) for context in recorded)
+        after = sum(tokens(render_context(context)) for context in recorded)
+        escapes = sum(str(context).count("\\") for context in recorded)
+        print(f"{len(recorded)} recorded contexts, tokens counted with {counter}")
+        print(f"list repr (before) : {before} tokens, {escapes} escape sequences")
+        print(f"numbered (after)   : {after} tokens ({(before - after) / before:.0%} fewer)")
+
+@restores("chatbot", "summary_token_budget")
+def bench_background_summary():
+
+    """ Turn latency of chatbot.py with the summary inline vs in the background
+
+    Replies take ~0.2s plus prefill; the user takes 0.5s to type between turns, which is when background summaries run.
+    """
+
+    import chatbot
+    with mock.patch.object(chatbot, "model", FakeLLM(reply="Sure, the 49ers' best season was 1984.", latency=0.2, prefill=0.5)):
+        # Summarize every few turns, as the short messages here never reach the token budget
+        chatbot.summary_token_budget = 0
+        for mode in ("inline", "background"):
+            chatbot.latencies.clear()
+            chatbot.summary_stats.clear()
+            for turn in range(30):
+                chatbot.chat(f"Question {turn} about the 49ers?", thread_id=f"{mode}-thread", mode=mode)
+                time.sleep(0.5)
+            chatbot.wait_for_summary(f"{mode}-thread")
+            state = chatbot.graphs[mode].get_state({"configurable": {"thread_id": f"{mode}-thread"}}).values
+            print(f"{mode}: {len(state['messages'])} messages and a {len(state.get('summary', ''))} char summary in state at the end, "
+                  f"{dict(chatbot.summary_stats)}")
+            print(f"  turn latency {chatbot.latency_histogram(chatbot.latencies[f'turn:{mode}'], buckets=(0.25, 0.3, 0.4, 0.5, 0.75, 1))}")
+        print(f"  waits for a background summary {chatbot.latency_histogram(chatbot.latencies['summary_wait'])}")
+
+@restores("chatbot", "summary_token_budget", "incremental_summary")
+def bench_rolling_summary():
+
+    """ Summarization prompts over a 60 turn chatbot.py conversation: message count trigger + full history vs token budget + incremental
+
+    Most user messages are short questions, every tenth pastes ~2k tokens of text; replies are ~100 tokens. The fake summarizer
+    extends the summary by a sentence per message it is shown and keeps it within a word limit when the prompt sets one,
+    which is how "extend the summary" behaves in practice: without a limit the summary grows with the conversation.
+    """
+
+    import re
+    import chatbot
+
+    class SummaryLLM(FakeLLM):
+        def invoke(self, messages, config=None, **kwargs):
+            prompt = messages[-1].content
+            if "summary of the conversation" not in prompt:
+                return super().invoke(messages, config, **kwargs)
+            self._record("summary", messages)
+            self.summary_prompts.append(sum(len(m.content) for m in messages) // 4)
+            summary = prompt.split("to date: ", 1)[1].split("\n\n", 1)[0] if "to date: " in prompt else ""
+            summary += " The user and the assistant talked about the 49ers." * (len(messages) - 1)
+            limit = re.search(r"at most (\d+) words", prompt)
+            if limit:
+                summary = " ".join(summary.split()[-int(limit.group(1)):])
+            return AIMessage(content=summary.strip())
+
+    rng = random.Random(0)
+    turns = [("Here is the article: " + "The 49ers won five Super Bowls. " * 250) if turn % 10 == 9
+             else f"Question {turn}: " + "what about the 49ers? " * rng.randint(1, 6) for turn in range(60)]
+    for label, budget, incremental in (("count trigger, full history", 0, False), ("token budget, incremental", 1000, True)):
+        with mock.patch.object(chatbot, "model", SummaryLLM(reply="The 49ers' best season was 1984. " * 12)):
+            chatbot.model.summary_prompts = []
+            chatbot.summary_token_budget, chatbot.incremental_summary = budget, incremental
+            chatbot.memory.storage.clear()
+            for turn in turns:
+                chatbot.chat(turn, thread_id="rolling", mode="inline")
+            prompts = chatbot.model.summary_prompts
+            print(f"{label:<28}: {len(prompts)} summaries, {sum(prompts)} summary prompt tokens "
+                  f"({sum(prompts) / len(turns):.0f} per turn), prompt tokens of summaries 1-5 {prompts[:5]}, last 5 {prompts[-5:]}")
+
+def bench_concurrent_tools():
+
+    """ Turn latency when one AI message asks for several slow tools: prebuilt ToolNode vs tool_executor.tool_node
+
+    Four calls of 0.2-0.5s (sum 1.3s, slowest 0.5s), sync and async graphs. Both run the calls concurrently;
+    tool_node adds a parallelism cap (max_parallel=1 runs them one at a time). Then a fifth call that hangs
+    for 3s, which the prebuilt ToolNode waits out and tool_node cuts off at a 1s timeout.
+    """
+
+    from langchain_core.tools import tool
+    from langgraph.graph import START, StateGraph, MessagesState
+    from langgraph.prebuilt import ToolNode, tools_condition
+    import tool_executor
+
+    @tool
+    def search(query: str) -> str:
+        """Search the web."""
+        time.sleep(0.3)
+        return f"Results for {query}"
+
+    @tool
+    def wikipedia(query: str) -> str:
+        """Look up Wikipedia."""
+        time.sleep(0.5)
+        return f"Article on {query}"
+
+    @tool
+    def wait(seconds: float) -> str:
+        """Pause for N seconds."""
+        time.sleep(seconds)
+        return f"Waited {seconds} seconds"
+
+    @tool
+    def hang(query: str) -> str:
+        """A backend that stopped answering."""
+        time.sleep(3)
+        return "too late"
+
+    calls = [{"name": "search", "args": {"query": "Python language"}, "id": "1"},
+             {"name": "search", "args": {"query": "RAG technique"}, "id": "2"},
+             {"name": "wikipedia", "args": {"query": "FastAPI"}, "id": "3"},
+             {"name": "wait", "args": {"seconds": 0.2}, "id": "4"}]
+
+    def build(tools_node, turn_calls):
+        def assistant(state: MessagesState):
+            if len(state["messages"]) == 1:
+                return {"messages": [AIMessage(content="", tool_calls=turn_calls)]}
+            return {"messages": [AIMessage(content="Done.")]}
+        builder = StateGraph(MessagesState)
+        builder.add_node("assistant", assistant)
+        builder.add_node("tools", tools_node)
+        builder.add_edge(START, "assistant")
+        builder.add_conditional_edges("assistant", tools_condition)
+        builder.add_edge("tools", "assistant")
+        return builder.compile()
+
+    tools = [search, wikipedia, wait, hang]
+    nodes = (("prebuilt ToolNode", lambda: ToolNode(tools)),
+             ("tool_node, max_parallel=1", lambda: tool_executor.tool_node(tools, max_parallel=1)),
+             ("tool_node", lambda: tool_executor.tool_node(tools)),
+             ("tool_node, 2 slots", lambda: tool_executor.tool_node(tools, max_parallel=2)))
+    for label, node in nodes:
+        graph = build(node(), calls)
+        start = time.perf_counter()
+        graph.invoke({"messages": [HumanMessage(content="Search both, look up FastAPI, then wait")]})
+        sync_time = time.perf_counter() - start
+        start = time.perf_counter()
+        asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="Search both, look up FastAPI, then wait")]}))
+        print(f"{label:<26}: sync turn {sync_time:.2f}s, async turn {time.perf_counter() - start:.2f}s")
+
+    hung = calls + [{"name": "hang", "args": {"query": "x"}, "id": "5"}]
+    start = time.perf_counter()
+    build(ToolNode(tools), hung).invoke({"messages": [HumanMessage(content="Search everything")]})
+    print(f"with a hung call, prebuilt ToolNode: turn {time.perf_counter() - start:.2f}s")
+    tool_executor.tool_stats.clear()
+    start = time.perf_counter()
+    result = build(tool_executor.tool_node(tools, timeouts={"hang": 1.0}), hung).invoke({"messages": [HumanMessage(content="Search everything")]})
+    print(f"with a hung call, tool_node 1s timeout: turn {time.perf_counter() - start:.2f}s, {dict(tool_executor.tool_stats)}, "
+          f"hung call answered {result['messages'][-2].content!r}")
+
+def bench_pure_tool_cache():
+
+    """ agent_w_memory.py on repeated arithmetic questions: no cache vs pure tool cache with the tools node short-circuited
+
+    400 questions drawn (Zipf-like) from 60 multiplications, arguments sometimes sent as strings or floats.
+    The fake LLM answers in ~1ms, so the numbers are graph overhead: supersteps, tool dispatch, checkpoints.
+    """
+
+    import agent_w_memory as agent
+    import tool_executor
+    from langchain_core.messages import ToolMessage
+
+    class ArithmeticLLM:
+        def invoke(self, messages):
+            last = messages[-1]
+            if isinstance(last, ToolMessage):
+                return AIMessage(content=f"The answer is {last.content}.")
+            a, b = last.content.split()[1::2]
+            args = {"a": a, "b": b} if rng.random() < 0.5 else {"b": float(b), "a": int(a)}
+            return AIMessage(content="", tool_calls=[{"name": "multiply", "args": args, "id": f"call-{a}-{b}-{random.random()}"}])
+
+    rng = random.Random(0)
+    pairs = [(rng.randint(2, 99), rng.randint(2, 99)) for _ in range(60)]
+    questions = [pairs[min(int(rng.paretovariate(1.2)) - 1, len(pairs) - 1)] for _ in range(400)]
+    with mock.patch.object(agent, "llm_with_tools", ArithmeticLLM()):
+        cache = tool_executor.tool_cache
+        maxsize = cache.maxsize
+        try:
+            for label, cache_size in (("no cache", 0), ("pure tool cache", 1024)):
+                cache.clear()
+                cache.maxsize = cache_size
+                tool_executor.tool_stats.clear()
+                graph = agent.builder.compile(checkpointer=agent.MemorySaver())
+                steps, start = Counter(), time.perf_counter()
+                for i, (a, b) in enumerate(questions):
+                    for chunk in graph.stream({"messages": [HumanMessage(content=f"Multiply {a} and {b}")]},
+                                              {"configurable": {"thread_id": str(i)}}, stream_mode="updates"):
+                        steps.update(chunk.keys())
+                elapsed = time.perf_counter() - start
+                print(f"{label:<16}: {elapsed / len(questions) * 1000:.2f} ms per question, tools node ran {steps['tools']} times, "
+                      f"{dict(tool_executor.tool_stats)}, hit rate {cache.stats()['hit_rate']:.0%}")
+        finally:
+            cache.maxsize = maxsize
+            cache.clear()
+
+@restores("arithmetic", "arithmetic_fast_path")
+def bench_arithmetic_fast_path():
+
+    """ agent.py on a calculator traffic mix with the arithmetic fast path off vs on
+
+    70% one operation in assorted phrasings, 15% several operations, 15% other questions; the fake LLM takes 50ms a call
+    and picks the tool like llama3.1 would (tool call, then the answer).
+    """
+
+    import re
+    import agent
+    import arithmetic
+    import tool_executor
+
+    class CalculatorLLM(FakeLLM):
+        def invoke(self, messages, config=None, **kwargs):
+            super().invoke(messages, config, **kwargs)
+            last = messages[-1]
+            numbers = [int(n) for n in re.findall(r"\d+", last.content)]
+            if isinstance(last, HumanMessage) and len(numbers) >= 2:
+                return AIMessage(content="", tool_calls=[{"name": "multiply", "args": {"a": numbers[0], "b": numbers[1]}, "id": f"call-{random.random()}"}])
+            return AIMessage(content=f"The answer is {last.content}.")
+
+    rng = random.Random(0)
+    simple = ["Multiply {a} by {b}.", "Multiply {a} and {b}", "what is {a} * {b}?", "Please add {a} and {b}",
+              "{a} + {b}", "Divide {a} by {b}", "What's {a} times {b}?", "calculate the sum of {a} and {b}"]
+    other = ["Multiply {a} by {b} and then add 7", "Add {a} and {b}, then divide the result by 3",
+             "What is the square root of {a}?", "Explain what a divisor is", "Is {a} a prime number?"]
+    traffic = []
+    for _ in range(200):
+        a, b = rng.randint(1, 99), rng.randint(1, 99)
+        traffic.append((rng.choice(simple) if rng.random() < 0.7 else rng.choice(other)).format(a=a, b=b))
+
+    with mock.patch.object(agent, "llm_with_tools", CalculatorLLM(latency=0.05)):
+        for label, enabled in (("fast path off", False), ("fast path on", True)):
+            arithmetic.arithmetic_fast_path = enabled
+            arithmetic.fast_path_stats.clear()
+            tool_executor.tool_cache.clear()
+            agent.llm_with_tools.calls.clear()
+            timings = {"served": [], "fallback": []}
+            for request in traffic:
+                start = time.perf_counter()
+                result = agent.graph.invoke({"messages": [HumanMessage(content=request)]})
+                served = result["messages"][-1].name == "fast_path"
+                timings["served" if served else "fallback"].append(time.perf_counter() - start)
+            everything = sorted(timings["served"] + timings["fallback"])
+            p50 = lambda samples: f"{statistics.median(samples) * 1000:.1f} ms" if samples else "-"
+            print(f"{label:<14}: {arithmetic.fast_path_share():.0%} served by the fast path, p50 {p50(everything)} "
+                  f"(fast path {p50(timings['served'])}, LLM {p50(timings['fallback'])}), {agent.llm_with_tools.calls['chat']} LLM calls")
+
+def bench_safe_math():
+
+    """ agent_example's math tool: eval vs the compiled evaluator, scalar loop vs one array evaluation, one step per call vs math_steps
+
+    The multi-step turn is a five step calculation where each step needs the previous result; the fake LLM takes 50ms a call.
+    """
+
+    import agent_example
+    import safe_math
+    import tool_executor
+    from langgraph.graph import START, StateGraph, MessagesState
+    from langgraph.prebuilt import tools_condition
+    from langchain_core.messages import ToolMessage
+
+    rng = random.Random(0)
+    expressions = [f"{rng.randint(1, 999)} * {rng.randint(1, 99)} + sqrt({rng.randint(1, 999)}) / {rng.randint(1, 9)}"
+                   for _ in range(50)]
+    workload = [rng.choice(expressions) for _ in range(20000)]
+    namespace = {"sqrt": safe_math.math.sqrt, "__builtins__": {}}
+    start = time.perf_counter()
+    for expr in workload:
+        eval(expr, namespace)
+    eval_time = time.perf_counter() - start
+    safe_math.compile_expression.cache_clear()
+    start = time.perf_counter()
+    for expr in workload:
+        safe_math.evaluate(expr)
+    safe_time = time.perf_counter() - start
+    print(f"20000 evaluations of 50 expressions: eval {eval_time / len(workload) * 1e6:.1f} us, "
+          f"compiled evaluator {safe_time / len(workload) * 1e6:.1f} us each ({safe_math.compile_expression.cache_info().misses} parses)")
+
+    rejected = [expr for expr in ("__import__('os').system('id')", "().__class__.__bases__", "open('/etc/passwd').read()",
+                                  "9 ** 9 ** 9", "(9 ** 9999) ** 9999", "9 ** 5000 * 9 ** 5000",
+                                  "factorial(10 ** 6)", "[x for x in range(10 ** 9)]")
+                if str(agent_example.math.invoke({"expr": expr})).startswith("Math error")]
+    print(f"{len(rejected)} of 8 hostile expressions rejected")
+
+    values = [rng.uniform(0, 100) for _ in range(10000)]
+    start = time.perf_counter()
+    loop = [safe_math.evaluate("sqrt(x) * 2 + x ** 2 / 3", {"x": value}) for value in values]
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    vector = safe_math.evaluate("sqrt(x) * 2 + x ** 2 / 3", {"x": values})
+    vector_time = time.perf_counter() - start
+    assert all(abs(a - b) < 1e-9 for a, b in zip(loop, vector))
+    print(f"10000 values: scalar loop {loop_time * 1000:.1f} ms, one array evaluation {vector_time * 1000:.2f} ms")
+
+    steps = ["price = 1250 * 3", "discounted = price * 0.85", "taxed = discounted * 1.2", "shipping = 35 + taxed / 100", "taxed + shipping"]
+
+    class StepLLM(FakeLLM):
+        def __init__(self, batched):
+            super().__init__(latency=0.05)
+            self.batched = batched
+        def invoke(self, messages, config=None, **kwargs):
+            super().invoke(messages, config, **kwargs)
+            done = sum(isinstance(m, ToolMessage) for m in messages)
+            if self.batched and not done:
+                return AIMessage(content="", tool_calls=[{"name": "math_steps", "args": {"steps": steps}, "id": "steps"}])
+            if not self.batched and done < len(steps):
+                # Each step is a single expression over the previous result
+                expr = steps[done].split("=")[-1]
+                for previous, message in zip(steps, [m for m in messages if isinstance(m, ToolMessage)]):
+                    expr = expr.replace(previous.split("=")[0].strip(), message.content)
+                return AIMessage(content="", tool_calls=[{"name": "math", "args": {"expr": expr}, "id": f"step-{done}"}])
+            return AIMessage(content=f"The total is {messages[-1].content}.")
+
+    for label, batched in (("one step per math call", False), ("math_steps", True)):
+        llm = StepLLM(batched)
+        def assistant(state: MessagesState):
+            return {"messages": [llm.invoke(state["messages"])]}
+        builder = StateGraph(MessagesState)
+        builder.add_node("assistant", assistant)
+        builder.add_node("tools", tool_executor.tool_node([agent_example.math, agent_example.math_steps]))
+        builder.add_edge(START, "assistant")
+        builder.add_conditional_edges("assistant", tools_condition)
+        builder.add_edge("tools", "assistant")
+        tool_executor.tool_cache.clear()
+        start = time.perf_counter()
+        result = builder.compile().invoke({"messages": [HumanMessage(content="What do 3 laptops at 1250 cost with the discount, tax and shipping?")]})
+        print(f"{label:<24}: {llm.calls['chat']} LLM calls, {sum(isinstance(m, ToolMessage) for m in result['messages'])} tool calls, "
+              f"turn {time.perf_counter() - start:.2f}s, {result['messages'][-1].content}")
+
+def bench_append_state():
+
+    """ agent_example.py over a 150 tool-call conversation: full-history updates (the old state) vs append_messages deltas
+
+    The fake LLM answers instantly and asks for one more math step until it has 150 results, so the numbers are
+    the cost of moving state: time per graph step and size of each streamed update, early vs late in the conversation.
+    """
+
+    from typing import TypedDict
+    import agent_example
+    import tool_executor
+    from langchain_core.messages import ToolMessage
+    from langgraph.graph import StateGraph, END
+
+    steps = 150
+
+    class LoopLLM:
+        def invoke(self, messages):
+            done = sum(isinstance(m, ToolMessage) for m in messages)
+            if done < steps:
+                # ChatOpenAI fills both the parsed tool_calls and the raw OpenAI ones, which router() looks at
+                raw = [{"id": f"step-{done}", "type": "function", "function": {"name": "math", "arguments": json.dumps({"expr": f"{done} * 2 + 1"})}}]
+                return AIMessage(content="", additional_kwargs={"tool_calls": raw},
+                                 tool_calls=[{"name": "math", "args": {"expr": f"{done} * 2 + 1"}, "id": f"step-{done}"}])
+            return AIMessage(content=f"Done after {done} steps.")
+
+    # The old state: a plain list every node returns in full
+    class FullState(TypedDict):
+        messages: list
+
+    def full_agent(state: FullState):
+        return {"messages": state["messages"] + [agent_example.llm.invoke(state["messages"])]}
+
+    tools = tool_executor.tool_node(agent_example.TOOLS)
+    def full_tools(state: FullState):
+        return {"messages": state["messages"] + tools.invoke(state)["messages"]}
+
+    full = StateGraph(FullState)
+    full.add_node("agent", full_agent)
+    full.add_node("tool", full_tools)
+    full.set_entry_point("agent")
+    full.add_conditional_edges("agent", lambda state: agent_example.router(state), {"tool": "tool", "agent": "agent", "end": END})
+    full.add_edge("tool", "agent")
+
+    with mock.patch.object(agent_example, "llm", LoopLLM()):
+        for label, app in (("full-history updates", full.compile()), ("append_messages deltas", agent_example.app)):
+            tool_executor.tool_cache.clear()
+            times, sizes, printing = [], [], 0.0
+            start = time.perf_counter()
+            for update in app.stream({"messages": [HumanMessage(content="Keep computing")]}, {"recursion_limit": 1000}):
+                times.append(time.perf_counter() - start)
+                # What printing the update (as run_agent did) or sending it to a client costs
+                start = time.perf_counter()
+                sizes.append(len(repr(update)))
+                printing += time.perf_counter() - start
+                start = time.perf_counter()
+            early, late = slice(0, 20), slice(-20, None)
+            print(f"{label:<22}: {len(times)} steps, ms per step {statistics.mean(times[early]) * 1000:.2f} (first 20) "
+                  f"-> {statistics.mean(times[late]) * 1000:.2f} (last 20), update size {statistics.mean(sizes[early]) / 1024:.1f} KB "
+                  f"-> {statistics.mean(sizes[late]) / 1024:.1f} KB, {sum(sizes) / 1024 / 1024:.1f} MB streamed, "
+                  f"{printing:.2f}s rendering updates")
+
+BENCHMARKS = {
+    "query_planning": bench_query_planning,
+    "retrieval_cache": bench_retrieval_cache,
+    "context_packing": bench_context_packing,
+    "tree_reduce": bench_tree_reduce,
+    "reduce_prefill": bench_reduce_prefill,
+    "novelty_stopping": bench_novelty_stopping,
+    "wikipedia_passages": bench_wikipedia_passages,
+    "wikipedia_snapshot": bench_wikipedia_snapshot,
+    "document_store": bench_document_store,
+    "approval_jobs": bench_approval_jobs,
+    "checkpoint_resume": bench_checkpoint_resume,
+    "joke_batching": bench_joke_batching,
+    "joke_selection": bench_joke_selection,
+    "structured_repair": bench_structured_repair,
+    "answer_deadline": bench_answer_deadline,
+    "context_rendering": bench_context_rendering,
+    "background_summary": bench_background_summary,
+    "rolling_summary": bench_rolling_summary,
+    "concurrent_tools": bench_concurrent_tools,
+    "pure_tool_cache": bench_pure_tool_cache,
+    "arithmetic_fast_path": bench_arithmetic_fast_path,
+    "safe_math": bench_safe_math,
+    "append_state": bench_append_state,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"### {name}")
+        BENCHMARKS[name]()
+        print()
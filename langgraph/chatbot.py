@@ -1,15 +1,35 @@
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 from langchain_core.messages import HumanMessage, SystemMessage, RemoveMessage
 from langgraph.graph import MessagesState
 from langgraph.graph import StateGraph, START, END
+from langgraph.checkpoint.memory import MemorySaver
+
+from context_packing import count_tokens
 
 # We will use this model for both the conversation and the summarization
 from langchain_openai import ChatOpenAI
 model = ChatOpenAI(model="llama3.1", openai_api_base="http://localhost:11434/v1", api_key="ollama", temperature=0)
 
+# Summarize once the messages in state exceed this many tokens (0: once there are more than 6 messages)
+summary_token_budget = int(os.environ.get("SUMMARY_TOKEN_BUDGET", 1000))
+
+# Summarize only the messages added since the last summary, into a summary of bounded length
+incremental_summary = os.environ.get("SUMMARY_INCREMENTAL", "1") == "1"
+summary_max_words = int(os.environ.get("SUMMARY_MAX_WORDS", 200))
+
 # State class to store messages and summary
 class State(MessagesState):
     summary: str
+    # Id of the last message the summary covers
+    summarized_through: str
+    # Token count per id of the messages in state, so each message is tokenized once
+    token_counts: dict
     
 # Define the logic to call the model
 def call_model(state: State):
@@ -30,7 +50,20 @@ def call_model(state: State):
         messages = state["messages"]
     
     response = model.invoke(messages)
-    return {"messages": response}
+    # Give the reply its id now so its token count can be keyed on it
+    response.id = response.id or str(uuid.uuid4())
+    return {"messages": response, "token_counts": counted(state["messages"] + [response], state.get("token_counts", {}))}
+
+def message_tokens(message, counts: dict) -> int:
+    if message.id in counts:
+        return counts[message.id]
+    return count_tokens(str(message.content))
+
+def counted(messages, counts: dict) -> dict:
+
+    """ Token counts of exactly these messages, only the ones not in counts are tokenized """
+
+    return {m.id: message_tokens(m, counts) for m in messages}
 
 # Determine whether to end or summarize the conversation
 def should_continue(state: State) -> Literal["summarize_conversation", "__end__"]:
@@ -39,14 +72,21 @@ def should_continue(state: State) -> Literal["summarize_conversation", "__end__"
     
     messages = state["messages"]
     
-    # If there are more than six messages, then we summarize the conversation
-    if len(messages) > 6:
+    # If the messages exceed the token budget (more than six messages without a budget), then we summarize the conversation
+    if summary_token_budget:
+        counts = state.get("token_counts", {})
+        if sum(message_tokens(m, counts) for m in messages) > summary_token_budget:
+            return "summarize_conversation"
+    elif len(messages) > 6:
         return "summarize_conversation"
     
     # Otherwise we can just end
     return END
 
 def summarize_conversation(state: State):
+
+    if incremental_summary:
+        return summarize_new_messages(state)
     
     # First get the summary if it exists
     summary = state.get("summary", "")
@@ -70,7 +110,35 @@ def summarize_conversation(state: State):
     
     # Delete all but the 2 most recent messages and add our summary to the state 
     delete_messages = [RemoveMessage(id=m.id) for m in state["messages"][:-2]]
-    return {"summary": response.content, "messages": delete_messages}
+    return {"summary": response.content, "messages": delete_messages,
+            "token_counts": counted(state["messages"][-2:], state.get("token_counts", {}))}
+
+def summarize_new_messages(state: State):
+
+    """ Fold the messages added since the last summary into it, so the prompt does not grow with the history """
+
+    # Get state
+    summary = state.get("summary", "")
+    messages = state["messages"]
+
+    # Messages after the last one the summary covers (the kept recent ones are already in it)
+    ids = [m.id for m in messages]
+    start = ids.index(state["summarized_through"]) + 1 if state.get("summarized_through") in ids else 0
+    new_messages = messages[start:]
+
+    if summary:
+        summary_message = (
+            f"This is summary of the conversation to date: {summary}\n\n"
+            f"Extend the summary by taking into account the new messages above, in at most {summary_max_words} words:"
+        )
+    else:
+        summary_message = f"Create a summary of the conversation above, in at most {summary_max_words} words:"
+    response = model.invoke(new_messages + [HumanMessage(content=summary_message)])
+
+    # Delete all but the 2 most recent messages, they stay for context but are marked as summarized
+    delete_messages = [RemoveMessage(id=m.id) for m in messages[:-2]]
+    return {"summary": response.content, "summarized_through": messages[-1].id, "messages": delete_messages,
+            "token_counts": counted(messages[-2:], state.get("token_counts", {}))}
 
 # Define a new graph
 workflow = StateGraph(State)
@@ -83,4 +151,117 @@ workflow.add_conditional_edges("conversation", should_continue)
 workflow.add_edge("summarize_conversation", END)
 
 # Compile
-graph = workflow.compile()
\ No newline at end of file
+graph = workflow.compile()
+
+### Summarizing in the background
+
+# "inline": the turn waits for the summary (the graph above), "background": the reply returns
+# first and the summary is written to the thread before its next turn
+summary_mode = os.environ.get("SUMMARY_MODE", "background")
+
+# Same nodes, but the turn ends with the reply. summarize_conversation stays in the graph so the
+# background summary is checkpointed as that node's update on the thread
+reply_workflow = StateGraph(State)
+reply_workflow.add_node("conversation", call_model)
+reply_workflow.add_node(summarize_conversation)
+reply_workflow.add_edge(START, "conversation")
+reply_workflow.add_edge("conversation", END)
+reply_workflow.add_edge("summarize_conversation", END)
+
+memory = MemorySaver()
+graphs = {"inline": workflow.compile(checkpointer=memory),
+          "background": reply_workflow.compile(checkpointer=memory)}
+
+summary_pool = ThreadPoolExecutor(max_workers=4)
+pending_summaries = {} # thread_id -> future of its background summary
+summary_stats = defaultdict(int)
+
+# Seconds per kind: "turn:<mode>" (what the user waits for), "summary" (background work), "summary_wait".
+# Both are updated from summary_pool threads, under _lock
+latencies = defaultdict(list)
+_lock = threading.Lock()
+
+def record_latency(kind, seconds):
+    with _lock:
+        latencies[kind].append(seconds)
+
+def count_summary(outcome):
+    with _lock:
+        summary_stats[outcome] += 1
+
+def summarize_in_background(graph, config, values):
+
+    """ Summarize the thread as it was after the turn and merge the result into its state """
+
+    start = time.perf_counter()
+    try:
+        update = summarize_conversation(values)
+        # Removals are by message id, so only the messages this summary covers are deleted
+        graph.update_state(config, update, as_node="summarize_conversation")
+        count_summary("summarized")
+    except Exception as e:
+        # The history stays as it was and the next turn tries again
+        count_summary("failed")
+        print(f"Background summary of thread {config['configurable']['thread_id']} failed: {e}")
+    record_latency("summary", time.perf_counter() - start)
+
+def wait_for_summary(thread_id):
+
+    """ Block until the thread's background summary (if any) is in its state """
+
+    future = pending_summaries.pop(thread_id, None)
+    if future is None:
+        return
+    if not future.done():
+        count_summary("waited")
+    start = time.perf_counter()
+    future.result()
+    record_latency("summary_wait", time.perf_counter() - start)
+
+def chat(message: str, thread_id: str = "1", mode: str = None) -> str:
+
+    """ One turn of the conversation on a thread, returns the reply """
+
+    mode = mode or summary_mode
+    graph = graphs[mode]
+    config = {"configurable": {"thread_id": thread_id}}
+
+    # The previous turn's summary must be merged before this turn reads the state
+    start = time.perf_counter()
+    wait_for_summary(thread_id)
+    state = graph.invoke({"messages": [HumanMessage(content=message)]}, config)
+    record_latency(f"turn:{mode}", time.perf_counter() - start)
+
+    # Summarize after the reply is returned, off the user's critical path
+    if mode == "background" and should_continue(state) == "summarize_conversation":
+        pending_summaries[thread_id] = summary_pool.submit(summarize_in_background, graph, config, state)
+    return state["messages"][-1].content
+
+def latency_histogram(samples, buckets=(0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30), width: int = 40) -> str:
+
+    """ Text histogram of latencies (seconds) over fixed bucket bounds, with p50 / p95 """
+
+    if not samples:
+        return "(no samples)"
+    counts = [0] * (len(buckets) + 1)
+    for seconds in samples:
+        counts[next((i for i, bound in enumerate(buckets) if seconds <= bound), len(buckets))] += 1
+    ordered = sorted(samples)
+    lines = [f"n={len(ordered)} p50={ordered[len(ordered) // 2]:.3f}s p95={ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]:.3f}s"]
+    top = max(counts)
+    for i, count in enumerate(counts):
+        if not count:
+            continue
+        label = f"<= {buckets[i]}s" if i < len(buckets) else f"> {buckets[-1]}s"
+        lines.append(f"  {label:>9} {'#' * max(1, round(count * width / top)):<{width}} {count}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    for i, message in enumerate(["hi! I'm Lance", "what's my name?", "i like the 49ers!",
+                                 "who is their quarterback?", "what was his best season?",
+                                 "and the team's best season?", "thanks, what did we talk about?"]):
+        print(f"> {message}\n{chat(message)}\n")
+    wait_for_summary("1")
+    for kind in sorted(latencies):
+        print(f"{kind}: {latency_histogram(latencies[kind])}")
+    print(dict(summary_stats))
\ No newline at end of file
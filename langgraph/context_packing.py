@@ -0,0 +1,137 @@
+""" Token-budgeted context packing
+
+The interview context grows every turn (operator.add) and holds whole
+Wikipedia pages, so pasting it into each prompt makes Ollama prefill time
+dominate. pack_context instead:
+
+1. parses the <Document ...> blocks out of the context and drops duplicates
+   fetched on earlier turns,
+2. splits each document into passages of roughly passage_tokens,
+3. ranks passages against the current question with BM25,
+4. keeps the best passages that fit in the token budget, regrouped under
+   their original <Document> header so citations still work.
+
+Token counts are estimated at ~4 characters per token, which is close
+enough for llama3.1 to size prompts without loading a tokenizer.
+"""
+
+import hashlib
+import re
+from collections import Counter
+
+from passage_index import PassageIndex, split_passages
+
+DOCUMENT_PATTERN = re.compile(r"<Document ([^>]*?)/?>\n(.*?)\n</Document>", re.DOTALL)
+
+# Running totals across calls, see packing_stats()
+totals = Counter()
+
+def count_tokens(text: str) -> int:
+
+    """ Approximate token count (~4 characters per token) """
+
+    return (len(text) + 3) // 4
+
+def parse_documents(context):
+
+    """ Split context entries into unique (header, text) documents, first occurrence wins """
+
+    documents, seen = [], set()
+    for entry in context:
+        for header, text in DOCUMENT_PATTERN.findall(entry):
+            key = hashlib.sha1(f"{header}\n{text.strip()}".encode()).hexdigest()
+            if key not in seen:
+                seen.add(key)
+                documents.append((header, text.strip()))
+    return documents
+
+def bm25_scores(query: str, passages):
+
+    """ BM25 score of every passage for the query """
+
+    index = PassageIndex()
+    for passage in passages:
+        index.add_passage(passage)
+    return index.scores(query)
+
+def render_documents(documents):
+
+    """ (header, text) pairs -> <Document> blocks """
+
+    return "\n\n---\n\n".join(f"<Document {header}/>\n{text}\n</Document>" for header, text in documents)
+
+HEADER_ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+
+def source_label(header: str) -> str:
+
+    """ Citation label of a <Document> header: its href / source, plus the page when there is one """
+
+    attributes = dict(HEADER_ATTRIBUTE.findall(header))
+    label = attributes.get("href") or attributes.get("source") or header.strip()
+    if attributes.get("page"):
+        label += f", page {attributes['page']}"
+    return label
+
+def render_context(context) -> str:
+
+    """ Compact numbered rendering of context entries for a prompt
+
+    Documents are deduplicated and numbered in order of appearance as "[n] source" followed by the
+    text with runs of blank lines and spaces collapsed, so citations can use [n] directly. Formatting
+    the context list itself into a prompt sends its Python repr instead: every newline and quote
+    escaped, plus the <Document> tags and separators.
+    """
+
+    if isinstance(context, str):
+        context = [context]
+    blocks = []
+    for n, (header, text) in enumerate(parse_documents(context), start=1):
+        text = re.sub(r"[ \t]+", " ", re.sub(r"\n\s*\n+", "\n", text)).strip()
+        blocks.append(f"[{n}] {source_label(header)}\n{text}")
+    return "\n\n".join(blocks)
+
+def pack_context(context, query: str, token_budget: int = 2000, passage_tokens: int = 120):
+
+    """ Render the passages most relevant to query within token_budget
+
+    Returns the packed context string and the stats of this call (tokens of the raw
+    context as it used to be formatted, tokens sent, tokens saved, passages kept).
+    """
+
+    documents = parse_documents(context)
+
+    # Every passage, remembering which document it came from
+    passages = [(i, passage) for i, (_, text) in enumerate(documents) for passage in split_passages(text, passage_tokens)]
+    scores = bm25_scores(query, [p for _, p in passages])
+
+    # Greedily take the best passages that fit the budget
+    kept, used = set(), 0
+    for j in sorted(range(len(passages)), key=lambda j: -scores[j]):
+        header_cost = 0 if any(passages[k][0] == passages[j][0] for k in kept) else count_tokens(documents[passages[j][0]][0]) + 8
+        cost = count_tokens(passages[j][1]) + header_cost
+        if used + cost > token_budget:
+            continue
+        kept.add(j)
+        used += cost
+
+    # Regroup kept passages per document, in their original order
+    packed = []
+    for i, (header, _) in enumerate(documents):
+        chunks = [passages[j][1] for j in sorted(kept) if passages[j][0] == i]
+        if chunks:
+            packed.append((header, "\n\n".join(chunks)))
+    text = render_documents(packed)
+
+    raw_tokens = count_tokens(str(context))
+    sent_tokens = count_tokens(text)
+    stats = {"documents": len(documents), "passages": len(passages), "passages_kept": len(kept),
+             "raw_tokens": raw_tokens, "packed_tokens": sent_tokens, "tokens_saved": max(raw_tokens - sent_tokens, 0)}
+    totals.update({"calls": 1, "raw_tokens": raw_tokens, "packed_tokens": sent_tokens, "tokens_saved": stats["tokens_saved"]})
+    return text, stats
+
+def packing_stats():
+
+    """ Totals across every pack_context call in this process """
+
+    calls = totals["calls"]
+    return {**totals, "tokens_saved_per_call": totals["tokens_saved"] / calls if calls else 0.0}
@@ -0,0 +1,129 @@
+""" Content-addressed document store
+
+Retrieved documents are stored once under the hash of their text and graph
+state carries only the IDs, so the same Wikipedia page fetched by three
+analysts is held once in memory instead of being copied into every
+interview state, checkpoint and stream event. Nodes resolve IDs back to
+text when they build prompts.
+
+References are held by an owner (an interview): put(text, owner) takes
+the owner's reference on the document once, however often the owner stores
+it again (a turn re-run after a resume, the same page found twice), and
+release(owner) drops every reference the owner holds. Documents nobody
+references are kept (so a page fetched again soon is free) until their
+total size exceeds max_unreferenced_bytes, then evicted oldest first.
+
+With durable checkpoints the IDs in a checkpoint must still resolve in the
+process that resumes it: persist(path) writes every document through to a
+SQLite table, which get falls back to when a document is not in memory.
+Evicting a document deletes its row too.
+"""
+
+import hashlib
+import sqlite3
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+class DocumentStore:
+
+    """ hash -> text with reference counts and LRU eviction of unreferenced documents """
+
+    def __init__(self, max_unreferenced_bytes: int = 64 * 1024 * 1024):
+        self.max_unreferenced_bytes = max_unreferenced_bytes
+        self._texts = {}
+        self._holders = defaultdict(set) # doc_id -> owners referencing it
+        self._owned = defaultdict(set) # owner -> doc_ids it references
+        self._unreferenced = OrderedDict() # doc_id -> size, oldest first
+        self._unreferenced_bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self.counters = Counter()
+
+    def persist(self, path: str):
+
+        """ Write documents through to a SQLite file (e.g. next to the checkpoint database) and read misses back from it """
+
+        with self._lock:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, text TEXT)")
+            self._db.executemany("INSERT OR IGNORE INTO documents VALUES (?, ?)", self._texts.items())
+            self._db.commit()
+
+    @staticmethod
+    def doc_id(text: str) -> str:
+        return "doc:" + hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+    def put(self, text: str, owner: str) -> str:
+
+        """ Store the text (once) and take the owner's reference on it, returns its ID """
+
+        doc_id = self.doc_id(text)
+        with self._lock:
+            if doc_id in self._texts:
+                self.counters["deduplicated"] += 1
+            else:
+                self._texts[doc_id] = text
+                self.counters["stored"] += 1
+                if self._db is not None:
+                    self._db.execute("INSERT OR IGNORE INTO documents VALUES (?, ?)", (doc_id, text))
+                    self._db.commit()
+            if doc_id in self._unreferenced:
+                self._unreferenced_bytes -= self._unreferenced.pop(doc_id)
+            self._holders[doc_id].add(owner)
+            self._owned[owner].add(doc_id)
+        return doc_id
+
+    def put_many(self, texts, owner: str):
+        return [self.put(text, owner) for text in texts]
+
+    def get(self, doc_id: str) -> str:
+        if doc_id in self._texts:
+            return self._texts[doc_id]
+        if self._db is not None:
+            with self._lock:
+                row = self._db.execute("SELECT text FROM documents WHERE id = ?", (doc_id,)).fetchone()
+            if row is not None:
+                self.counters["loaded"] += 1
+                return row[0]
+        raise KeyError(f"Document {doc_id} is not in the store (evicted, or stored by another process)")
+
+    def resolve(self, doc_ids):
+
+        """ Texts of the IDs, in order """
+
+        return [self.get(doc_id) for doc_id in doc_ids]
+
+    def release(self, owner: str):
+
+        """ Drop every reference the owner holds, then evict unreferenced documents over the size bound """
+
+        with self._lock:
+            for doc_id in self._owned.pop(owner, ()):
+                self._holders[doc_id].discard(owner)
+                if not self._holders[doc_id]:
+                    del self._holders[doc_id]
+                    size = len(self._texts[doc_id])
+                    self._unreferenced[doc_id] = size
+                    self._unreferenced_bytes += size
+            evicted = []
+            while self._unreferenced_bytes > self.max_unreferenced_bytes:
+                doc_id, size = self._unreferenced.popitem(last=False)
+                del self._texts[doc_id]
+                self._unreferenced_bytes -= size
+                evicted.append(doc_id)
+            if evicted:
+                self.counters["evicted"] += len(evicted)
+            if evicted and self._db is not None:
+                self._db.executemany("DELETE FROM documents WHERE id = ?", [(doc_id,) for doc_id in evicted])
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters,
+                    "documents": len(self._texts),
+                    "bytes": sum(len(text) for text in self._texts.values()),
+                    "referenced": len(self._holders)}
+
+# Shared by every interview of the process
+document_store = DocumentStore()
@@ -1,4 +1,6 @@
 import operator
+import os
+import time
 from typing import Annotated
 from typing_extensions import TypedDict
 
@@ -9,9 +11,14 @@ from langchain_openai import ChatOpenAI
 from langgraph.types import Send
 from langgraph.graph import END, StateGraph, START
 
+from structured_output import repair_stats, structured
+
 # Prompts we will use
 subjects_prompt = """Generate a list of 3 sub-topics that are all related to this overall topic: {topic}."""
 joke_prompt = """Generate a joke about {subject}"""
+jokes_prompt = """Generate one joke about each of the following subjects. Return every joke with its subject, copied exactly as written below:
+
+{subjects}"""
 best_joke_prompt = """Below are a bunch of jokes about {topic}. Select the best one! Return the ID of the best one, starting 0 as the ID for the first joke. Jokes: \n\n  {jokes}"""
 
 # LLM
@@ -32,7 +39,7 @@ class OverallState(TypedDict):
 
 def generate_topics(state: OverallState):
     prompt = subjects_prompt.format(topic=state["topic"])
-    response = model.with_structured_output(Subjects).invoke(prompt)
+    response = structured(model, Subjects).invoke(prompt)
     return {"subjects": response.subjects}
 
 class JokeState(TypedDict):
@@ -43,30 +50,117 @@ class Joke(BaseModel):
 
 def generate_joke(state: JokeState):
     prompt = joke_prompt.format(subject=state["subject"])
-    response = model.with_structured_output(Joke).invoke(prompt)
+    response = structured(model, Joke).invoke(prompt)
     return {"jokes": [response.joke]}
 
+# Selection: "flat" asks for the best of all jokes in one prompt, "tournament" picks a winner in groups of
+# tournament_group_size concurrently and advances the winners until one group is left (log depth, small prompts)
+best_joke_mode = os.environ.get("BEST_JOKE_MODE", "tournament")
+# At least 2, a group of one never narrows the field
+tournament_group_size = max(2, int(os.environ.get("JOKE_TOURNAMENT_GROUP_SIZE", "8")))
+
+def clamp_id(size):
+    # Repair an ID outside the group (often 1-based) to the nearest joke instead of asking again
+    def fixup(data):
+        if isinstance(data.get("id"), int):
+            data["id"] = min(max(data["id"], 0), size - 1)
+        return data
+    return fixup
+
+def pick_best(topic, groups):
+    # Groups of one advance without a call
+    contests = [group for group in groups if len(group) > 1]
+    prompts = [best_joke_prompt.format(topic=topic, jokes="\n\n".join(group)) for group in contests]
+    responses = iter(structured(model, BestJoke).batch(prompts, config={"max_concurrency": joke_max_concurrency},
+                                                       fixups=[clamp_id(len(group)) for group in contests]))
+    return [group[next(responses).id] if len(group) > 1 else group[0] for group in groups]
+
 def best_joke(state: OverallState):
-    jokes = "\n\n".join(state["jokes"])
-    prompt = best_joke_prompt.format(topic=state["topic"], jokes=jokes)
-    response = model.with_structured_output(BestJoke).invoke(prompt)
-    return {"best_selected_joke": state["jokes"][response.id]}
+    jokes = state["jokes"]
+    if not jokes:
+        return {"best_selected_joke": ""}
+    if best_joke_mode == "tournament":
+        while len(jokes) > tournament_group_size:
+            num_groups = -(-len(jokes) // tournament_group_size)
+            jokes = pick_best(state["topic"], [jokes[i::num_groups] for i in range(num_groups)])
+    return {"best_selected_joke": pick_best(state["topic"], [jokes])[0]}
+
+class SubjectJoke(BaseModel):
+    subject: str
+    joke: str
+
+class Jokes(BaseModel):
+    jokes: list[SubjectJoke]
+
+# Map step: "send" makes one generate_joke call per subject via Send(), the other modes write every joke in
+# generate_jokes. "single" asks for all jokes in one structured call (one round trip, one prefill of the
+# instructions); "batch" splits the subjects into groups of at most joke_group_size, spread over at least
+# joke_max_concurrency calls, and runs them through model.batch, joke_max_concurrency at a time.
+# "auto" (default) makes the single call for up to joke_single_call_size subjects and batches longer lists
+joke_mode = os.environ.get("JOKE_MODE", "auto")
+joke_single_call_size = int(os.environ.get("JOKE_SINGLE_CALL_SIZE", "4"))
+joke_group_size = int(os.environ.get("JOKE_GROUP_SIZE", "8"))
+joke_max_concurrency = int(os.environ.get("JOKE_MAX_CONCURRENCY", "4"))
+
+def split_subjects(subjects, num_groups):
+    # Consecutive groups whose sizes differ by at most one, so the jokes come back in subject order
+    bounds = [len(subjects) * i // num_groups for i in range(num_groups + 1)]
+    return [subjects[bounds[i]:bounds[i + 1]] for i in range(num_groups)]
+
+def subject_key(subject):
+    return " ".join(subject.lower().split()).strip(" .-*")
+
+def generate_jokes(state: OverallState):
+    subjects = state["subjects"]
+    if not subjects:
+        return {"jokes": []}
+    if joke_mode == "single" or (joke_mode == "auto" and len(subjects) <= joke_single_call_size):
+        num_groups = 1
+    else:
+        # Enough groups to keep every slot busy and none larger than joke_group_size
+        num_groups = min(len(subjects), max(-(-len(subjects) // max(joke_group_size, 1)), joke_max_concurrency))
+    groups = split_subjects(subjects, num_groups)
+    prompts = [jokes_prompt.format(subjects="\n".join(f"- {s}" for s in group)) for group in groups]
+    if len(prompts) == 1:
+        responses = [structured(model, Jokes).invoke(prompts[0])]
+    else:
+        responses = structured(model, Jokes).batch(prompts, config={"max_concurrency": joke_max_concurrency})
+
+    # Jokes are matched to their subjects by name, not by position in the answer
+    written = {}
+    for response in responses:
+        for item in response.jokes:
+            written.setdefault(subject_key(item.subject), item.joke)
+    jokes = []
+    for subject in subjects:
+        joke = written.get(subject_key(subject))
+        # A subject the answer left out gets its joke on its own
+        jokes.extend([joke] if joke is not None else generate_joke({"subject": subject})["jokes"])
+    return {"jokes": jokes}
 
 def continue_to_jokes(state: OverallState):
-    return [Send("generate_joke", {"subject": s}) for s in state["subjects"]]
+    if joke_mode == "send":
+        return [Send("generate_joke", {"subject": s}) for s in state["subjects"]]
+    return "generate_jokes"
 
 # Construct the graph: here we put everything together to construct our graph
 graph_builder = StateGraph(OverallState)
 graph_builder.add_node("generate_topics", generate_topics)
 graph_builder.add_node("generate_joke", generate_joke)
+graph_builder.add_node("generate_jokes", generate_jokes)
 graph_builder.add_node("best_joke", best_joke)
 graph_builder.add_edge(START, "generate_topics")
-graph_builder.add_conditional_edges("generate_topics", continue_to_jokes, ["generate_joke"])
+graph_builder.add_conditional_edges("generate_topics", continue_to_jokes, ["generate_joke", "generate_jokes"])
 graph_builder.add_edge("generate_joke", "best_joke")
+graph_builder.add_edge("generate_jokes", "best_joke")
 graph_builder.add_edge("best_joke", END)
 
 # Compile the graph
 graph = graph_builder.compile()
 
-result=graph.invoke({"topic": "jokes about computers"})
-print(result['best_selected_joke'])
+if __name__ == "__main__":
+    start = time.perf_counter()
+    result=graph.invoke({"topic": "jokes about computers"})
+    print(result['best_selected_joke'])
+    print(f"{len(result['jokes'])} jokes in {time.perf_counter() - start:.2f}s ({joke_mode} mode)")
+    print("structured output:", repair_stats())
@@ -0,0 +1,34 @@
+""" Novelty of newly retrieved context
+
+Scores how much of a turn's retrieval is actually new, as the share of its
+word shingles that do not already appear in the earlier context. Interviews
+use it to stop once another question / search / answer round would mostly
+re-read documents they already have.
+"""
+
+from context_packing import parse_documents
+from passage_index import tokenize
+
+def shingles(text: str, size: int = 5):
+
+    """ Set of overlapping size-word windows of the text """
+
+    words = tokenize(text)
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def context_shingles(context, size: int = 5):
+    return set().union(*[shingles(text, size) for _, text in parse_documents(context)])
+
+def novelty(new_context, old_context, size: int = 5):
+
+    """ Share of shingles in new_context absent from old_context: 1.0 all new, 0.0 nothing new
+
+    None when new_context has no text: a failed or empty search says nothing about novelty.
+    """
+
+    new = context_shingles(new_context, size)
+    if not new:
+        return None
+    return len(new - context_shingles(old_context, size)) / len(new)
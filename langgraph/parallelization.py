@@ -1,3 +1,9 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 from langchain_openai import ChatOpenAI
 from typing_extensions import TypedDict
 from typing import Annotated, operator
@@ -16,13 +22,26 @@ from langchain_community.document_loaders import WikipediaLoader
 from langchain_community.tools import TavilySearchResults
 # from :class:`~langchain_tavily import TavilySearch`
 
+from context_packing import render_context
+from passage_index import PassageIndex, group_by_source
+from retrieval_cache import dump_documents, load_documents, shared_cache
+from wiki_snapshot import WikipediaSnapshotLoader
+
+# Local Wikipedia snapshot (built with wiki_snapshot.py) queried instead of the Wikipedia API when set
+wikipedia_snapshot = os.environ.get("WIKIPEDIA_SNAPSHOT")
+
+# Wikipedia pages are chunked and only the top passages for the question are returned (as in research_assistant.py),
+# 0 returns whole pages
+wikipedia_top_k = int(os.environ.get("RESEARCH_WIKIPEDIA_PASSAGES", "4"))
+
 def search_web(state):
     
     """ Retrieve docs from web search """
 
     # Search
     tavily_search = TavilySearchResults(max_results=3)
-    search_docs = tavily_search.invoke(state['question'])
+    query = state['question']
+    search_docs = shared_cache.fetch("tavily", query, lambda: tavily_search.invoke(query), max_results=3)
      # Format
     formatted_search_docs = "\n\n---\n\n".join(
         [
@@ -38,8 +57,21 @@ def search_wikipedia(state):
     """ Retrieve docs from wikipedia """
 
     # Search
-    search_docs = WikipediaLoader(query=state['question'], 
-                                  load_max_docs=2).load()
+    query = state['question']
+    if wikipedia_snapshot:
+        pages = WikipediaSnapshotLoader(query=query, load_max_docs=2, path=wikipedia_snapshot).load()
+    else:
+        pages = load_documents(shared_cache.fetch(
+            "wikipedia", query,
+            lambda: dump_documents(WikipediaLoader(query=query, load_max_docs=2).load()),
+            load_max_docs=2))
+
+    # Keep only the passages relevant to the question instead of whole articles
+    search_docs = pages
+    if wikipedia_top_k:
+        index = PassageIndex(passage_tokens=120)
+        index.add_documents(pages)
+        search_docs = group_by_source(index.search(query, k=wikipedia_top_k))
 
      # Format
     formatted_search_docs = "\n\n---\n\n".join(
@@ -51,12 +83,144 @@ def search_wikipedia(state):
 
     return {"context": [formatted_search_docs]} 
 
+# Deadline mode: generate_answer fires once this many seconds have passed with whatever context has arrived,
+# instead of waiting for the slowest backend. 0 waits for every backend as before
+answer_deadline = float(os.environ.get("ANSWER_DEADLINE_SECONDS", "0"))
+
+# Hedged requests: re-issue a backend query that is still running after that backend's p95 latency,
+# the first of the attempts to succeed wins
+hedge_requests = bool(os.environ.get("RETRIEVAL_HEDGE"))
+hedge_min_samples = 20
+
+# No hedge is issued while this many attempts of the backend are still running, so a stalled backend
+# cannot fill the pool with abandoned attempts
+hedge_max_in_flight = 4
+
+backends = {"web": search_web, "wikipedia": search_wikipedia}
+retrieval_stats = Counter()
+
+# Requests outliving the deadline finish in the background (their result still lands in the retrieval cache),
+# so the pool is never waited on by a node
+request_pool = ThreadPoolExecutor(max_workers=32)
+
+class LatencyTracker:
+
+    """ Recent latencies per backend """
+
+    def __init__(self, window: int = 200):
+        self.samples = {}
+        self.window = window
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, name, q):
+        with self._lock:
+            samples = sorted(self.samples.get(name, ()))
+        if len(samples) < hedge_min_samples:
+            return None
+        return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+latencies = LatencyTracker()
+
+# Attempts per backend submitted and not finished yet
+in_flight = Counter()
+_in_flight_lock = threading.Lock()
+
+def timed_request(name, state):
+    start = time.monotonic()
+    result = backends[name](state)
+    latencies.record(name, time.monotonic() - start)
+    return result
+
+def submit_request(name, state):
+
+    """ Start an attempt on the request pool, counted in flight until it finishes """
+
+    with _in_flight_lock:
+        in_flight[name] += 1
+
+    def finished(future):
+        with _in_flight_lock:
+            in_flight[name] -= 1
+    future = request_pool.submit(timed_request, name, state)
+    future.add_done_callback(finished)
+    return future
+
+def retrieve(state):
+
+    """ Query every backend concurrently, return the context that arrived before the deadline
+
+    A backend still running past its p95 is re-issued once (RETRIEVAL_HEDGE), its first successful attempt
+    wins, and it only counts as failed once every attempt failed.
+    """
+
+    start = time.monotonic()
+    deadline = start + answer_deadline if answer_deadline else None
+    attempts = {name: [submit_request(name, state)] for name in backends}
+    hedge_at = {}
+    if hedge_requests:
+        for name in backends:
+            p95 = latencies.percentile(name, 0.95)
+            if p95 is not None:
+                hedge_at[name] = start + p95
+    results = {}
+
+    def pending():
+        return [name for name in backends if name not in results and not all(f.done() for f in attempts[name])]
+
+    while True:
+        for name in backends:
+            if name not in results:
+                succeeded = [f for f in attempts[name] if f.done() and f.exception() is None]
+                if succeeded:
+                    results[name] = succeeded[0].result()
+                    if succeeded[0] is not attempts[name][0]:
+                        retrieval_stats[f"{name}_hedge_won"] += 1
+        now = time.monotonic()
+        waiting = pending()
+        if not waiting or (deadline is not None and now >= deadline):
+            break
+        for name in waiting:
+            if name in hedge_at and now >= hedge_at[name]:
+                del hedge_at[name]
+                with _in_flight_lock:
+                    busy = in_flight[name] >= hedge_max_in_flight
+                if not busy:
+                    retrieval_stats[f"{name}_hedged"] += 1
+                    attempts[name].append(submit_request(name, state))
+        wake = [t for t in [deadline, *[hedge_at.get(name) for name in waiting]] if t is not None]
+        wait([f for name in waiting for f in attempts[name] if not f.done()],
+             timeout=max(0.0, min(wake) - now) if wake else None, return_when=FIRST_COMPLETED)
+
+    # Attempts not started yet are dropped, running ones finish in the background
+    for futures in attempts.values():
+        for future in futures:
+            future.cancel()
+
+    context = []
+    retrieval_stats["answers"] += 1
+    for name in backends:
+        if name in results:
+            context.extend(results[name]["context"])
+        else:
+            # Late or failed backend, answer without it
+            retrieval_stats[f"{name}_missed"] += 1
+    return {"context": context}
+
+def route_retrieval(state):
+    if answer_deadline:
+        return "retrieve"
+    return ["search_web", "search_wikipedia"]
+
 def generate_answer(state):
     
     """ Node to answer a question """
 
-    # Get state
-    context = state["context"]
+    # Get state, context rendered as numbered documents rather than the list's repr
+    context = render_context(state["context"])
     question = state["question"]
 
     # Template
@@ -75,17 +239,23 @@ builder = StateGraph(State)
 # Initialize each node with node_secret 
 builder.add_node("search_web",search_web)
 builder.add_node("search_wikipedia", search_wikipedia)
+builder.add_node("retrieve", retrieve)
 builder.add_node("generate_answer", generate_answer)
 
 # Flow
-builder.add_edge(START, "search_wikipedia")
-builder.add_edge(START, "search_web")
+builder.add_conditional_edges(START, route_retrieval, ["search_web", "search_wikipedia", "retrieve"])
 builder.add_edge("search_wikipedia", "generate_answer")
 builder.add_edge("search_web", "generate_answer")
+builder.add_edge("retrieve", "generate_answer")
 builder.add_edge("generate_answer", END)
 graph = builder.compile()
 
 # display(Image(graph.get_graph().draw_mermaid_png()))
 
-result = graph.invoke({"question": "How were Nvidia's Q2 2024 earnings"})
-print(result['answer'].content)
\ No newline at end of file
+if __name__ == "__main__":
+    start = time.perf_counter()
+    result = graph.invoke({"question": "How were Nvidia's Q2 2024 earnings"})
+    print(result['answer'].content)
+    print(f"answered in {time.perf_counter() - start:.2f}s")
+    print("retrieval cache:", shared_cache.stats())
+    print("retrieval:", dict(retrieval_stats))
\ No newline at end of file
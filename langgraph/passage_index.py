@@ -0,0 +1,152 @@
+""" In-process lexical passage index
+
+Fetched pages are split into passages and indexed with BM25, so retrieval
+returns only the passages relevant to the current query (prompt size is
+bounded however long the article is) and later queries on the same
+interview can be answered from pages that were already fetched.
+"""
+
+import math
+import re
+import threading
+from collections import Counter
+
+from langchain_core.documents import Document
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it", "of",
+             "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which", "who", "why", "with"}
+
+def tokenize(text: str):
+    return TOKEN_PATTERN.findall(text.lower())
+
+def split_passages(text: str, passage_tokens: int = 120):
+
+    """ Split a document into paragraph-aligned passages of roughly passage_tokens """
+
+    passages, current = [], []
+    for paragraph in re.split(r"\n\s*\n", text):
+        words = paragraph.split()
+        # Break up paragraphs that alone exceed a passage
+        while len(words) * 4 // 3 > passage_tokens:
+            head, words = words[:passage_tokens * 3 // 4], words[passage_tokens * 3 // 4:]
+            if current:
+                passages.append(" ".join(current))
+                current = []
+            passages.append(" ".join(head))
+        if current and (len(current) + len(words)) * 4 // 3 > passage_tokens:
+            passages.append(" ".join(current))
+            current = []
+        current.extend(words)
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+class PassageIndex:
+
+    """ BM25 index over passages, growing as pages are added """
+
+    def __init__(self, passage_tokens: int = 120, k1: float = 1.5, b: float = 0.75):
+        self.passage_tokens = passage_tokens
+        self.k1 = k1
+        self.b = b
+        self.passages = [] # (text, metadata)
+        self.term_freqs = [] # Counter per passage
+        self.doc_freq = Counter()
+        self.total_length = 0
+        self.sources = set()
+
+    def __len__(self):
+        return len(self.passages)
+
+    def add_passage(self, passage: str, metadata: dict = None):
+        tf = Counter(tokenize(passage))
+        self.passages.append((passage, metadata or {}))
+        self.term_freqs.append(tf)
+        self.doc_freq.update(tf.keys())
+        self.total_length += sum(tf.values())
+
+    def add_text(self, text: str, metadata: dict):
+        for passage in split_passages(text, self.passage_tokens):
+            self.add_passage(passage, metadata)
+
+    def add_documents(self, docs):
+
+        """ Index pages, skipping sources already in the index """
+
+        for doc in docs:
+            source = doc.metadata.get("source")
+            if source in self.sources:
+                continue
+            self.sources.add(source)
+            self.add_text(doc.page_content, doc.metadata)
+
+    def scores(self, query: str):
+
+        """ BM25 score of every passage for the query """
+
+        terms = set(tokenize(query))
+        n = len(self.passages)
+        avg_length = self.total_length / n if n else 1.0
+        scores = []
+        for tf in self.term_freqs:
+            length = sum(tf.values())
+            score = 0.0
+            for term in terms:
+                if term not in tf:
+                    continue
+                idf = math.log(1 + (n - self.doc_freq[term] + 0.5) / (self.doc_freq[term] + 0.5))
+                score += idf * tf[term] * (self.k1 + 1) / (tf[term] + self.k1 * (1 - self.b + self.b * length / (avg_length or 1.0)))
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, k: int = 4):
+
+        """ Top-k passages as Documents, carrying the metadata of the page they came from """
+
+        scores = self.scores(query)
+        ranked = sorted(range(len(scores)), key=lambda i: -scores[i])[:k]
+        return [Document(page_content=self.passages[i][0], metadata=self.passages[i][1]) for i in ranked]
+
+    def coverage(self, query: str, k: int = 4) -> float:
+
+        """ Share of the query's content words found in its top-k passages """
+
+        terms = {t for t in tokenize(query) if t not in STOPWORDS}
+        if not terms:
+            return 0.0
+        found = set(tokenize(" ".join(doc.page_content for doc in self.search(query, k))))
+        return len(terms & found) / len(terms)
+
+def group_by_source(passages):
+
+    """ Merge passages from the same page into one Document, in rank order of each page's best passage """
+
+    grouped = {}
+    for doc in passages:
+        source = doc.metadata.get("source")
+        if source in grouped:
+            grouped[source].page_content += "\n\n...\n\n" + doc.page_content
+        else:
+            grouped[source] = Document(page_content=doc.page_content, metadata=doc.metadata)
+    return list(grouped.values())
+
+class IndexRegistry:
+
+    """ One PassageIndex per key (e.g. per interview), shared between threads """
+
+    def __init__(self, passage_tokens: int = 120):
+        self.passage_tokens = passage_tokens
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key) -> PassageIndex:
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = PassageIndex(self.passage_tokens)
+            return self._indexes[key]
+
+    def drop(self, key):
+        with self._lock:
+            self._indexes.pop(key, None)
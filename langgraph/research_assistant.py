@@ -1,4 +1,11 @@
+import asyncio
+import contextlib
 import operator
+import os
+import sqlite3
+import threading
+import uuid
+import weakref
 from pydantic import BaseModel, Field
 from typing import Annotated, List
 from typing_extensions import TypedDict
@@ -6,15 +13,100 @@ from typing_extensions import TypedDict
 from langchain_community.document_loaders import WikipediaLoader
 from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
 
-from langgraph.types import Send
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.types import Command, Send, interrupt
 from langgraph.graph import END, MessagesState, START, StateGraph
 
+from context_packing import pack_context, packing_stats, render_context
+from doc_store import document_store
+from novelty import novelty
+from passage_index import IndexRegistry, group_by_source
+from retrieval_cache import dump_documents, load_documents, shared_cache
+from structured_output import repair_stats, structured
+from wiki_snapshot import WikipediaSnapshotLoader
+
 ### LLM
 
 llm = ChatOpenAI(model="llama3.1", openai_api_base="http://localhost:11434/v1", api_key="ollama", temperature=0) 
 
+### Concurrency
+
+# Global cap on in-flight LLM / search calls, for graph.invoke (interviews run on threads) and graph.ainvoke
+# (interviews overlap on the event loop): never more than this many requests hit Ollama at once
+max_concurrency = int(os.environ.get("RESEARCH_MAX_CONCURRENCY", "4"))
+
+# One semaphore per event loop, created lazily on first use
+_semaphores = weakref.WeakKeyDictionary()
+
+# Threads share one semaphore per cap value, so changing max_concurrency takes effect on the next call
+_thread_semaphores = {}
+_thread_semaphores_lock = threading.Lock()
+
+def concurrency_limit():
+
+    """ Semaphore bounding concurrent LLM / search calls on the running event loop """
+
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(max_concurrency)
+    return _semaphores[loop]
+
+def thread_concurrency_limit():
+
+    """ Semaphore bounding concurrent LLM / search calls of graph.invoke """
+
+    with _thread_semaphores_lock:
+        if max_concurrency not in _thread_semaphores:
+            _thread_semaphores[max_concurrency] = threading.BoundedSemaphore(max_concurrency)
+        return _thread_semaphores[max_concurrency]
+
+def limited(call):
+
+    """ call() within the concurrency cap """
+
+    with thread_concurrency_limit():
+        return call()
+
+async def alimited(call):
+
+    """ Async variant of limited, call() returns an awaitable """
+
+    async with concurrency_limit():
+        return await call()
+
+def call_many(model, inputs):
+
+    """ model on every input in parallel, each call within the concurrency cap """
+
+    return RunnableLambda(lambda messages: limited(lambda: model.invoke(messages))).batch(inputs)
+
+async def acall_many(model, inputs):
+
+    """ Async variant of call_many """
+
+    return await asyncio.gather(*[alimited(lambda messages=messages: model.ainvoke(messages)) for messages in inputs])
+
+def llm_node(name, prepare, finish):
+
+    """ Node calling an LLM: prepare(state) returns the (model, messages) to invoke and finish(state, response) the state update
+
+    The node runs model.invoke under graph.invoke and model.ainvoke under graph.ainvoke, both within the concurrency cap
+    """
+
+    def node(state):
+        model, messages = prepare(state)
+        return finish(state, limited(lambda: model.invoke(messages)))
+
+    async def anode(state):
+        model, messages = prepare(state)
+        return finish(state, await alimited(lambda: model.ainvoke(messages)))
+
+    return RunnableLambda(node, afunc=anode, name=name)
+
 ### Schema 
 
 class Analyst(BaseModel):
@@ -47,20 +139,32 @@ class GenerateAnalystsState(TypedDict):
 
 class InterviewState(MessagesState):
     max_num_turns: int # Number turns of conversation
-    context: Annotated[list, operator.add] # Source docs
+    context: Annotated[list, operator.add] # Source doc IDs, text lives in doc_store
     analyst: Analyst # Analyst asking questions
+    interview_id: str # Key of the interview's Wikipedia passage index
     interview: str # Interview transcript
     sections: list # Final key we duplicate in outer state for Send() API
+    web_query: str # Query planned for web search this turn
+    wikipedia_query: str # Query planned for wikipedia this turn
+    turn_start: int # Length of context when this turn's retrieval started
+    interview_stats: list # How the interview ended and what stopping early saved
 
 class SearchQuery(BaseModel):
     search_query: str = Field(None, description="Search query for retrieval.")
 
+class SearchQueries(BaseModel):
+    web_query: str = Field(None, description="Search query for a web search engine.")
+    wikipedia_query: str = Field(None, description="Short query naming the Wikipedia article most likely to answer the question.")
+
 class ResearchGraphState(TypedDict):
     topic: str # Research topic
     max_analysts: int # Number of analysts
     human_analyst_feedback: str # Human feedback
     analysts: List[Analyst] # Analyst asking questions
     sections: Annotated[list, operator.add] # Send() API key
+    memos: list # Sections condensed by the tree reduce
+    formatted_sections: str # Memos formatted once, the shared prefix of the report writer prompts
+    interview_stats: Annotated[list, operator.add] # One entry per interview, see save_interview
     introduction: str # Introduction for the final report
     content: str # Content for the final report
     conclusion: str # Conclusion for the final report
@@ -83,31 +187,37 @@ analyst_instructions="""You are tasked with creating a set of AI analyst persona
 
 5. Assign one analyst to each theme."""
 
-def create_analysts(state: GenerateAnalystsState):
-    
-    """ Create analysts """
+def analyst_messages(state: GenerateAnalystsState):
+
+    """ Prompt to create analysts """
     
     topic=state['topic']
     max_analysts=state['max_analysts']
     human_analyst_feedback=state.get('human_analyst_feedback', '')
         
     # Enforce structured output
-    structured_llm = llm.with_structured_output(Perspectives)
+    structured_llm = structured(llm, Perspectives)
 
     # System message
     system_message = analyst_instructions.format(topic=topic,
                                                             human_analyst_feedback=human_analyst_feedback, 
                                                             max_analysts=max_analysts)
 
-    # Generate question 
-    analysts = structured_llm.invoke([SystemMessage(content=system_message)]+[HumanMessage(content="Generate the set of analysts.")])
+    return structured_llm, [SystemMessage(content=system_message)]+[HumanMessage(content="Generate the set of analysts.")]
+
+def save_analysts(state: GenerateAnalystsState, analysts):
     print("created analysts returning :", analysts)
     # Write the list of analysis to state
     return {"analysts": analysts.analysts}
 
+# Create analysts
+create_analysts = llm_node("create_analysts", analyst_messages, save_analysts)
+
+human_feedback_prompt = "Enter 'approve' to proceed with interviews or additional input to revise created analysts: "
+
 def human_feedback(state: GenerateAnalystsState):
-    """ No-op node that should be interrupted on """
-    user_input = input("Enter 'approve' to proceed with interviews or additional input to revise created analysts: ")
+    """ Pause the run until a human approves or revises the analysts, see ResearchJobs """
+    user_input = interrupt({"topic": state["topic"], "analysts": state["analysts"], "prompt": human_feedback_prompt})
     return {"human_analyst_feedback": user_input}
 
 # Generate analyst question
@@ -129,21 +239,25 @@ When you are satisfied with your understanding, complete the interview with: "Th
 
 Remember to stay in character throughout your response, reflecting the persona and goals provided to you."""
 
-def generate_question(state: InterviewState):
+def question_messages(state: InterviewState):
 
-    """ Node to generate a question """
+    """ Prompt to generate a question """
 
     # Get state
     analyst = state["analyst"]
     messages = state["messages"]
 
-    # Generate question 
     system_message = question_instructions.format(goals=analyst.persona)
-    question = llm.invoke([SystemMessage(content=system_message)]+messages)
+    return llm, [SystemMessage(content=system_message)]+messages
+
+def save_question(state: InterviewState, question):
     print("Generated question:", question.content)
     # Write messages to state
     return {"messages": [question]}
 
+# Node to generate a question
+generate_question = llm_node("generate_question", question_messages, save_question)
+
 # Search query writing
 search_instructions = SystemMessage(content=f"""You will be given a conversation between an analyst and an expert. 
 
@@ -155,51 +269,154 @@ Pay particular attention to the final question posed by the analyst.
 
 Convert this final question into a well-structured web search query""")
 
+per_backend_search_instructions = SystemMessage(content=f"""You will be given a conversation between an analyst and an expert. 
+
+Your goal is to generate well-structured queries for use in retrieval related to the conversation.
+        
+First, analyze the full conversation.
+
+Pay particular attention to the final question posed by the analyst.
+
+Convert this final question into:
+1. A well-structured web search query.
+2. A short Wikipedia query naming the article most likely to answer it.""")
+
+# Plan one query per backend (still a single LLM call) instead of sharing one query
+per_backend_queries = bool(os.environ.get("RESEARCH_PER_BACKEND_QUERIES"))
+
+def search_messages(state: InterviewState):
+
+    """ Prompt to write the search query once per turn """
+
+    if per_backend_queries:
+        return structured(llm, SearchQueries), [per_backend_search_instructions]+state['messages']
+
+    # Search query
+    return structured(llm, SearchQuery), [search_instructions]+state['messages']
+
+def save_queries(state: InterviewState, queries):
+    if isinstance(queries, SearchQueries):
+        return {"web_query": queries.web_query, "wikipedia_query": queries.wikipedia_query,
+                "turn_start": len(state.get('context', []))}
+    return {"web_query": queries.search_query, "wikipedia_query": queries.search_query,
+            "turn_start": len(state.get('context', []))}
+
+# Write the search query once per turn and hand it to every retriever
+plan_search = llm_node("plan_search", search_messages, save_queries)
+
+def format_web_doc(doc):
+
+    """ Format a Tavily result as a <Document> block """
+
+    return f'<Document href="{doc["url"]}"/>\n{doc["content"]}\n</Document>'
+
+def format_wikipedia_doc(doc):
+
+    """ Format a Wikipedia page as a <Document> block """
+
+    return f'<Document source="{doc.metadata["source"]}" page="{doc.metadata.get("page", "")}"/>\n{doc.page_content}\n</Document>'
+
+def web_context(state: InterviewState, search_docs):
+
+    """ Format and store the search results, hand back the document IDs """
+
+    return {"context": document_store.put_many((format_web_doc(doc) for doc in search_docs), interview_key(state))}
+
 def search_web(state: InterviewState):
     
     """ Retrieve docs from web search """
 
     # Search
     tavily_search = TavilySearchResults(max_results=3)
+    query = state['web_query']
 
-    # Search query
-    structured_llm = llm.with_structured_output(SearchQuery)
-    search_query = structured_llm.invoke([search_instructions]+state['messages'])
-    
-    # Search
-    search_docs = tavily_search.invoke(search_query.search_query)
-
-     # Format
-    formatted_search_docs = "\n\n---\n\n".join(
-        [
-            f'<Document href="{doc["url"]}"/>\n{doc["content"]}\n</Document>'
-            for doc in search_docs
-        ]
-    )
+    # Search, served from the retrieval cache when the query was seen before
+    return web_context(state, shared_cache.fetch("tavily", query, lambda: limited(lambda: tavily_search.invoke(query)), max_results=3))
+
+async def asearch_web(state: InterviewState):
+
+    """ Async variant of search_web """
+
+    tavily_search = TavilySearchResults(max_results=3)
+    query = state['web_query']
+    return web_context(state, await shared_cache.afetch("tavily", query, lambda: alimited(lambda: tavily_search.ainvoke(query)), max_results=3))
+
+# Wikipedia pages are chunked into a BM25 index per interview and only the top passages are returned,
+# 0 returns whole pages as before
+wikipedia_top_k = int(os.environ.get("RESEARCH_WIKIPEDIA_PASSAGES", "4"))
+
+# Pages are only fetched when the passages already indexed cover less than this share of the query's words
+wikipedia_reuse_coverage = 0.8
+
+wikipedia_indexes = IndexRegistry(passage_tokens=120)
+
+# Local Wikipedia snapshot (built with wiki_snapshot.py) queried instead of the Wikipedia API when set
+wikipedia_snapshot = os.environ.get("WIKIPEDIA_SNAPSHOT")
+
+def interview_key(state: InterviewState):
+    return state.get("interview_id") or state["analyst"].name
+
+def fetch_wikipedia(query):
+
+    """ Wikipedia pages for the query, served from the retrieval cache when the query was seen before """
+
+    # Snapshot lookups are local and take milliseconds, no need to cache them
+    if wikipedia_snapshot:
+        return WikipediaSnapshotLoader(query=query, load_max_docs=2, path=wikipedia_snapshot).load()
+
+    return load_documents(shared_cache.fetch(
+        "wikipedia", query,
+        lambda: dump_documents(limited(WikipediaLoader(query=query, load_max_docs=2).load)),
+        load_max_docs=2))
+
+async def afetch_wikipedia(query):
+
+    """ Async variant of fetch_wikipedia """
 
-    return {"context": [formatted_search_docs]} 
+    if wikipedia_snapshot:
+        return await WikipediaSnapshotLoader(query=query, load_max_docs=2, path=wikipedia_snapshot).aload()
+
+    async def retrieve():
+        return dump_documents(await alimited(WikipediaLoader(query=query, load_max_docs=2).aload))
+
+    return load_documents(await shared_cache.afetch("wikipedia", query, retrieve, load_max_docs=2))
+
+def wikipedia_needs_fetch(state: InterviewState):
+
+    """ Whether this turn fetches pages: always for whole pages, else when the pages indexed on earlier turns do not cover the query """
+
+    if not wikipedia_top_k:
+        return True
+    index = wikipedia_indexes.get(interview_key(state))
+    return index.coverage(state['wikipedia_query'], wikipedia_top_k) < wikipedia_reuse_coverage
+
+def wikipedia_context(state: InterviewState, pages):
+
+    """ Store the fetched pages, or the top passages of the interview's index, and hand back the document IDs """
+
+    search_docs = pages
+    if wikipedia_top_k:
+        index = wikipedia_indexes.get(interview_key(state))
+        index.add_documents(pages)
+        search_docs = group_by_source(index.search(state['wikipedia_query'], wikipedia_top_k))
+
+    # Format, store and hand back the document IDs
+    return {"context": document_store.put_many((format_wikipedia_doc(doc) for doc in search_docs), interview_key(state))}
 
 def search_wikipedia(state: InterviewState):
     
     """ Retrieve docs from wikipedia """
 
-    # Search query
-    structured_llm = llm.with_structured_output(SearchQuery)
-    search_query = structured_llm.invoke([search_instructions]+state['messages'])
-    
-    # Search
-    search_docs = WikipediaLoader(query=search_query.search_query, 
-                                  load_max_docs=2).load()
-
-     # Format
-    formatted_search_docs = "\n\n---\n\n".join(
-        [
-            f'<Document source="{doc.metadata["source"]}" page="{doc.metadata.get("page", "")}"/>\n{doc.page_content}\n</Document>'
-            for doc in search_docs
-        ]
-    )
+    # Query the pages fetched on earlier turns first, fetch only if they do not cover the query
+    pages = fetch_wikipedia(state['wikipedia_query']) if wikipedia_needs_fetch(state) else []
+    return wikipedia_context(state, pages)
+
+async def asearch_wikipedia(state: InterviewState):
 
-    return {"context": [formatted_search_docs]} 
+    """ Async variant of search_wikipedia """
+
+    pages = await afetch_wikipedia(state['wikipedia_query']) if wikipedia_needs_fetch(state) else []
+    return wikipedia_context(state, pages)
 
 # Generate expert answer
 answer_instructions = """You are an expert being interviewed by an analyst.
@@ -218,30 +435,45 @@ When answering questions, follow these guidelines:
         
 2. Do not introduce external information or make assumptions beyond what is explicitly stated in the context.
 
-3. The context contain sources at the topic of each individual document.
+3. Each document in the context starts with a "[n] source" line: its number, then its link or document name.
 
-4. Include these sources your answer next to any relevant statements. For example, for source # 1 use [1]. 
+4. Cite a document next to any relevant statement with its number. For example, for the document headed [1] use [1]. 
 
-5. List your sources in order at the bottom of your answer. [1] Source 1, [2] Source 2, etc
-        
-6. If the source is: <Document source="assistant/docs/llama3_1.pdf" page="7"/>' then just list: 
+5. List the documents you cited in order at the bottom of your answer, copying their "[n] source" lines. [1] Source 1, [2] Source 2, etc
         
-[1] assistant/docs/llama3_1.pdf, page 7 
+6. If a document is headed: [1] assistant/docs/llama3_1.pdf, page 7 then just list: 
         
-And skip the addition of the brackets as well as the Document source preamble in your citation."""
+[1] assistant/docs/llama3_1.pdf, page 7"""
 
-def generate_answer(state: InterviewState):
+# Token budgets for the packed context of the answer / section prompts, 0 sends the whole context as before
+answer_token_budget = int(os.environ.get("RESEARCH_ANSWER_TOKEN_BUDGET", "2000"))
+section_token_budget = int(os.environ.get("RESEARCH_SECTION_TOKEN_BUDGET", "3000"))
+
+def packed_context(context, query, token_budget):
+
+    """ Deduped, ranked and budgeted context for a prompt, from the document IDs in state """
+
+    context = document_store.resolve(context)
+    if not token_budget:
+        return context
+    text, stats = pack_context(context, query, token_budget)
+    print(f"Packed context: {stats['packed_tokens']} of {stats['raw_tokens']} tokens ({stats['tokens_saved']} saved)")
+    return text
+
+def answer_messages(state: InterviewState):
     
-    """ Node to answer a question """
+    """ Prompt to answer a question """
 
     # Get state
     analyst = state["analyst"]
     messages = state["messages"]
-    context = state["context"]
+    context = render_context(packed_context(state["context"], messages[-1].content, answer_token_budget))
 
     # Answer question
     system_message = answer_instructions.format(goals=analyst.persona, context=context)
-    answer = llm.invoke([SystemMessage(content=system_message)]+messages)
+    return llm, [SystemMessage(content=system_message)]+messages
+
+def save_answer(state: InterviewState, answer):
             
     # Name the message as coming from the expert
     answer.name = "expert"
@@ -249,24 +481,31 @@ def generate_answer(state: InterviewState):
     # Append it to state
     return {"messages": [answer]}
 
-def save_interview(state: InterviewState):
-    
-    """ Save interviews """
+# Node to answer a question
+generate_answer = llm_node("generate_answer", answer_messages, save_answer)
 
-    # Get messages
-    messages = state["messages"]
-    
-    # Convert interview to a string
-    interview = get_buffer_string(messages)
-    
-    # Save to interviews key
-    return {"interview": interview}
+# End the interview once a turn's retrieval adds less than this share of new text to the context. Off (0) unless
+# RESEARCH_NOVELTY_THRESHOLD is set, 0.1 is a reasonable value. A turn that retrieved nothing never stops the interview
+novelty_threshold = float(os.environ.get("RESEARCH_NOVELTY_THRESHOLD", "0"))
 
-def route_messages(state: InterviewState, 
-                   name: str = "expert"):
+# LLM calls of one more question / search / answer round. Searches are not counted: a skipped turn's searches
+# would mostly have been answered by the shared search cache, so they say little about fetches avoided
+llm_calls_per_turn = 3 # generate_question, plan_search, generate_answer
+
+def turn_novelty(state: InterviewState):
+
+    """ Share of the latest turn's retrieved text that was not already in context, None if it retrieved nothing """
+
+    context = document_store.resolve(state.get("context", []))
+    turn_start = state.get("turn_start", 0)
+    if turn_start == 0:
+        return 1.0
+    return novelty(context[turn_start:], context[:turn_start])
+
+def stop_reason(state: InterviewState, name: str = "expert"):
+
+    """ Why the interview should end after this turn, None to keep going """
 
-    """ Route between question and answer """
-    
     # Get messages
     messages = state["messages"]
     max_num_turns = state.get('max_num_turns',2)
@@ -278,23 +517,71 @@ def route_messages(state: InterviewState,
 
     # End if expert has answered more than the max turns
     if num_responses >= max_num_turns:
-        return 'save_interview'
+        return "max_turns"
 
     # This router is run after each question - answer pair 
     # Get the last question asked to check if it signals the end of discussion
     last_question = messages[-2]
     
     if "Thank you so much for your help" in last_question.content:
+        return "thank_you"
+
+    # End if the last retrieval mostly repeated documents already in context
+    if novelty_threshold:
+        score = turn_novelty(state)
+        if score is not None and score < novelty_threshold:
+            return "novelty"
+    return None
+
+def save_interview(state: InterviewState):
+    
+    """ Save interviews """
+
+    # Get messages
+    messages = state["messages"]
+    
+    # Convert interview to a string
+    interview = get_buffer_string(messages)
+
+    # Record how the interview ended, and what the novelty stop saved
+    turns = len([m for m in messages if isinstance(m, AIMessage) and m.name == "expert"])
+    reason = stop_reason(state)
+    turns_saved = state.get('max_num_turns', 2) - turns if reason == "novelty" else 0
+    stats = {"analyst": state["analyst"].name, "turns": turns, "stop_reason": reason,
+             "novelty": turn_novelty(state), "turns_saved": turns_saved,
+             "llm_calls_saved": turns_saved * llm_calls_per_turn}
+    
+    # The interview is over, free its passage index
+    wikipedia_indexes.drop(interview_key(state))
+    
+    # Save to interviews key
+    return {"interview": interview, "interview_stats": [stats]}
+
+def route_messages(state: InterviewState, 
+                   name: str = "expert"):
+
+    """ Route between question and answer """
+
+    if stop_reason(state, name):
         return 'save_interview'
     return "ask_question"
 
+def interview_savings(interview_stats):
+
+    """ Per-report totals of turns and LLM calls saved by novelty-based stopping """
+
+    return {"interviews": len(interview_stats),
+            "stopped_on_novelty": len([s for s in interview_stats if s["stop_reason"] == "novelty"]),
+            "turns_saved": sum(s["turns_saved"] for s in interview_stats),
+            "llm_calls_saved": sum(s["llm_calls_saved"] for s in interview_stats)}
+
 # Write a summary (section of the final report) of the interview
 section_writer_instructions = """You are an expert technical writer. 
             
 Your task is to create a short, easily digestible section of a report based on a set of source documents.
 
 1. Analyze the content of the source documents: 
-- The name of each source document is at the start of the document, with the <Document tag.
+- Each source document starts with a "[n] source" line: its number, then its link or document name.
         
 2. Create a report structure using markdown formatting:
 - Use ## for the section title
@@ -311,13 +598,12 @@ c. Sources (### header)
 5. For the summary section:
 - Set up summary with general background / context related to the focus area of the analyst
 - Emphasize what is novel, interesting, or surprising about insights gathered from the interview
-- Create a numbered list of source documents, as you use them
 - Do not mention the names of interviewers or experts
 - Aim for approximately 400 words maximum
-- Use numbered sources in your report (e.g., [1], [2]) based on information from source documents
+- Cite source documents by the number of their "[n] source" line (e.g., [1], [2])
         
 6. In the Sources section:
-- Include all sources used in your report
+- Include all sources used in your report, with the same numbers as in your summary
 - Provide full links to relevant websites or specific document paths
 - Separate each source by a newline. Use two spaces at the end of each line to create a newline in Markdown.
 - It will look like:
@@ -340,40 +626,71 @@ There should be no redundant sources. It should simply be:
 - Include no preamble before the title of the report
 - Check that all guidelines have been followed"""
 
-def write_section(state: InterviewState):
+def section_messages(state: InterviewState):
 
-    """ Node to write a section """
+    """ Prompt to write a section """
 
     # Get state
     interview = state["interview"]
-    context = state["context"]
     analyst = state["analyst"]
+    context = render_context(packed_context(state["context"], f"{analyst.description}\n{interview}", section_token_budget))
    
     # Write section using either the gathered source docs from interview (context) or the interview itself (interview)
     system_message = section_writer_instructions.format(focus=analyst.description)
-    section = llm.invoke([SystemMessage(content=system_message)]+[HumanMessage(content=f"Use this source to write your section: {context}")]) 
+    return llm, [SystemMessage(content=system_message)]+[HumanMessage(content=f"Use this source to write your section: {context}")]
+
+def save_section(state: InterviewState, section):
                 
     # Append it to state
     return {"sections": [section.content]}
 
+# Node to write a section
+write_section = llm_node("write_section", section_messages, save_section)
+
 # Add nodes and edges 
+# Each LLM-backed node carries a sync and an async implementation: graph.invoke runs the former, graph.ainvoke the latter
 interview_builder = StateGraph(InterviewState)
 interview_builder.add_node("ask_question", generate_question)
-interview_builder.add_node("search_web", search_web)
-interview_builder.add_node("search_wikipedia", search_wikipedia)
+interview_builder.add_node("plan_search", plan_search)
+interview_builder.add_node("search_web", RunnableLambda(search_web, afunc=asearch_web))
+interview_builder.add_node("search_wikipedia", RunnableLambda(search_wikipedia, afunc=asearch_wikipedia))
 interview_builder.add_node("answer_question", generate_answer)
 interview_builder.add_node("save_interview", save_interview)
 interview_builder.add_node("write_section", write_section)
 
 # Flow
 interview_builder.add_edge(START, "ask_question")
-interview_builder.add_edge("ask_question", "search_web")
-interview_builder.add_edge("ask_question", "search_wikipedia")
+interview_builder.add_edge("ask_question", "plan_search")
+interview_builder.add_edge("plan_search", "search_web")
+interview_builder.add_edge("plan_search", "search_wikipedia")
 interview_builder.add_edge("search_web", "answer_question")
 interview_builder.add_edge("search_wikipedia", "answer_question")
 interview_builder.add_conditional_edges("answer_question", route_messages,['ask_question','save_interview'])
 interview_builder.add_edge("save_interview", "write_section")
 interview_builder.add_edge("write_section", END)
+interview_graph = interview_builder.compile()
+
+def interview_result(result):
+    # The outer graph keeps the section and how the interview ended
+    return {"sections": result["sections"], "interview_stats": result["interview_stats"]}
+
+def conduct_interview(state: InterviewState, config):
+
+    """ Run the interview subgraph, then drop its document references however the interview ended """
+
+    try:
+        return interview_result(interview_graph.invoke(state, config))
+    finally:
+        document_store.release(interview_key(state))
+
+async def aconduct_interview(state: InterviewState, config):
+
+    """ Async variant of conduct_interview """
+
+    try:
+        return interview_result(await interview_graph.ainvoke(state, config))
+    finally:
+        document_store.release(interview_key(state))
 
 def initiate_all_interviews(state: ResearchGraphState):
 
@@ -390,14 +707,96 @@ def initiate_all_interviews(state: ResearchGraphState):
     else:
         print('initiating all interviews')
         topic = state["topic"]
-        return [Send("conduct_interview", {"analyst": analyst,
-                                           "messages": [HumanMessage(
-                                               content=f"So you said you were writing an article on {topic}?"
-                                           )
-                                                       ]}) for analyst in state["analysts"]]
+        return [Send("conduct_interview", interview_input(topic, analyst)) for analyst in state["analysts"]]
 
-# Write a report based on the interviews
-report_writer_instructions = """You are a technical writer creating a report on this overall topic: 
+def interview_input(topic, analyst):
+
+    """ Initial interview subgraph state for one analyst """
+
+    return {"analyst": analyst,
+            "interview_id": str(uuid.uuid4()),
+            "messages": [HumanMessage(
+                content=f"So you said you were writing an article on {topic}?"
+            )
+                        ]}
+
+# Merge groups of memos (hierarchical reduce)
+memo_merge_instructions = """You are a technical writer consolidating analyst memos on this overall topic: 
+
+{topic}
+
+You will be given a group of memos. Merge them into a single memo that:
+
+1. Keeps every specific insight, example and number from the memos.
+2. Preserves the citations exactly as they appear, for example [1] or [2].
+3. Ends with a combined ### Sources section listing every source from the memos, without repeats.
+4. Has no preamble and does not mention analyst names.
+
+Here are the memos to merge: 
+
+{memos}"""
+
+# Number of memos merged per LLM call; once there are more sections than this, they are merged
+# group by group (in parallel) and the merged memos again, until a single group is left
+reduce_group_size = int(os.environ.get("RESEARCH_REDUCE_GROUP_SIZE", "5"))
+
+def format_sections(memos):
+
+    """ Shared formatted-sections artifact, computed once for the reduce phase """
+
+    return "\n\n".join([f"{memo}" for memo in memos])
+
+def group_memos(memos):
+    return [memos[i:i + reduce_group_size] for i in range(0, len(memos), reduce_group_size)]
+
+def memo_merge_messages(topic, group):
+    memos = "\n\n".join([f"{memo}" for memo in group])
+    return [SystemMessage(content=memo_merge_instructions.format(topic=topic, memos=memos)),
+            HumanMessage(content="Merge these memos.")]
+
+def merge_messages(state: ResearchGraphState, groups):
+    return [memo_merge_messages(state["topic"], group) for group in groups if len(group) > 1]
+
+def merged_memos(groups, merged):
+
+    """ One memo per group: the merged memo, or the group's only memo which needs no merge """
+
+    merged = iter(merged)
+    memos = [next(merged).content if len(group) > 1 else group[0] for group in groups]
+    print(f"Condensed sections into {len(memos)} memos")
+    return memos
+
+def needs_condensing(memos):
+    return reduce_group_size > 1 and len(memos) > reduce_group_size
+
+def condense_sections(state: ResearchGraphState):
+
+    """ Tree reduce of the sections so the report prompts stay within the context window """
+
+    memos = state["sections"]
+
+    # Each round merges groups in parallel, so there are about log(n) / log(group size) rounds
+    while needs_condensing(memos):
+        groups = group_memos(memos)
+        memos = merged_memos(groups, call_many(llm, merge_messages(state, groups)))
+
+    return {"memos": memos, "formatted_sections": format_sections(memos)}
+
+async def acondense_sections(state: ResearchGraphState):
+
+    """ Async variant of condense_sections """
+
+    memos = state["sections"]
+    while needs_condensing(memos):
+        groups = group_memos(memos)
+        memos = merged_memos(groups, await acall_many(llm, merge_messages(state, groups)))
+
+    return {"memos": memos, "formatted_sections": format_sections(memos)}
+
+# Shared head of the three reduce prompts: the (large) sections block comes first and is byte-identical
+# across write_report, write_introduction and write_conclusion, so Ollama can reuse the KV cache of the
+# prefix and only prefill the short task instructions that follow it
+reduce_prefix_instructions = """You are a technical writer creating a report on this overall topic: 
 
 {topic}
     
@@ -406,12 +805,23 @@ You have a team of analysts. Each analyst has done two things:
 1. They conducted an interview with an expert on a specific sub-topic.
 2. They write up their finding into a memo.
 
-Your task: 
+Here are the memos from your analysts: 
+
+{formatted_str_sections}"""
+
+def reduce_messages(state: ResearchGraphState, instructions: str):
+
+    """ Shared sections prefix followed by the task-specific instructions """
 
-1. You will be given a collection of memos from your analysts.
-2. Think carefully about the insights from each memo.
-3. Consolidate these into a crisp overall summary that ties together the central ideas from all of the memos. 
-4. Summarize the central points in each memo into a cohesive single narrative.
+    prefix = reduce_prefix_instructions.format(topic=state["topic"], formatted_str_sections=state["formatted_sections"])
+    return [SystemMessage(content=prefix)]+[HumanMessage(content=instructions)]
+
+# Write a report based on the interviews
+report_writer_instructions = """Your task: 
+
+1. Think carefully about the insights from each memo above.
+2. Consolidate these into a crisp overall summary that ties together the central ideas from all of the memos. 
+3. Summarize the central points in each memo into a cohesive single narrative.
 
 To format your report:
  
@@ -427,36 +837,22 @@ To format your report:
 [1] Source 1
 [2] Source 2
 
-Here are the memos from your analysts to build your report from: 
+Write a report based upon these memos."""
 
-{context}"""
+def report_messages(state: ResearchGraphState):
 
-def write_report(state: ResearchGraphState):
+    """ Prompt to write the final report body """
 
-    """ Node to write the final report body """
+    # Summarize the shared sections into a final report
+    return llm, reduce_messages(state, report_writer_instructions)
 
-    # Full set of sections
-    sections = state["sections"]
-    topic = state["topic"]
-
-    # Concat all sections together
-    formatted_str_sections = "\n\n".join([f"{section}" for section in sections])
-    
-    # Summarize the sections into a final report
-    system_message = report_writer_instructions.format(topic=topic, context=formatted_str_sections)    
-    report = llm.invoke([SystemMessage(content=system_message)]+[HumanMessage(content=f"Write a report based upon these memos.")]) 
-    return {"content": report.content}
+# Node to write the final report body
+write_report = llm_node("write_report", report_messages, lambda state, report: {"content": report.content})
 
 # Write the introduction or conclusion
-intro_conclusion_instructions = """You are a technical writer finishing a report on {topic}
-
-You will be given all of the sections of the report.
-
-You job is to write a crisp and compelling introduction or conclusion section.
-
-The user will instruct you whether to write the introduction or conclusion.
+intro_conclusion_instructions = """Your task is to finish the report with a crisp and compelling {section} section, reflecting on all of the memos above.
 
-Include no pre-amble for either section.
+Include no pre-amble for the section.
 
 Target around 100 words, crisply previewing (for introduction) or recapping (for conclusion) all of the sections of the report.
 
@@ -468,41 +864,23 @@ For your introduction, use ## Introduction as the section header.
 
 For your conclusion, use ## Conclusion as the section header.
 
-Here are the sections to reflect on for writing: {formatted_str_sections}"""
+Write the report {section}."""
 
-def write_introduction(state: ResearchGraphState):
+def introduction_messages(state: ResearchGraphState):
 
-    """ Node to write the introduction """
+    """ Prompt to write the introduction from the shared sections """
 
-    # Full set of sections
-    sections = state["sections"]
-    topic = state["topic"]
+    return llm, reduce_messages(state, intro_conclusion_instructions.format(section="introduction"))
 
-    # Concat all sections together
-    formatted_str_sections = "\n\n".join([f"{section}" for section in sections])
-    
-    # Summarize the sections into a final report
-    
-    instructions = intro_conclusion_instructions.format(topic=topic, formatted_str_sections=formatted_str_sections)    
-    intro = llm.invoke([instructions]+[HumanMessage(content=f"Write the report introduction")]) 
-    return {"introduction": intro.content}
+def conclusion_messages(state: ResearchGraphState):
 
-def write_conclusion(state: ResearchGraphState):
+    """ Prompt to write the conclusion from the shared sections """
 
-    """ Node to write the conclusion """
+    return llm, reduce_messages(state, intro_conclusion_instructions.format(section="conclusion"))
 
-    # Full set of sections
-    sections = state["sections"]
-    topic = state["topic"]
-
-    # Concat all sections together
-    formatted_str_sections = "\n\n".join([f"{section}" for section in sections])
-    
-    # Summarize the sections into a final report
-    
-    instructions = intro_conclusion_instructions.format(topic=topic, formatted_str_sections=formatted_str_sections)    
-    conclusion = llm.invoke([instructions]+[HumanMessage(content=f"Write the report conclusion")]) 
-    return {"conclusion": conclusion.content}
+# Nodes to write the introduction and the conclusion
+write_introduction = llm_node("write_introduction", introduction_messages, lambda state, intro: {"introduction": intro.content})
+write_conclusion = llm_node("write_conclusion", conclusion_messages, lambda state, conclusion: {"conclusion": conclusion.content})
 
 def finalize_report(state: ResearchGraphState):
 
@@ -529,25 +907,219 @@ def finalize_report(state: ResearchGraphState):
 builder = StateGraph(ResearchGraphState)
 builder.add_node("create_analysts", create_analysts)
 builder.add_node("human_feedback", human_feedback)
-builder.add_node("conduct_interview", interview_builder.compile())
-builder.add_node("write_report",write_report)
-builder.add_node("write_introduction",write_introduction)
-builder.add_node("write_conclusion",write_conclusion)
+builder.add_node("conduct_interview", RunnableLambda(conduct_interview, afunc=aconduct_interview))
+builder.add_node("condense_sections", RunnableLambda(condense_sections, afunc=acondense_sections))
+builder.add_node("write_report", write_report)
+builder.add_node("write_introduction", write_introduction)
+builder.add_node("write_conclusion", write_conclusion)
 builder.add_node("finalize_report",finalize_report)
 
 # Logic
 builder.add_edge(START, "create_analysts")
 builder.add_edge("create_analysts", "human_feedback")
 builder.add_conditional_edges("human_feedback", initiate_all_interviews, ["create_analysts", "conduct_interview"])
-builder.add_edge("conduct_interview", "write_report")
-builder.add_edge("conduct_interview", "write_introduction")
-builder.add_edge("conduct_interview", "write_conclusion")
+builder.add_edge("conduct_interview", "condense_sections")
+builder.add_edge("condense_sections", "write_report")
+builder.add_edge("condense_sections", "write_introduction")
+builder.add_edge("condense_sections", "write_conclusion")
 builder.add_edge(["write_conclusion", "write_report", "write_introduction"], "finalize_report")
 builder.add_edge("finalize_report", END)
 
 # Compile
-# graph = builder.compile(interrupt_before=['human_feedback'])
-graph = builder.compile()
+# The checkpointer holds runs paused on human_feedback, resume them with Command(resume=feedback) on the same thread_id
+checkpoint_serde = JsonPlusSerializer(allowed_msgpack_modules=[(Analyst.__module__, "Analyst")])
+
+# SQLite file for durable checkpoints of the research graph and its interview subgraphs, in memory when unset.
+# A run that crashed or timed out continues from its last completed super-step with resume_research(thread_id)
+checkpoint_path = os.environ.get("RESEARCH_CHECKPOINT_PATH")
+
+def checkpointer(path=None):
+
+    """ SqliteSaver on path (requires langgraph-checkpoint-sqlite), MemorySaver when no path is given """
+
+    if not path:
+        return MemorySaver(serde=checkpoint_serde)
+    from langgraph.checkpoint.sqlite import SqliteSaver
+    return SqliteSaver(sqlite3.connect(path, check_same_thread=False), serde=checkpoint_serde)
+
+if checkpoint_path:
+    # Checkpoints carry document IDs, the documents must survive with them (in their own file, the
+    # async checkpointer keeps write transactions open on the checkpoint database)
+    document_store.persist(checkpoint_path + ".documents")
+
+graph = builder.compile(checkpointer=checkpointer(checkpoint_path))
+
+@contextlib.asynccontextmanager
+async def async_graph():
+
+    """ The research graph for ainvoke: SqliteSaver is sync-only, durable async runs need an AsyncSqliteSaver on the running loop """
+
+    if not checkpoint_path:
+        yield graph
+        return
+    import aiosqlite
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+    async with aiosqlite.connect(checkpoint_path) as conn:
+        yield builder.compile(checkpointer=AsyncSqliteSaver(conn, serde=checkpoint_serde))
+
+def console_review(request):
+
+    """ Ask for analyst approval on the console """
+
+    for analyst in request["analysts"]:
+        print(analyst.persona)
+    return input(request["prompt"])
+
+def run_thread(graph_input, config, review):
+
+    """ Invoke the graph on a thread until it finishes, asking review(request) whenever it pauses for analyst approval """
+
+    result = graph.invoke(graph_input, config)
+    while "__interrupt__" in result:
+        result = graph.invoke(Command(resume=review(result["__interrupt__"][0].value)), config)
+    return result
+
+def run_research(topic: str, max_analysts: int = 3, review=console_review, thread_id: str = None):
+
+    """ Run the research graph, checkpointed under thread_id (a fresh one by default) """
+
+    config = {"configurable": {"thread_id": thread_id or str(uuid.uuid4())}}
+    print("research thread:", config["configurable"]["thread_id"])
+    return run_thread({"topic": topic, "max_analysts": max_analysts}, config, review)
+
+def resume_research(thread_id: str, review=console_review):
+
+    """ Continue a run from its last checkpoint
+
+    Work finished before the crash is not redone: completed interviews keep their sections, a
+    super-step resumes with only its failed tasks, and a run paused on analyst approval asks again.
+    """
+
+    config = {"configurable": {"thread_id": thread_id}}
+    snapshot = graph.get_state(config)
+    if not snapshot.values:
+        raise ValueError(f"No checkpoint for research thread {thread_id}")
+    if not snapshot.next:
+        return snapshot.values
+    return run_thread(None, config, review)
+
+async def arun_thread(graph, graph_input, config, review):
 
-result = graph.invoke({"topic": "real world applications of langgraph", "max_analysts": 3})
-print(result)
\ No newline at end of file
+    """ Async variant of run_thread """
+
+    result = await graph.ainvoke(graph_input, config)
+    while "__interrupt__" in result:
+        # A blocking review (console input) runs in a thread so other jobs on the loop keep going
+        feedback = await asyncio.to_thread(review, result["__interrupt__"][0].value)
+        result = await graph.ainvoke(Command(resume=feedback), config)
+    return result
+
+async def arun_research(topic: str, max_analysts: int = 3, max_concurrent_calls: int = None, review=console_review, thread_id: str = None):
+
+    """ Run the research graph on the event loop so interviews overlap, bounded by the global concurrency cap """
+
+    if max_concurrent_calls is not None:
+        _semaphores[asyncio.get_running_loop()] = asyncio.Semaphore(max_concurrent_calls)
+    config = {"configurable": {"thread_id": thread_id or str(uuid.uuid4())}}
+    print("research thread:", config["configurable"]["thread_id"])
+    async with async_graph() as research_graph:
+        return await arun_thread(research_graph, {"topic": topic, "max_analysts": max_analysts}, config, review)
+
+async def aresume_research(thread_id: str, review=console_review):
+
+    """ Async variant of resume_research """
+
+    config = {"configurable": {"thread_id": thread_id}}
+    async with async_graph() as research_graph:
+        snapshot = await research_graph.aget_state(config)
+        if not snapshot.values:
+            raise ValueError(f"No checkpoint for research thread {thread_id}")
+        if not snapshot.next:
+            return snapshot.values
+        return await arun_thread(research_graph, None, config, review)
+
+class ResearchJobs:
+
+    """ Many research runs in flight on one event loop, each pausing for analyst approval
+
+    No worker waits on a human: a job runs until human_feedback interrupts it, its state is
+    checkpointed and the task ends. Reviewers list pending() approvals and resume() jobs whenever
+    they get to them.
+
+        jobs = ResearchJobs()
+        job_id = jobs.start("real world applications of langgraph")
+        ...
+        for request in jobs.pending():
+            jobs.resume(request["job_id"], "approve")
+        report = (await jobs.wait(job_id))["final_report"]
+
+    With RESEARCH_CHECKPOINT_PATH set, pass the graph of `async with async_graph()`.
+    """
+
+    def __init__(self, graph=graph):
+        self.graph = graph
+        self.tasks = {} # job_id -> asyncio.Task of the job's current leg
+
+    def config(self, job_id):
+        return {"configurable": {"thread_id": job_id}}
+
+    def start(self, topic: str, max_analysts: int = 3, job_id: str = None):
+
+        """ Start a job in the background, returns its id (call from the event loop) """
+
+        job_id = job_id or str(uuid.uuid4())
+        self.tasks[job_id] = asyncio.ensure_future(
+            self.graph.ainvoke({"topic": topic, "max_analysts": max_analysts}, self.config(job_id)))
+        return job_id
+
+    def status(self, job_id):
+
+        """ "running", "awaiting_approval", "done" or "failed" """
+
+        task = self.tasks[job_id]
+        if not task.done():
+            return "running"
+        if task.exception() is not None:
+            return "failed"
+        return "awaiting_approval" if "__interrupt__" in task.result() else "done"
+
+    def pending(self):
+
+        """ Approval requests of the jobs paused on human_feedback """
+
+        return [{"job_id": job_id, **self.tasks[job_id].result()["__interrupt__"][0].value}
+                for job_id in self.tasks if self.status(job_id) == "awaiting_approval"]
+
+    def resume(self, job_id, feedback: str = "approve"):
+
+        """ Continue a paused job with the reviewer's feedback: 'approve' runs the interviews, anything else revises the analysts """
+
+        if self.status(job_id) != "awaiting_approval":
+            raise ValueError(f"Job {job_id} is not awaiting approval")
+        self.tasks[job_id] = asyncio.ensure_future(self.graph.ainvoke(Command(resume=feedback), self.config(job_id)))
+
+    async def wait(self, job_id):
+
+        """ Result of the job's current leg: the final state, or the state it paused in """
+
+        return await self.tasks[job_id]
+
+if __name__ == "__main__":
+    # Set RESEARCH_ASYNC=1 to run every node async with interviews overlapping on one event loop
+    # Set RESEARCH_RESUME=<thread id> (with RESEARCH_CHECKPOINT_PATH) to continue a run that crashed
+    resume_thread = os.environ.get("RESEARCH_RESUME")
+    if os.environ.get("RESEARCH_ASYNC"):
+        if resume_thread:
+            result = asyncio.run(aresume_research(resume_thread))
+        else:
+            result = asyncio.run(arun_research("real world applications of langgraph", max_analysts=3))
+    elif resume_thread:
+        result = resume_research(resume_thread)
+    else:
+        result = run_research("real world applications of langgraph", max_analysts=3)
+    print(result)
+    print("retrieval cache:", shared_cache.stats())
+    print("context packing:", packing_stats())
+    print("document store:", document_store.stats())
+    print("structured output:", repair_stats())
+    print("interview early stopping:", interview_savings(result.get("interview_stats", [])))
\ No newline at end of file
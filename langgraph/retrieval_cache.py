@@ -0,0 +1,170 @@
+""" Persistent cache for web / Wikipedia retrieval results
+
+Analysts working on related topics issue near-identical search queries, so
+results are stored in a local SQLite file keyed on the backend, the
+normalized query and the retrieval parameters (max_results, load_max_docs).
+Entries expire after a TTL and the table is kept under a fixed number of
+rows by evicting the least recently used entries.
+
+Configuration (environment):
+    RETRIEVAL_CACHE_PATH         SQLite file (default ~/.cache/multi-agents/retrieval.sqlite),
+                                 ":memory:" for a per-process cache, empty to disable caching
+    RETRIEVAL_CACHE_TTL          seconds an entry stays valid (default one day)
+    RETRIEVAL_CACHE_MAX_ENTRIES  LRU bound on stored entries (default 10000)
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from langchain_core.documents import Document
+
+def normalize_query(query: str) -> str:
+
+    """ Lowercase, drop punctuation and collapse whitespace so trivially different queries share an entry """
+
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+def dump_documents(docs):
+
+    """ Documents -> JSON-serializable dicts """
+
+    return [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+
+def load_documents(data):
+
+    """ JSON dicts -> Documents """
+
+    return [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in data]
+
+class RetrievalCache:
+
+    """ SQLite-backed retrieval cache with TTL expiry, LRU eviction and hit / miss counters
+
+    An empty path disables it: nothing is stored and every fetch calls the backend.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 24 * 3600, max_entries: int = 10000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        # Opened lazily so importing a graph never touches the disk
+        if self._conn is None:
+            if self.path != ":memory:" and os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            if self.path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                      key TEXT PRIMARY KEY,
+                                      backend TEXT,
+                                      query TEXT,
+                                      value TEXT,
+                                      created REAL,
+                                      accessed REAL)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_created ON entries (created)")
+            self._conn.commit()
+        return self._conn
+
+    def key(self, backend: str, query: str, **params) -> str:
+        payload = json.dumps([backend, normalize_query(query), sorted(params.items())])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, backend: str, query: str, **params):
+
+        """ Cached value or None; counts a hit or a miss """
+
+        if not self.path:
+            return None
+        key = self.key(backend, query, **params)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                conn.commit()
+                self.counters["expired"] += 1
+                row = None
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.counters["hits"] += 1
+            return json.loads(row[0])
+
+    def put(self, backend: str, query: str, value, **params):
+
+        """ Store a value, then drop expired entries and trim to max_entries """
+
+        if not self.path:
+            return
+        key = self.key(backend, query, **params)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, backend, normalize_query(query), json.dumps(value), now, now))
+            conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl_seconds,))
+            overflow = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed ASC LIMIT ?)",
+                             (overflow,))
+                self.counters["evictions"] += overflow
+            conn.commit()
+
+    def fetch(self, backend: str, query: str, retrieve, **params):
+
+        """ Cached result for the query, or call retrieve() and store what it returns
+
+        Only non-empty result lists are stored, so backend errors (TavilySearchResults returns
+        them as strings) and empty hits are retried on the next call.
+        """
+
+        cached = self.get(backend, query, **params)
+        if cached is not None:
+            return cached
+        value = retrieve()
+        if isinstance(value, list) and value:
+            self.put(backend, query, value, **params)
+        return value
+
+    async def afetch(self, backend: str, query: str, aretrieve, **params):
+
+        """ Async variant of fetch, aretrieve is a coroutine function """
+
+        cached = self.get(backend, query, **params)
+        if cached is not None:
+            return cached
+        value = await aretrieve()
+        if isinstance(value, list) and value:
+            self.put(backend, query, value, **params)
+        return value
+
+    def stats(self):
+        hits, misses = self.counters["hits"], self.counters["misses"]
+        with self._lock:
+            entries = self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0] if self.path else 0
+        return {"hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "expired": self.counters["expired"],
+                "evictions": self.counters["evictions"],
+                "entries": entries}
+
+# Shared by research_assistant and parallelization, RETRIEVAL_CACHE_PATH="" turns it off
+shared_cache = RetrievalCache(os.environ.get("RETRIEVAL_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "multi-agents", "retrieval.sqlite")),
+                              ttl_seconds=float(os.environ.get("RETRIEVAL_CACHE_TTL", 24 * 3600)),
+                              max_entries=int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", 10000)))
@@ -1,9 +1,12 @@
 from langchain_openai import ChatOpenAI
 from langgraph.graph import MessagesState
-from langgraph.graph import StateGraph, START, END
-from langgraph.prebuilt import ToolNode, tools_condition
+from langgraph.graph import StateGraph, END
+
+from arithmetic import add_fast_path
+from tool_executor import cached_results, cached_tools_condition, pure, tool_node
 
 # Tool
+@pure
 def multiply(a: int, b: int) -> int:
     """Multiplies a and b.
 
@@ -19,18 +22,22 @@ llm_with_tools = llm.bind_tools([multiply])
 
 # Node
 def tool_calling_llm(state: MessagesState):
-    return {"messages": [llm_with_tools.invoke(state["messages"])]}
+    response = llm_with_tools.invoke(state["messages"])
+    # Tool calls the cache can answer skip the tools node
+    return {"messages": [response] + cached_results(response, [multiply])}
 
 # Build graph
 builder = StateGraph(MessagesState)
 builder.add_node("tool_calling_llm", tool_calling_llm)
-builder.add_node("tools", ToolNode([multiply]))
-builder.add_edge(START, "tool_calling_llm")
+builder.add_node("tools", tool_node([multiply]))
+# With ARITHMETIC_FAST_PATH=1 plain arithmetic is answered locally, everything else goes to the LLM
+add_fast_path(builder, "tool_calling_llm", ["multiply"])
 builder.add_conditional_edges(
     "tool_calling_llm",
     # If the latest message (result) from assistant is a tool call -> tools_condition routes to tools
     # If the latest message (result) from assistant is a not a tool call -> tools_condition routes to END
-    tools_condition,
+    # If the tool calls were answered from the cache -> routes to END
+    cached_tools_condition(END),
 )
 builder.add_edge("tools", END)
 
@@ -0,0 +1,191 @@
+""" Sandboxed arithmetic for the math tool
+
+eval() on a model-produced string runs whatever the model wrote. Here an
+expression is parsed once to an AST, checked against a whitelist (numbers,
+arithmetic and comparison operators, a fixed set of math functions and
+constants, variables the caller defined) and compiled into a tree of
+closures; compiled expressions are cached, so an expression the agent uses
+again is not parsed again.
+
+evaluate_steps runs several steps in one call, where a step may assign a
+name ("total = 12 * 8") for later steps to use. A list literal
+("prices = [10, 20, 30]") becomes a NumPy array, and arithmetic and
+functions on it are vectorized; without NumPy installed, lists are rejected.
+"""
+
+import ast
+import math
+import operator
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Largest exponent of ** and argument of factorial, and the largest integer result (in bits) of ** and *.
+# Python integers have no size limit, so without these 9 ** 9 ** 9 or (9 ** 9999) ** 9999 hang the worker.
+# 14000 bits is ~4200 digits, under the 4300 digits Python will turn into a string for the tool message
+MAX_EXPONENT = 10000
+MAX_FACTORIAL = 1000
+MAX_BITS = 14000
+
+def too_large():
+    return ValueError(f"Result larger than {MAX_BITS} bits")
+
+def checked_pow(base, exponent):
+    if np is not None and isinstance(exponent, np.ndarray):
+        if np.any(np.abs(exponent) > MAX_EXPONENT):
+            raise ValueError(f"Exponent larger than {MAX_EXPONENT}")
+    elif abs(exponent) > MAX_EXPONENT:
+        raise ValueError(f"Exponent larger than {MAX_EXPONENT}")
+    # Estimate the size of an integer power before computing it
+    elif isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and abs(base) > 1:
+        if exponent * math.log2(abs(base)) > MAX_BITS:
+            raise too_large()
+    return operator.pow(base, exponent)
+
+def checked_mul(a, b):
+    if isinstance(a, int) and isinstance(b, int) and a.bit_length() + b.bit_length() > MAX_BITS:
+        raise too_large()
+    return operator.mul(a, b)
+
+def checked_factorial(n):
+    if n > MAX_FACTORIAL:
+        raise ValueError(f"factorial argument larger than {MAX_FACTORIAL}")
+    return math.factorial(n)
+
+CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau, "inf": math.inf}
+
+FUNCTIONS = {name: getattr(math, name) for name in (
+    "sqrt", "exp", "log", "log2", "log10", "sin", "cos", "tan", "asin", "acos", "atan", "atan2",
+    "sinh", "cosh", "tanh", "floor", "ceil", "hypot", "degrees", "radians")}
+FUNCTIONS.update({"abs": abs, "round": round, "min": min, "max": max, "sum": sum, "pow": checked_pow, "factorial": checked_factorial,
+                  "mean": lambda values: sum(values) / len(values)})
+
+# Array versions used when an argument is a NumPy array
+ARRAY_FUNCTIONS = {} if np is None else {
+    "sqrt": np.sqrt, "exp": np.exp, "log": np.log, "log2": np.log2, "log10": np.log10, "sin": np.sin,
+    "cos": np.cos, "tan": np.tan, "asin": np.arcsin, "acos": np.arccos, "atan": np.arctan, "atan2": np.arctan2,
+    "sinh": np.sinh, "cosh": np.cosh, "tanh": np.tanh, "floor": np.floor, "ceil": np.ceil, "hypot": np.hypot,
+    "degrees": np.degrees, "radians": np.radians, "abs": np.abs, "round": np.round, "min": np.min,
+    "max": np.max, "sum": np.sum, "pow": checked_pow, "mean": np.mean}
+
+BINARY = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: checked_mul, ast.Div: operator.truediv,
+          ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: checked_pow}
+UNARY = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+COMPARE = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+           ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+def is_array(value) -> bool:
+    return np is not None and isinstance(value, np.ndarray)
+
+def call(name, args):
+    if name in ARRAY_FUNCTIONS and any(is_array(arg) for arg in args):
+        return ARRAY_FUNCTIONS[name](*args)
+    return FUNCTIONS[name](*args)
+
+def build(node):
+
+    """ Closure env -> value for a whitelisted AST node, ValueError for anything else """
+
+    if isinstance(node, ast.Expression):
+        return build(node.body)
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError(f"Unsupported constant {node.value!r}")
+        value = node.value
+        return lambda env: value
+    if isinstance(node, ast.Name):
+        name = node.id
+        if name in CONSTANTS:
+            value = CONSTANTS[name]
+            return lambda env: value
+        def lookup(env):
+            if name not in env:
+                raise ValueError(f"Unknown name {name!r}")
+            return env[name]
+        return lookup
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+        op, left, right = BINARY[type(node.op)], build(node.left), build(node.right)
+        return lambda env: op(left(env), right(env))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY:
+        op, operand = UNARY[type(node.op)], build(node.operand)
+        return lambda env: op(operand(env))
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in COMPARE:
+        op, left, right = COMPARE[type(node.ops[0])], build(node.left), build(node.comparators[0])
+        return lambda env: op(left(env), right(env))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        if node.func.id not in FUNCTIONS:
+            raise ValueError(f"Unknown function {node.func.id!r}, use one of {', '.join(FUNCTIONS)}")
+        name, args = node.func.id, [build(arg) for arg in node.args]
+        return lambda env: call(name, [arg(env) for arg in args])
+    if isinstance(node, (ast.List, ast.Tuple)):
+        if np is None:
+            raise ValueError("Lists need NumPy, which is not installed")
+        items = [build(item) for item in node.elts]
+        return lambda env: np.array([item(env) for item in items], dtype=float)
+    raise ValueError(f"Unsupported syntax ({type(node).__name__}), only numbers, operators and math functions are allowed")
+
+@lru_cache(maxsize=4096)
+def compile_expression(expr: str):
+
+    """ Compiled (cached) closure of an expression """
+
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid expression {expr!r}: {e.msg}") from None
+    return build(tree)
+
+@lru_cache(maxsize=4096)
+def compile_step(step: str):
+
+    """ (name or None, compiled expression) of "name = expression" or a bare expression """
+
+    target, sep, expr = step.partition("=")
+    target = target.strip()
+    # "x == 1" is a comparison ("x <= 1" and friends fail isidentifier)
+    if sep and target.isidentifier() and not expr.startswith("="):
+        if target in CONSTANTS or target in FUNCTIONS:
+            raise ValueError(f"Cannot assign to {target!r}")
+        return target, compile_expression(expr)
+    return None, compile_expression(step)
+
+def as_result(value):
+
+    """ Plain Python numbers / lists for the tool message """
+
+    if is_array(value):
+        return value.tolist()
+    if np is not None and isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def make_env(variables):
+
+    """ Variables for evaluation, lists become arrays """
+
+    return {name: np.asarray(value, dtype=float) if isinstance(value, (list, tuple)) and np is not None else value
+            for name, value in (variables or {}).items()}
+
+def evaluate(expr: str, variables: dict = None):
+
+    """ Value of one expression, with optional variables """
+
+    env = make_env(variables)
+    return as_result(compile_expression(expr)(env))
+
+def evaluate_steps(steps, variables: dict = None):
+
+    """ Values of the steps in order, each step may assign a name used by the later ones """
+
+    env = make_env(variables)
+    results = []
+    for step in steps:
+        name, compiled = compile_step(step)
+        value = compiled(env)
+        if name:
+            env[name] = value
+        results.append(as_result(value))
+    return results
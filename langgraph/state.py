@@ -3,12 +3,14 @@ from IPython.display import Image, display
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import MessagesState
 from langgraph.graph import START, StateGraph
-from langgraph.prebuilt import tools_condition, ToolNode
+
+from tool_executor import cached_results, cached_tools_condition, pure, tool_node
 
 from langchain_core.messages import HumanMessage, SystemMessage
 
 from langchain_openai import ChatOpenAI
 
+@pure
 def multiply(a: int, b: int) -> int:
     """Multiply a and b.
 
@@ -19,6 +21,7 @@ def multiply(a: int, b: int) -> int:
     return a * b
 
 # This will be a tool
+@pure
 def add(a: int, b: int) -> int:
     """Adds a and b.
 
@@ -28,6 +31,7 @@ def add(a: int, b: int) -> int:
     """
     return a + b
 
+@pure
 def divide(a: int, b: int) -> float:
     """Divide a by b.
 
@@ -46,14 +50,16 @@ sys_msg = SystemMessage(content="You are a helpful assistant tasked with perform
 
 # Node
 def assistant(state: MessagesState):
-   return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+   response = llm_with_tools.invoke([sys_msg] + state["messages"])
+   # Tool calls the cache can answer skip the tools node
+   return {"messages": [response] + cached_results(response, tools)}
 
 # Graph
 builder = StateGraph(MessagesState)
 
 # Define nodes: these do the work
 builder.add_node("assistant", assistant)
-builder.add_node("tools", ToolNode(tools))
+builder.add_node("tools", tool_node(tools))
 
 # Define edges: these determine the control flow
 builder.add_edge(START, "assistant")
@@ -61,7 +67,8 @@ builder.add_conditional_edges(
     "assistant",
     # If the latest message (result) from assistant is a tool call -> tools_condition routes to tools
     # If the latest message (result) from assistant is a not a tool call -> tools_condition routes to END
-    tools_condition,
+    # If the tool calls were answered from the cache -> routes to assistant
+    cached_tools_condition("assistant"),
 )
 builder.add_edge("tools", "assistant")
 
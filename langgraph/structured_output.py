@@ -0,0 +1,287 @@
+""" Structured output with local repair
+
+llama3.1 regularly returns structured output that is almost right: JSON
+wrapped in prose or code fences, cut off before its closing brackets, enum
+values in the wrong case ("High") or phrased differently ("urgent"), an
+index one past the end of the list. with_structured_output fails the whole
+call on any of these and the usual fix is another full LLM call.
+
+structured(llm, schema) asks for the raw response alongside the parsed one
+and, when parsing fails, repairs the raw text locally before falling back to
+a retry:
+
+1. keeps the first JSON value, dropping prose and code fences around it,
+2. closes an unterminated string and any open brackets, drops dangling keys
+   and trailing commas,
+3. unwraps {"EmailClassification": {...}} style wrappers, wraps a bare list
+   for single-list schemas,
+4. coerces Literal fields to their allowed values (case, aliases, close matches),
+5. applies the caller's fixup (e.g. clamping an index into range), which also
+   runs on responses that parsed fine.
+
+Outcomes are counted per schema, see repair_stats().
+"""
+
+import difflib
+import json
+import re
+import threading
+import typing
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.exceptions import OutputParserException
+from pydantic import BaseModel, ValidationError
+
+# schema name -> Counter of outcomes: parsed, repaired, retried, failed
+counters = defaultdict(Counter)
+_lock = threading.Lock()
+
+def record(schema_name, outcome):
+    with _lock:
+        counters[schema_name][outcome] += 1
+
+def repair_stats():
+
+    """ Totals of every outcome across schemas, and per schema """
+
+    with _lock:
+        totals = sum(counters.values(), Counter())
+        calls = totals["parsed"] + totals["repaired"] + totals["failed"]
+        return {**{outcome: totals[outcome] for outcome in ("parsed", "repaired", "retried", "failed")},
+                "repair_rate": totals["repaired"] / calls if calls else 0.0,
+                "by_schema": {name: dict(c) for name, c in counters.items()}}
+
+### Repairing JSON text
+
+def raw_text(message):
+
+    """ Text of the structured response: invalid tool call arguments, tool call arguments or the content """
+
+    for call in getattr(message, "invalid_tool_calls", None) or []:
+        if call.get("args"):
+            return call["args"]
+    for call in getattr(message, "tool_calls", None) or []:
+        return json.dumps(call["args"])
+    content = getattr(message, "content", message)
+    if isinstance(content, list):
+        content = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return content or ""
+
+def repair_json(text: str):
+
+    """ Best-effort parse of the first JSON value in text, closing whatever was left open; None if hopeless """
+
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return None
+    text = text[min(starts):]
+
+    # Walk the value, tracking open brackets outside strings
+    closers, in_string, escaped = [], False, False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers and closers[-1] == ch:
+            closers.pop()
+            if not closers:
+                # Complete value, anything after it is prose
+                text = text[:i + 1]
+                break
+    else:
+        # Truncated: close the string, drop a dangling separator or key, close the brackets
+        if in_string:
+            text += '"'
+        text = text.rstrip().rstrip(",:").rstrip()
+        if closers and closers[-1] == "}":
+            text = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"$', r"\1", text).rstrip().rstrip(",")
+        text += "".join(reversed(closers))
+
+    text = re.sub(r",\s*([}\]])", r"\1", text)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+### Fitting data to the schema
+
+def field_types(schema):
+
+    """ field name -> annotation, for pydantic models and TypedDicts """
+
+    if isinstance(schema, type) and issubclass(schema, BaseModel):
+        return {name: field.annotation for name, field in schema.model_fields.items()}
+    return typing.get_type_hints(schema)
+
+def literal_choices(annotation):
+
+    """ Allowed values of a Literal annotation (also inside Optional), None for other types """
+
+    if typing.get_origin(annotation) is typing.Literal:
+        return typing.get_args(annotation)
+    for arg in typing.get_args(annotation):
+        if typing.get_origin(arg) is typing.Literal:
+            return typing.get_args(arg)
+    return None
+
+def coerce_choice(value, choices, aliases=None):
+
+    """ Map a near miss onto one of choices: exact, alias, case, a choice named in the value, close spelling """
+
+    if value in choices:
+        return value
+    text = str(value).strip().lower()
+    if aliases and text in aliases:
+        return aliases[text]
+    by_lower = {str(choice).lower(): choice for choice in choices}
+    if text in by_lower:
+        return by_lower[text]
+    named = [choice for key, choice in by_lower.items() if re.search(rf"\b{re.escape(key)}\b", text)]
+    if len(named) == 1:
+        return named[0]
+    close = difflib.get_close_matches(text, list(by_lower), n=1, cutoff=0.75)
+    return by_lower[close[0]] if close else value
+
+def fit_schema(data, schema, aliases=None):
+
+    """ Reshape parsed JSON towards the schema's fields """
+
+    types = field_types(schema)
+    # {"SchemaName": {...}} or {"properties": {...}} wrappers
+    if isinstance(data, dict) and len(data) == 1 and not set(data) & set(types):
+        inner = next(iter(data.values()))
+        if isinstance(inner, dict):
+            data = inner
+    # A bare list for a schema holding one list
+    if isinstance(data, list) and len(types) == 1:
+        data = {next(iter(types)): data}
+    if not isinstance(data, dict):
+        return data
+    data = dict(data)
+    for name, annotation in types.items():
+        choices = literal_choices(annotation)
+        if choices and name in data:
+            data[name] = coerce_choice(data[name], choices, (aliases or {}).get(name))
+    return data
+
+def validate(data, schema):
+
+    """ Instance of the schema (pydantic model) or checked dict (TypedDict), raises ValueError if data does not fit """
+
+    if isinstance(schema, type) and issubclass(schema, BaseModel):
+        return schema.model_validate(data)
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected an object for {schema.__name__}, got {type(data).__name__}")
+    for name, annotation in field_types(schema).items():
+        choices = literal_choices(annotation)
+        if name not in data and name in getattr(schema, "__required_keys__", ()):
+            raise ValueError(f"Missing field {name!r} for {schema.__name__}")
+        if choices and name in data and data[name] not in choices:
+            raise ValueError(f"{name}={data[name]!r} is not one of {choices}")
+    return data
+
+def as_data(parsed):
+    return parsed.model_dump() if isinstance(parsed, BaseModel) else dict(parsed)
+
+### The structured LLM
+
+class StructuredOutput:
+
+    """ llm.with_structured_output(schema) that repairs malformed responses locally before retrying """
+
+    def __init__(self, llm, schema, fixup=None, aliases=None, retries: int = 1, repair: bool = True):
+        self.runnable = llm.with_structured_output(schema, include_raw=True)
+        self.schema = schema
+        self.name = getattr(schema, "__name__", str(schema))
+        self.fixup = fixup
+        self.aliases = aliases
+        self.retries = retries
+        self.repair = repair
+
+    def _resolve(self, response, fixup):
+
+        """ (result, outcome) of one response, result None when it could not be used """
+
+        fixup = (fixup or self.fixup) if self.repair else None
+        parsed = response.get("parsed")
+        if parsed is not None and response.get("parsing_error") is None:
+            if not self.repair:
+                return parsed, "parsed"
+            # LangChain checks Literal values of pydantic models only, dicts and TypedDicts go through the schema here
+            is_model = isinstance(parsed, BaseModel)
+            data = as_data(parsed)
+            try:
+                fixed = data if is_model else fit_schema(data, self.schema, self.aliases)
+                if fixup:
+                    fixed = fixup(dict(fixed))
+                if fixed == data:
+                    return (parsed if is_model else validate(data, self.schema)), "parsed"
+                return validate(fixed, self.schema), "repaired"
+            except (ValidationError, ValueError, TypeError):
+                # Repair from the raw text below, else retry
+                pass
+        if not self.repair:
+            return None, None
+        data = repair_json(raw_text(response.get("raw")))
+        if data is None:
+            return None, None
+        data = fit_schema(data, self.schema, self.aliases)
+        if fixup and isinstance(data, dict):
+            data = fixup(data)
+        try:
+            return validate(data, self.schema), "repaired"
+        except (ValidationError, ValueError, TypeError):
+            return None, None
+
+    def _finish(self, response, attempt, fixup):
+        result, outcome = self._resolve(response, fixup)
+        if outcome:
+            record(self.name, outcome)
+            return result
+        if attempt < self.retries:
+            record(self.name, "retried")
+            return None
+        record(self.name, "failed")
+        raise OutputParserException(f"Could not parse or repair {self.name} output: {response.get('parsing_error')}",
+                                    llm_output=raw_text(response.get("raw")))
+
+    def invoke(self, input, config=None, fixup=None):
+        for attempt in range(self.retries + 1):
+            result = self._finish(self.runnable.invoke(input, config), attempt, fixup)
+            if result is not None:
+                return result
+
+    async def ainvoke(self, input, config=None, fixup=None):
+        for attempt in range(self.retries + 1):
+            result = self._finish(await self.runnable.ainvoke(input, config), attempt, fixup)
+            if result is not None:
+                return result
+
+    def batch(self, inputs, config=None, fixups=None):
+
+        """ invoke over inputs, at most config["max_concurrency"] at a time, with an optional fixup per input """
+
+        fixups = fixups or [None] * len(inputs)
+        max_workers = (config or {}).get("max_concurrency") or len(inputs) or 1
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(lambda args: self.invoke(*args), [(i, None, f) for i, f in zip(inputs, fixups)]))
+
+def structured(llm, schema, fixup=None, aliases=None, retries: int = 1, repair: bool = True) -> StructuredOutput:
+
+    """ Drop-in for llm.with_structured_output(schema) with local repair, see the module docstring
+
+    fixup(data) -> data adjusts the response as a dict (before validation), aliases maps a Literal
+    field to {"phrase": "allowed value"}, retries is how many extra LLM calls an unrepairable
+    response may cost, repair=False skips repair and fixups and only retries (for comparison).
+    """
+
+    return StructuredOutput(llm, schema, fixup=fixup, aliases=aliases, retries=retries, repair=repair)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The examples are flat modules in the directory above, imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,30 @@
+import pytest
+
+from arithmetic import parse_arithmetic
+
+@pytest.mark.parametrize("text, expected", [
+    ("Multiply 3 by 4.", ("multiply", 3, 4)),
+    ("what is 12 * 8?", ("multiply", 12, 8)),
+    ("What's 7 times 6?", ("multiply", 7, 6)),
+    ("Please add 2 and 3", ("add", 2, 3)),
+    ("2+3", ("add", 2, 3)),
+    ("calculate the sum of 1.5 and 2", ("add", 1.5, 2)),
+    ("Divide 10 by 4", ("divide", 10, 4)),
+    ("-6 / 3", ("divide", -6, 3)),
+])
+def test_parses_single_operations(text, expected):
+    assert parse_arithmetic(text) == expected
+
+@pytest.mark.parametrize("text", [
+    "Multiply 3 by 4 and then add 7",
+    "What is the square root of 9?",
+    "Explain what a divisor is",
+    "0x10",
+    "3x4",
+])
+def test_leaves_everything_else_to_the_llm(text):
+    assert parse_arithmetic(text) is None
+
+def test_operations_filter():
+    assert parse_arithmetic("2 + 3", operations={"multiply"}) is None
+    assert parse_arithmetic("2 * 3", operations={"multiply"}) == ("multiply", 2, 3)
@@ -0,0 +1,53 @@
+from doc_store import DocumentStore
+
+def test_documents_are_stored_once():
+    store = DocumentStore()
+    first = store.put("page", "interview-1")
+    assert store.put("page", "interview-2") == first
+    assert store.resolve([first]) == ["page"]
+    assert store.stats()["documents"] == 1
+
+def test_put_is_idempotent_per_owner():
+    store = DocumentStore(max_unreferenced_bytes=0)
+    doc_id = store.put("page", "interview-1")
+    store.put("page", "interview-1")
+    store.release("interview-1")
+    # One release drops the owner's reference, however often it stored the page
+    assert store.stats()["referenced"] == 0
+    assert store.stats()["documents"] == 0
+    assert doc_id not in store._texts
+
+def test_documents_live_while_any_owner_holds_them():
+    store = DocumentStore(max_unreferenced_bytes=0)
+    doc_id = store.put("page", "interview-1")
+    store.put("page", "interview-2")
+    store.release("interview-1")
+    assert store.resolve([doc_id]) == ["page"]
+    store.release("interview-2")
+    assert store.stats()["documents"] == 0
+
+def test_unreferenced_documents_are_evicted_oldest_first():
+    store = DocumentStore(max_unreferenced_bytes=8)
+    old, new = store.put("old page", "interview-1"), store.put("new page", "interview-2")
+    store.release("interview-1")
+    store.release("interview-2")
+    assert store.resolve([new]) == ["new page"]
+    assert old not in store._texts
+    assert store.counters["evicted"] == 1
+
+def test_releasing_an_unknown_owner_is_a_no_op():
+    store = DocumentStore()
+    store.release("never-stored")
+    assert store.stats()["referenced"] == 0
+
+def test_persisted_documents_resolve_in_a_new_store_until_evicted(tmp_path):
+    path = str(tmp_path / "documents.sqlite")
+    store = DocumentStore(max_unreferenced_bytes=0)
+    store.persist(path)
+    doc_id = store.put("page", "interview-1")
+    resumed = DocumentStore()
+    resumed.persist(path)
+    assert resumed.get(doc_id) == "page"
+    # Eviction deletes the row as well
+    store.release("interview-1")
+    assert store._db.execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 0
@@ -0,0 +1,54 @@
+import retrieval_cache
+from retrieval_cache import RetrievalCache
+
+def test_fetch_caches_non_empty_results():
+    cache = RetrievalCache(":memory:")
+    calls = []
+    retrieve = lambda: calls.append(1) or [{"url": "u", "content": "c"}]
+    assert cache.fetch("tavily", "LangGraph agents?", retrieve, max_results=3) == [{"url": "u", "content": "c"}]
+    # Normalized query, same parameters: served from the cache
+    assert cache.fetch("tavily", "langgraph  AGENTS", retrieve, max_results=3) == [{"url": "u", "content": "c"}]
+    assert len(calls) == 1
+    # Other parameters are another entry
+    cache.fetch("tavily", "langgraph agents", retrieve, max_results=5)
+    assert len(calls) == 2
+
+def test_errors_and_empty_results_are_not_stored():
+    cache = RetrievalCache(":memory:")
+    cache.fetch("tavily", "q", lambda: "HTTPError('429')")
+    cache.fetch("tavily", "q", lambda: [])
+    assert cache.stats()["entries"] == 0
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retrieval_cache.time, "time", lambda: now[0])
+    cache = RetrievalCache(":memory:", ttl_seconds=60)
+    cache.put("wikipedia", "q", ["page"])
+    now[0] += 59
+    assert cache.get("wikipedia", "q") == ["page"]
+    now[0] += 2
+    assert cache.get("wikipedia", "q") is None
+    assert cache.counters["expired"] == 1
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retrieval_cache.time, "time", lambda: now[0])
+    cache = RetrievalCache(":memory:", max_entries=2)
+    for query in ("a", "b"):
+        now[0] += 1
+        cache.put("tavily", query, [query])
+    now[0] += 1
+    cache.get("tavily", "a")
+    now[0] += 1
+    cache.put("tavily", "c", ["c"])
+    assert cache.get("tavily", "a") == ["a"]
+    assert cache.get("tavily", "b") is None
+    assert cache.stats()["evictions"] == 1
+
+def test_empty_path_disables_the_cache(tmp_path):
+    cache = RetrievalCache("")
+    calls = []
+    for _ in range(2):
+        cache.fetch("tavily", "q", lambda: calls.append(1) or ["hit"])
+    assert len(calls) == 2
+    assert cache.stats()["entries"] == 0
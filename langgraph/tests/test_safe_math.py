@@ -0,0 +1,33 @@
+import pytest
+
+import safe_math
+
+def test_arithmetic_and_functions():
+    assert safe_math.evaluate("12 * 8") == 96
+    assert safe_math.evaluate("2 ** 10 // 3 % 7") == 341 % 7
+    assert safe_math.evaluate("sqrt(16) + max(1, 5)") == 9.0
+    assert safe_math.evaluate("pi > 3")
+
+def test_variables():
+    assert safe_math.evaluate("x * 2 + 1", {"x": 20}) == 41
+
+@pytest.mark.parametrize("expr", ["__import__('os').system('id')", "().__class__.__bases__",
+                                  "open('/etc/passwd').read()", "lambda: 1", "[x for x in range(3)]"])
+def test_rejects_everything_else(expr):
+    with pytest.raises(Exception):
+        safe_math.evaluate(expr)
+
+def test_bounds_huge_results():
+    with pytest.raises(ValueError):
+        safe_math.evaluate("9 ** 9 ** 9")
+    with pytest.raises(ValueError):
+        safe_math.evaluate("factorial(100000)")
+
+def test_steps_assign_names():
+    assert safe_math.evaluate_steps(["total = 12 * 8", "total + 4"]) == [96, 100]
+    with pytest.raises(ValueError):
+        safe_math.evaluate_steps(["pi = 3"])
+
+@pytest.mark.skipif(safe_math.np is None, reason="NumPy not installed")
+def test_lists_are_vectorized():
+    assert safe_math.evaluate_steps(["prices = [10, 20, 30]", "prices * 2"])[-1] == [20.0, 40.0, 60.0]
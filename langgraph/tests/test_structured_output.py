@@ -0,0 +1,41 @@
+from typing import Literal, TypedDict
+
+from pydantic import BaseModel
+
+from structured_output import fit_schema, repair_json
+
+class Subjects(BaseModel):
+    subjects: list[str]
+
+class Classification(TypedDict):
+    intent: Literal["question", "bug", "billing"]
+    urgency: Literal["low", "medium", "high", "critical"]
+
+def test_repair_json_plain():
+    assert repair_json('{"id": 2}') == {"id": 2}
+
+def test_repair_json_drops_prose_and_fences():
+    assert repair_json('Sure! Here it is: {"id": 2} Let me know.') == {"id": 2}
+    assert repair_json('```json\n{"subjects": ["a", "b"]}\n```') == {"subjects": ["a", "b"]}
+
+def test_repair_json_closes_truncated_value():
+    assert repair_json('{"subjects": ["keyboards", "debug') == {"subjects": ["keyboards", "debug"]}
+    assert repair_json('{"intent": "bug", "urgency":') == {"intent": "bug"}
+
+def test_repair_json_trailing_comma():
+    assert repair_json('{"subjects": ["a", "b",],}') == {"subjects": ["a", "b"]}
+
+def test_repair_json_hopeless():
+    assert repair_json("I'm sorry, I cannot help with that.") is None
+
+def test_fit_schema_unwraps_and_wraps():
+    assert fit_schema({"Subjects": {"subjects": ["a"]}}, Subjects) == {"subjects": ["a"]}
+    assert fit_schema(["a", "b"], Subjects) == {"subjects": ["a", "b"]}
+
+def test_fit_schema_coerces_literals():
+    data = fit_schema({"intent": "Billing", "urgency": "urgent"}, Classification, aliases={"urgency": {"urgent": "high"}})
+    assert data == {"intent": "billing", "urgency": "high"}
+    assert fit_schema({"intent": "it is a bug report", "urgency": "critcal"}, Classification) == {"intent": "bug", "urgency": "critical"}
+
+def test_fit_schema_leaves_unknown_values():
+    assert fit_schema({"intent": "refund", "urgency": "low"}, Classification)["intent"] == "refund"
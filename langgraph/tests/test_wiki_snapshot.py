@@ -0,0 +1,35 @@
+import pytest
+
+import wiki_snapshot
+
+ARTICLES = [
+    ("LangGraph", "LangGraph is a library for building stateful agents as graphs of nodes and edges."),
+    ("Python (programming language)", "Python is a programming language. Python code is readable."),
+    ("Llama", "The llama is a domesticated South American camelid."),
+]
+
+@pytest.fixture
+def snapshot_dir(tmp_path):
+    # Tiny runs so the on-disk merge of sorted runs is exercised
+    assert wiki_snapshot.build_snapshot(iter(ARTICLES), str(tmp_path), max_run_postings=4) == len(ARTICLES)
+    yield str(tmp_path)
+    wiki_snapshot.open_snapshot.cache_clear()
+
+def test_query_ranks_the_matching_article_first(snapshot_dir):
+    docs = wiki_snapshot.WikipediaSnapshotLoader("python programming", load_max_docs=2, path=snapshot_dir).load()
+    assert docs[0].metadata == {"title": "Python (programming language)",
+                                "source": "https://en.wikipedia.org/wiki/Python_(programming_language)"}
+    assert docs[0].page_content == ARTICLES[1][1]
+
+def test_query_without_matches_returns_nothing(snapshot_dir):
+    assert wiki_snapshot.WikipediaSnapshotLoader("quantum chromodynamics", path=snapshot_dir).load() == []
+
+def test_documents_are_truncated_like_wikipedia_loader(snapshot_dir):
+    docs = wiki_snapshot.WikipediaSnapshotLoader("llama camelid", load_max_docs=1, path=snapshot_dir, doc_content_chars_max=10).load()
+    assert [doc.page_content for doc in docs] == [ARTICLES[2][1][:10]]
+
+def test_pure_python_search_matches_numpy(snapshot_dir, monkeypatch):
+    snapshot = wiki_snapshot.open_snapshot(snapshot_dir)
+    expected = snapshot.search("graphs of nodes python", k=3)
+    monkeypatch.setattr(wiki_snapshot, "np", None)
+    assert snapshot.search("graphs of nodes python", k=3) == expected
@@ -0,0 +1,280 @@
+""" Timeouts, a parallelism cap and a result cache for the prebuilt ToolNode
+
+The prebuilt ToolNode already runs the tool calls of one AI message
+concurrently (sync calls on a thread pool, async calls gathered), so a turn
+with two searches and a wait takes as long as the slowest call.
+tool_node(tools) returns a ToolNode, keeping InjectedState, Command returns
+and handle_tool_errors, with wrappers around every call that add what it
+lacks:
+
+- every call has a timeout (per tool name, else the default); a call that
+  runs out of time answers with an error ToolMessage so the model can react,
+  and the other calls still return their results,
+- at most max_parallel calls of the node run at once.
+
+Tools marked pure(tool) (same arguments, same result, no side effects)
+are answered from a bounded LRU cache keyed on their validated arguments,
+so "multiply 2 and 3" costs nothing the second time. When every call of an
+AI message is cached, cached_results(message, tools) answers them in the
+LLM node itself and cached_tools_condition routes past the tool node.
+
+A timeout counts from the start of the call, so a call waiting for a slot
+spends part of its budget there, and does not start once it is used up. A
+sync tool that times out cannot be interrupted: its thread finishes in the
+background and its result is dropped, neither counted nor cached.
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from langchain_core.messages import ToolMessage
+from langgraph.prebuilt import ToolNode, tools_condition
+from langchain_core.tools import BaseTool, tool as as_tool
+
+# Calls of one tool node running at once, and the default timeout of a call
+tool_max_parallel = int(os.environ.get("TOOL_MAX_PARALLEL", 8))
+tool_timeout = float(os.environ.get("TOOL_TIMEOUT_SECONDS", 30))
+
+# Outcomes of every call: ok, error, timeout, unknown, cached
+tool_stats = Counter()
+_lock = threading.Lock()
+
+def record(outcome, count: int = 1):
+    with _lock:
+        tool_stats[outcome] += count
+
+### Pure tools
+
+def pure(tool):
+
+    """ Mark a tool (function or BaseTool) as pure so its results are cached, returns the tool """
+
+    tool = tool if isinstance(tool, BaseTool) else as_tool(tool)
+    tool.metadata = {**(tool.metadata or {}), "pure": True}
+    return tool
+
+def is_pure(tool) -> bool:
+    return bool((tool.metadata or {}).get("pure"))
+
+class ToolCache:
+
+    """ Bounded LRU of pure tool results keyed on (tool name, canonical arguments) """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    @staticmethod
+    def key(tool, args):
+        # Validate first, so {"a": "2", "b": 3.0} and {"b": 3, "a": 2} are the same call
+        try:
+            args = tool.tool_call_schema.model_validate(args).model_dump()
+        except Exception:
+            pass
+        return tool.name, json.dumps(args, sort_keys=True, default=str)
+
+    def contains(self, key) -> bool:
+        with self._lock:
+            return key in self._results
+
+    def get(self, key):
+
+        """ Cached content or None, counting the hit or miss """
+
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.counters["hits"] += 1
+                return self._results[key]
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, content):
+        with self._lock:
+            self._results[key] = content
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.counters.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {**{name: self.counters[name] for name in ("hits", "misses", "evictions")},
+                    "hit_rate": self.counters["hits"] / lookups if lookups else 0.0,
+                    "size": len(self._results)}
+
+# Shared by every tool node of the process
+tool_cache = ToolCache(int(os.environ.get("TOOL_CACHE_SIZE", 1024)))
+
+def cached_message(call, content):
+    return ToolMessage(content=content, name=call["name"], tool_call_id=call["id"])
+
+def cached_results(message, tools, cache: ToolCache = None):
+
+    """ ToolMessages answering the message's tool calls from the cache, [] unless every call is a cached pure call """
+
+    cache = cache or tool_cache
+    tools = {t.name: t for t in tools if isinstance(t, BaseTool)}
+    calls = getattr(message, "tool_calls", None) or []
+    if not calls:
+        return []
+    keys = []
+    for call in calls:
+        tool = tools.get(call["name"])
+        if tool is None or not is_pure(tool) or not cache.contains(cache.key(tool, call["args"])):
+            return []
+        keys.append(cache.key(tool, call["args"]))
+    results = [cache.get(key) for key in keys]
+    # Evicted between the check and the lookup
+    if any(content is None for content in results):
+        return []
+    record("cached", len(calls))
+    return [cached_message(call, content) for call, content in zip(calls, results)]
+
+def cached_tools_condition(answered: str):
+
+    """ tools_condition that routes to `answered` when the LLM node already answered the calls from the cache """
+
+    def condition(state):
+        messages = state["messages"] if isinstance(state, dict) else state
+        if isinstance(messages[-1], ToolMessage):
+            return answered
+        return tools_condition(state)
+    return condition
+
+### Limits around each tool call
+
+def error_message(call, content):
+    return ToolMessage(content=content, name=call["name"], tool_call_id=call["id"], status="error")
+
+class ToolCallLimits:
+
+    """ wrap_tool_call / awrap_tool_call of a ToolNode: cache, timeout and parallelism cap of every call """
+
+    def __init__(self, max_parallel: int = None, timeout: float = None, timeouts: dict = None, cache: ToolCache = None):
+        self.max_parallel = max_parallel or tool_max_parallel
+        self.timeout = timeout or tool_timeout
+        self.timeouts = timeouts or {}
+        self.cache = cache or tool_cache
+        self._slots = threading.BoundedSemaphore(self.max_parallel)
+        # asyncio semaphores belong to one event loop
+        self._async_slots = weakref.WeakKeyDictionary()
+
+    def limit(self, call) -> float:
+        return self.timeouts.get(call["name"], self.timeout)
+
+    def _cache_key(self, request):
+        if request.tool is None or not is_pure(request.tool):
+            return None
+        return self.cache.key(request.tool, request.tool_call["args"])
+
+    def _cached(self, request):
+
+        """ Cached ToolMessage of a pure call, or None """
+
+        key = self._cache_key(request)
+        content = self.cache.get(key) if key else None
+        if content is None:
+            return None
+        record("cached")
+        return cached_message(request.tool_call, content)
+
+    def _timed_out(self, call):
+        record("timeout")
+        return error_message(call, f"Error: {call['name']} did not finish within {self.limit(call):g} seconds.")
+
+    def _done(self, request, message):
+
+        """ Count and cache the result of a call that finished in time """
+
+        failed = isinstance(message, ToolMessage) and message.status == "error"
+        record("error" if failed else "ok")
+        key = self._cache_key(request)
+        if key and isinstance(message, ToolMessage) and not failed:
+            self.cache.put(key, message.content)
+        return message
+
+    def wrap(self, request, execute):
+
+        """ Sync call on its own thread, waited for at most the call's timeout """
+
+        call = request.tool_call
+        cached = self._cached(request)
+        if cached is not None:
+            return cached
+        if request.tool is None:
+            # ToolNode answers with its own error message
+            record("unknown")
+            return execute(request)
+        deadline = time.monotonic() + self.limit(call)
+
+        def run():
+            # A call still waiting for a slot at its deadline never starts
+            if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                return None
+            try:
+                return execute(request)
+            finally:
+                self._slots.release()
+
+        pool = ThreadPoolExecutor(max_workers=1)
+        future = pool.submit(contextvars.copy_context().run, run)
+        pool.shutdown(wait=False)
+        try:
+            message = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            message = None
+        # Timed out: the running thread finishes in the background and its result is dropped
+        if message is None:
+            return self._timed_out(call)
+        return self._done(request, message)
+
+    async def awrap(self, request, execute):
+
+        """ Async call, cancelled at the call's timeout """
+
+        call = request.tool_call
+        cached = self._cached(request)
+        if cached is not None:
+            return cached
+        if request.tool is None:
+            record("unknown")
+            return await execute(request)
+        loop = asyncio.get_running_loop()
+        slots = self._async_slots.setdefault(loop, asyncio.Semaphore(self.max_parallel))
+
+        async def limited():
+            async with slots:
+                return await execute(request)
+        try:
+            message = await asyncio.wait_for(limited(), self.limit(call))
+        except asyncio.TimeoutError:
+            return self._timed_out(call)
+        return self._done(request, message)
+
+def tool_node(tools, max_parallel: int = None, timeout: float = None, timeouts: dict = None, cache: ToolCache = None, **kwargs):
+
+    """ Prebuilt ToolNode with per-call timeouts, a parallelism cap and the pure tool cache, see the module docstring
+
+    max_parallel and timeout default to TOOL_MAX_PARALLEL and TOOL_TIMEOUT_SECONDS,
+    timeouts maps a tool name to its own timeout in seconds, pure tools use cache (default tool_cache).
+    Other keyword arguments (handle_tool_errors, ...) go to ToolNode.
+    """
+
+    limits = ToolCallLimits(max_parallel=max_parallel, timeout=timeout, timeouts=timeouts, cache=cache)
+    return ToolNode(tools, wrap_tool_call=limits.wrap, awrap_tool_call=limits.awrap, **kwargs)
@@ -0,0 +1,342 @@
+""" Offline Wikipedia snapshot backend
+
+Answers Wikipedia queries from a local dump instead of the Wikipedia API.
+A one-time indexer turns a dump into a directory holding:
+
+    articles.bin   concatenated article texts (UTF-8), memory-mapped at query time
+    postings.bin   inverted index postings, (doc id, term frequency) uint32 pairs, memory-mapped
+    doclens.bin    indexed length of every article (uint32), memory-mapped
+    index.sqlite   lexicon (term -> postings offset, document frequency) and article titles / offsets
+
+Queries are ranked with BM25 and returned as Documents carrying the same
+metadata as WikipediaLoader (title, source), truncated like WikipediaLoader
+to 4000 characters.
+
+Build:
+    python wiki_snapshot.py build enwiki-latest-pages-articles.xml.bz2 wiki_snapshot/
+    python wiki_snapshot.py build articles.jsonl wiki_snapshot/     # {"title": ..., "text": ...} per line
+Query:
+    python wiki_snapshot.py query wiki_snapshot/ "large language model agents"
+
+Only the first max_index_words words of each article are indexed (the whole
+text is stored). Postings are collected in memory for max_run_postings
+postings at a time, written to disk as a sorted run, and the runs are merged
+into postings.bin at the end, so building a full dump needs memory for one
+run rather than for the whole index.
+
+Queries score postings with NumPy over the memory-mapped file (a pure
+Python loop when NumPy is not installed), so common terms whose postings
+cover most of the dump cost milliseconds.
+"""
+
+import bz2
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from array import array
+from collections import Counter
+from functools import lru_cache
+from urllib.parse import quote
+
+from langchain_core.documents import Document
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from passage_index import STOPWORDS, tokenize
+
+### Reading dumps
+
+def read_jsonl(path):
+
+    """ (title, text) pairs from a JSON lines file, e.g. WikiExtractor --json output """
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                article = json.loads(line)
+                yield article["title"], article["text"]
+
+def clean_wikitext(text: str) -> str:
+
+    """ Rough wikitext -> plain text: drops templates, tables, refs, markup; keeps link labels """
+
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.DOTALL)
+    text = re.sub(r"<ref[^>]*/>|<ref[^>]*>.*?</ref>", "", text, flags=re.DOTALL)
+    # Nested templates / tables: strip innermost first until none are left
+    for pattern in (r"\{\{[^{}]*\}\}", r"\{\|[^{}]*?\|\}"):
+        previous = None
+        while previous != text:
+            previous, text = text, re.sub(pattern, "", text, flags=re.DOTALL)
+    text = re.sub(r"\[\[(?:File|Image|Category):[^\[\]]*(?:\[\[[^\]]*\]\][^\[\]]*)*\]\]", "", text)
+    text = re.sub(r"\[\[(?:[^|\]]*\|)?([^\]]*)\]\]", r"\1", text)
+    text = re.sub(r"\[https?://\S+ ([^\]]*)\]", r"\1", text)
+    text = re.sub(r"<[^>]+>", "", text)
+    text = re.sub(r"'{2,}", "", text)
+    text = re.sub(r"^=+\s*(.*?)\s*=+\s*$", r"\1", text, flags=re.MULTILINE)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+def read_mediawiki_xml(path):
+
+    """ (title, text) of the main-namespace, non-redirect pages of a MediaWiki XML dump (.xml or .xml.bz2) """
+
+    opener = bz2.open if path.endswith(".bz2") else open
+    with opener(path, "rb") as f:
+        title = namespace = text = None
+        redirect = False
+        for _, elem in ET.iterparse(f, events=("end",)):
+            tag = elem.tag.rsplit("}", 1)[-1]
+            if tag == "title":
+                title = elem.text
+            elif tag == "ns":
+                namespace = elem.text
+            elif tag == "redirect":
+                redirect = True
+            elif tag == "text":
+                text = elem.text or ""
+            elif tag == "page":
+                if namespace == "0" and not redirect and title:
+                    yield title, clean_wikitext(text or "")
+                title = namespace = text = None
+                redirect = False
+                elem.clear()
+
+def read_dump(path):
+    return read_jsonl(path) if path.endswith((".jsonl", ".json")) else read_mediawiki_xml(path)
+
+### Building
+
+def write_run(postings, path: str):
+
+    """ Sorted run: postings of every term in term order, and a term -> (position, df) listing next to it """
+
+    with open(path + ".postings", "wb") as f, open(path + ".terms", "w", encoding="utf-8") as terms:
+        position = 0
+        for term in sorted(postings):
+            postings[term].tofile(f)
+            terms.write(f"{term}\t{position}\t{len(postings[term]) // 2}\n")
+            position += len(postings[term])
+
+def read_run(path: str):
+
+    """ (term, postings) pairs of a run, in term order """
+
+    data = _mmap_file(path + ".postings")
+    with open(path + ".terms", encoding="utf-8") as terms:
+        for line in terms:
+            term, position, df = line.rstrip("\n").split("\t")
+            position, df = int(position), int(df)
+            chunk = array("I")
+            chunk.frombytes(data[position * 4:(position + 2 * df) * 4])
+            yield term, chunk
+
+def build_snapshot(articles, out_dir: str, max_index_words: int = 2000, max_run_postings: int = 20_000_000):
+
+    """ Write the snapshot for an iterable of (title, text) pairs, returns the number of articles """
+
+    os.makedirs(out_dir, exist_ok=True)
+    db_path = os.path.join(out_dir, "index.sqlite")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path)
+    db.execute("CREATE TABLE docs (id INTEGER PRIMARY KEY, title TEXT, offset INTEGER, length INTEGER)")
+    db.execute("CREATE TABLE lexicon (term TEXT PRIMARY KEY, offset INTEGER, df INTEGER)")
+
+    runs, postings, run_size = [], {}, 0
+    num_docs = offset = 0
+    with open(os.path.join(out_dir, "articles.bin"), "wb") as store, open(os.path.join(out_dir, "doclens.bin"), "wb") as doclens:
+        for doc_id, (title, text) in enumerate(articles):
+            data = text.encode("utf-8")
+            store.write(data)
+            db.execute("INSERT INTO docs VALUES (?, ?, ?, ?)", (doc_id, title, offset, len(data)))
+            offset += len(data)
+            num_docs += 1
+
+            # Title words count twice, they are the strongest signal of what an article is about
+            tf = Counter(tokenize(f"{title} {title} " + " ".join(text.split()[:max_index_words])))
+            array("I", [sum(tf.values())]).tofile(doclens)
+            for term, count in tf.items():
+                if term not in postings:
+                    postings[term] = array("I")
+                postings[term].extend((doc_id, count))
+            run_size += len(tf)
+
+            # Runs cover increasing doc id ranges, so merging them in run order keeps postings sorted by doc id
+            if run_size >= max_run_postings:
+                runs.append(os.path.join(out_dir, f"run{len(runs)}"))
+                write_run(postings, runs[-1])
+                postings, run_size = {}, 0
+    if postings or not runs:
+        runs.append(os.path.join(out_dir, f"run{len(runs)}"))
+        write_run(postings, runs[-1])
+        postings = None
+
+    # k-way merge of the runs into postings.bin and the lexicon
+    with open(os.path.join(out_dir, "postings.bin"), "wb") as f:
+        position, lexicon = 0, []
+        merged = heapq.merge(*(read_run(run) for run in runs), key=lambda item: item[0])
+        for term, group in itertools.groupby(merged, key=lambda item: item[0]):
+            df = 0
+            for _, chunk in group:
+                chunk.tofile(f)
+                df += len(chunk) // 2
+            lexicon.append((term, position, df))
+            position += 2 * df
+            if len(lexicon) >= 10000:
+                db.executemany("INSERT INTO lexicon VALUES (?, ?, ?)", lexicon)
+                lexicon = []
+    db.executemany("INSERT INTO lexicon VALUES (?, ?, ?)", lexicon)
+    for run in runs:
+        os.remove(run + ".postings")
+        os.remove(run + ".terms")
+    db.execute("CREATE INDEX docs_title ON docs (title COLLATE NOCASE)")
+    db.commit()
+    db.close()
+    return num_docs
+
+### Querying
+
+def _mmap_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class WikipediaSnapshot:
+
+    """ Read-only view of a snapshot directory """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self._lock = threading.Lock()
+        self._articles = _mmap_file(os.path.join(path, "articles.bin"))
+        self._postings = memoryview(_mmap_file(os.path.join(path, "postings.bin"))).cast("I")
+        self._doc_lengths = memoryview(_mmap_file(os.path.join(path, "doclens.bin"))).cast("I")
+        self.num_docs = len(self._doc_lengths)
+        if np is not None:
+            self._postings_array = np.frombuffer(self._postings, dtype=np.uint32)
+            self._lengths_array = np.frombuffer(self._doc_lengths, dtype=np.uint32)
+            self.avg_length = float(self._lengths_array.mean()) if self.num_docs else 1.0
+        else:
+            self.avg_length = sum(self._doc_lengths) / self.num_docs if self.num_docs else 1.0
+
+    def _lookup(self, term):
+        with self._lock:
+            return self._db.execute("SELECT offset, df FROM lexicon WHERE term = ?", (term,)).fetchone()
+
+    def search(self, query: str, k: int = 2):
+
+        """ Ids of the k best articles for the query (BM25) """
+
+        terms = [t for t in set(tokenize(query)) if t not in STOPWORDS] or set(tokenize(query))
+        if np is not None:
+            return self._search_arrays(terms, k)
+        scores = Counter()
+        for term in terms:
+            row = self._lookup(term)
+            if row is None:
+                continue
+            offset, df = row
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            for i in range(offset, offset + 2 * df, 2):
+                doc_id, tf = self._postings[i], self._postings[i + 1]
+                length = self._doc_lengths[doc_id]
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self.avg_length))
+        return [doc_id for doc_id, _ in heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))]
+
+    def _search_arrays(self, terms, k: int):
+
+        """ search with the postings scored as NumPy slices of the memory map """
+
+        ids, contributions = [], []
+        for term in terms:
+            row = self._lookup(term)
+            if row is None:
+                continue
+            offset, df = row
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            postings = self._postings_array[offset:offset + 2 * df]
+            doc_ids, tf = postings[0::2], postings[1::2].astype(np.float64)
+            norms = self.k1 * (1 - self.b + self.b * self._lengths_array[doc_ids] / self.avg_length)
+            ids.append(doc_ids)
+            contributions.append(idf * tf * (self.k1 + 1) / (tf + norms))
+        if not ids:
+            return []
+        ids, contributions = np.concatenate(ids), np.concatenate(contributions)
+        # Sum per document: dense when the postings cover much of the collection, else over the documents hit
+        if len(ids) > self.num_docs // 4:
+            scores = np.bincount(ids, weights=contributions, minlength=self.num_docs)
+            doc_ids = np.arange(self.num_docs)
+        else:
+            doc_ids, inverse = np.unique(ids, return_inverse=True)
+            scores = np.bincount(inverse, weights=contributions)
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        # Candidates down to the k-th score (ties included), then by score and lowest doc id
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= kth)
+        order = np.lexsort((doc_ids[candidates], -scores[candidates]))[:k]
+        return [int(doc_ids[candidates[i]]) for i in order]
+
+    def document(self, doc_id: int, max_chars: int = 4000) -> Document:
+
+        """ Article as a Document shaped like WikipediaLoader output """
+
+        with self._lock:
+            title, offset, length = self._db.execute("SELECT title, offset, length FROM docs WHERE id = ?", (doc_id,)).fetchone()
+        text = bytes(self._articles[offset:offset + length]).decode("utf-8")
+        page = quote(title.replace(" ", "_"), safe="()',")
+        return Document(page_content=text[:max_chars],
+                        metadata={"title": title, "source": f"https://en.wikipedia.org/wiki/{page}"})
+
+@lru_cache(maxsize=None)
+def open_snapshot(path: str) -> WikipediaSnapshot:
+    return WikipediaSnapshot(path)
+
+class WikipediaSnapshotLoader:
+
+    """ Drop-in replacement for WikipediaLoader(query=..., load_max_docs=...) reading a local snapshot """
+
+    def __init__(self, query: str, load_max_docs: int = 2, path: str = None, doc_content_chars_max: int = 4000):
+        self.query = query
+        self.load_max_docs = load_max_docs
+        self.snapshot = open_snapshot(path or os.environ["WIKIPEDIA_SNAPSHOT"])
+        self.doc_content_chars_max = doc_content_chars_max
+
+    def load(self):
+        return [self.snapshot.document(doc_id, self.doc_content_chars_max)
+                for doc_id in self.snapshot.search(self.query, self.load_max_docs)]
+
+    async def aload(self):
+        # Local lookups take milliseconds, no need to leave the event loop
+        return self.load()
+
+if __name__ == "__main__":
+    command, path = sys.argv[1], sys.argv[2]
+    if command == "build":
+        start = time.perf_counter()
+        count = build_snapshot(read_dump(path), sys.argv[3])
+        print(f"Indexed {count} articles into {sys.argv[3]} in {time.perf_counter() - start:.1f}s")
+    elif command == "query":
+        start = time.perf_counter()
+        docs = WikipediaSnapshotLoader(" ".join(sys.argv[3:]), path=path).load()
+        elapsed = time.perf_counter() - start
+        for doc in docs:
+            print(doc.metadata["source"])
+            print(doc.page_content[:300], "\n")
+        print(f"{len(docs)} documents in {elapsed * 1000:.1f} ms")